@@ -11,8 +11,37 @@ import requests
 import shutil
 import urllib.parse
 import re
+import threading
+import math
+import collections
+import contextlib
+import sqlite3
+import heapq
+import signal
+import sys
+import tempfile
+import queue
+import codecs
+import itertools
+import bisect
+import glob
+import gzip
+import ipaddress
+import logging
+import logging.handlers
+import pwd
+import struct
 import netifaces
 
+try:
+    import zstandard    # opcional: compressão zstd dos payloads
+except ImportError:
+    zstandard = None
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 
 # =================== CONFIG ===================
@@ -21,38 +50,774 @@ CONFIG_FILE = '/opt/iwebit_agent/iwebit_agent.conf'
 VERSION = '1.0.40.2'
 LOG_ENABLED = True
 LOG_FILE = '/var/log/iwebit_agent/iwebit_agent.log'
+LOG_MAX_BYTES = 5 * 1024 * 1024   # rotação por tamanho
+LOG_BACKUPS = 5                   # ficheiros rodados (.1.gz ... .5.gz)
+LOG_BUFFER = 200                  # registos em memória antes de escrever
+LOG_FLUSH_INTERVAL = 5            # segundos entre escritas do buffer
 UPDATE_URL = 'https://raw.githubusercontent.com/RDFonseca82/iWebITAgent_Linux/main/iwebit_agent.py'
+UPDATE_SHA256_URL = UPDATE_URL + '.sha256'   # manifesto publicado com o script (saída do sha256sum)
 SCRIPT_PATH = '/opt/iwebit_agent/iwebit_agent.py'
-API_URL = 'https://agent.iwebit.app/scripts/script_linux.php'
+SERVER_URL = 'https://agent.iwebit.app'
+API_URL = f'{SERVER_URL}/scripts/script_linux.php'
+SCRIPT_API_URL = f'{SERVER_URL}/scripts/script_api.php'
+STATE_DIR = '/opt/iwebit_agent/state'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+DMI_ID_DIR = '/sys/class/dmi/id'
+HTTP_TIMEOUT = (5, 30)    # (connect, read) em segundos
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5        # 0.5s, 1s, 2s entre tentativas
+HTTP_RETRY_AFTER_MAX = 2  # segundos máximos de espera pedidos por Retry-After
+SPOOL_MAX_BYTES = 50 * 1024 * 1024   # tamanho máximo do spool offline
+SPOOL_BATCH = 20          # payloads reenviados por ciclo
+SPOOL_RATE = 1.0          # payloads por segundo durante o reenvio
+SPOOL_MAX_ATTEMPTS = 10   # tentativas falhadas antes de um payload ir para dead_letter
+SPOOL_MAX_FAILURE_AGE = 24 * 60 * 60  # ou segundos desde a primeira falha
+SPOOL_RETRY_MAX = 60 * 60 # espera máxima entre tentativas do mesmo payload
+SPOOL_DEAD_LETTER_MAX = 20  # payloads mantidos em dead_letter para diagnóstico
+FULL_SYNC_INTERVAL = 60 * 60
+MINIMAL_SYNC_INTERVAL = 5 * 60
+REMOTE_CHECK_INTERVAL = 2 * 60
+UPDATE_CHECK_INTERVAL = 5 * 60
+SPOOL_DRAIN_INTERVAL = 60
+COLLECTOR_TIMEOUT = 60    # segundos por coletor (valor por omissão)
+COLLECTOR_WORKERS = 8     # threads usadas na recolha paralela do full sync
+CONFIG_CHECK_INTERVAL = 1     # segundos mínimos entre stat() do ficheiro de configuração
+CONFIG_RELOAD_INTERVAL = 30   # verificação periódica de alterações (sem reiniciar)
+STATS_DUMP_FILE = 'agent_stats.json'   # em STATE_DIR, gravado com SIGUSR1
 
 # =================== LOGGING ===================
-def log(message):
-    if LOG_ENABLED:
-        with open(LOG_FILE, 'a') as f:
-            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}\n")
+# Um único ficheiro aberto, com buffer em memória: os registos são escritos a cada
+# LOG_FLUSH_INTERVAL segundos, quando o buffer enche ou logo após um erro.
+# Rotação por tamanho, com os ficheiros antigos comprimidos em gzip.
+_logger = None
+_logger_lock = threading.Lock()
+
+class LogFormatter(logging.Formatter):
+    # [data] [NÍVEL] mensagem chave=valor ...; a data só é formatada uma vez por segundo
+    def __init__(self):
+        super().__init__()
+        self._second = None
+        self._stamp = ''
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self._second:
+            self._second = second
+            self._stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return self._stamp
+
+    def format(self, record):
+        line = f"[{self.formatTime(record)}] [{record.levelname}] {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(
+                f"{key}={json.dumps(value) if isinstance(value, str) and (' ' in value or not value) else value}"
+                for key, value in fields.items()
+            )
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def get_logger():
+    global _logger
+    with _logger_lock:
+        if _logger is not None:
+            return _logger
+
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8', delay=True
+        )
+        file_handler.namer = lambda name: name + '.gz'
+        file_handler.rotator = gzip_rotator
+        file_handler.setFormatter(LogFormatter())
+        buffered = logging.handlers.MemoryHandler(
+            LOG_BUFFER, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True
+        )
+
+        logger = logging.getLogger('iwebit_agent')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(buffered)
+
+        def flush_periodically():
+            while True:
+                time.sleep(LOG_FLUSH_INTERVAL)
+                buffered.flush()
+
+        threading.Thread(target=flush_periodically, name='log-flush', daemon=True).start()
+        _logger = logger
+        return logger
+
+def flush_log():
+    # Escreve o buffer já (antes de os.execv, que não passa pelo atexit)
+    if _logger is not None:
+        for handler in _logger.handlers:
+            handler.flush()
+
+def handle_sigterm(signum, frame):
+    # systemctl stop/restart: sem handler o Python termina sem atexit e perde o
+    # buffer do log; sys.exit passa pelo atexit e pelo logging.shutdown
+    log("SIGTERM recebido, a terminar o agente.")
+    flush_log()
+    sys.exit(0)
+
+def log(message, level='INFO', **fields):
+    if not LOG_ENABLED:
+        return
+    try:
+        levelno = level if isinstance(level, int) else logging.getLevelName(level.upper())
+        get_logger().log(levelno, message, extra={'fields': fields})
+    except Exception:
+        pass
 
 # =================== CONFIG LOAD ===================
-def load_config():
-    global LOG_ENABLED
+# Configuração lida uma única vez e relida apenas quando o ficheiro muda
+# (mtime/tamanho/inode). Cada chave conhecida tem tipo, valor por omissão e
+# limites; valores inválidos são registados e substituídos. Quem precisa de
+# reagir a alterações (intervalos, limites) regista-se com CONFIG.watch().
+CONFIG_SCHEMA = {}
+
+def register_config(key, kind, default, minimum=None, maximum=None, choices=None):
+    CONFIG_SCHEMA[key] = {'Type': kind, 'Default': default, 'Min': minimum, 'Max': maximum,
+                          'Choices': choices}
+
+def parse_config_file(path):
     config = {}
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    config[key.strip()] = value.strip()
-    LOG_ENABLED = config.get('Log', '0') == '1'
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '=' in line:
+                key, value = line.split('=', 1)
+                config[key.strip()] = value.strip()
     return config
 
+def convert_config_value(key, raw):
+    # Devolve (valor, aviso); o aviso é None quando o valor é válido
+    spec = CONFIG_SCHEMA[key]
+    kind, default = spec['Type'], spec['Default']
+    if raw is None:
+        return default, None
+    try:
+        if kind is bool:
+            lowered = raw.lower()
+            if lowered not in ('0', '1', 'true', 'false', 'yes', 'no'):
+                raise ValueError(raw)
+            return lowered in ('1', 'true', 'yes'), None
+        if kind is list:
+            return [item.strip() for item in raw.split(',') if item.strip()], None
+        value = kind(raw)
+    except ValueError:
+        return default, f"Valor inválido para {key}: '{raw}', a usar {default}"
+
+    if spec['Choices'] and value not in spec['Choices']:
+        return default, f"Valor inválido para {key}: '{raw}' (opções: {', '.join(spec['Choices'])}), a usar {default}"
+    if spec['Min'] is not None and value < spec['Min']:
+        return spec['Min'], f"{key}={raw} abaixo do mínimo, a usar {spec['Min']}"
+    if spec['Max'] is not None and value > spec['Max']:
+        return spec['Max'], f"{key}={raw} acima do máximo, a usar {spec['Max']}"
+    return value, None
+
+class AgentConfig:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file_key = False   # False = ainda não carregado
+        self._checked = 0
+        self._raw = {}
+        self._values = {}
+        self._watchers = []
+
+    def refresh(self, force=False):
+        # Custa um stat() enquanto o ficheiro não muda; no máximo um por CONFIG_CHECK_INTERVAL
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._file_key is not False and now - self._checked < CONFIG_CHECK_INTERVAL:
+                return
+            self._checked = now
+            try:
+                st = os.stat(CONFIG_FILE)
+                file_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+            except OSError:
+                file_key = None
+            if file_key == self._file_key:
+                return
+
+            first_load = self._file_key is False
+            try:
+                raw = parse_config_file(CONFIG_FILE) if file_key else {}
+            except OSError:
+                raw = {}
+            warnings = []
+            values = {}
+            for key in CONFIG_SCHEMA:
+                values[key], warning = convert_config_value(key, raw.get(key))
+                if warning:
+                    warnings.append(warning)
+            changed = {key: value for key, value in values.items()
+                       if first_load or self._values.get(key) != value}
+            self._file_key = file_key
+            self._raw = raw
+            self._values = values
+            watchers = list(self._watchers)
+
+        # Fora do lock: os watchers e o log podem voltar a ler a configuração
+        for key, func in watchers:
+            if key in changed:
+                try:
+                    func(changed[key])
+                except Exception as e:
+                    log(f"Erro ao aplicar {key}: {e}", level='ERROR')
+        for warning in warnings:
+            log(warning, level='WARNING')
+        if changed and not first_load:
+            log("Configuração recarregada.", changed=','.join(sorted(changed)))
+
+    def get(self, key, default=None):
+        self.refresh()
+        with self._lock:
+            if key in CONFIG_SCHEMA:
+                return self._values.get(key, CONFIG_SCHEMA[key]['Default'])
+            # Chaves fora do esquema ficam disponíveis como texto
+            return self._raw.get(key, default)
+
+    def watch(self, key, func):
+        # func(valor) é chamada sempre que a chave muda (e já, se a configuração estiver carregada)
+        with self._lock:
+            self._watchers.append((key, func))
+            loaded = self._file_key is not False
+            value = self._values.get(key)
+        if loaded:
+            func(value)
+
+CONFIG = AgentConfig()
+
+def set_log_enabled(enabled):
+    global LOG_ENABLED
+    LOG_ENABLED = enabled
+
+register_config('IdSync', str, '0')
+register_config('UniqueId', str, '0')
+register_config('Log', bool, False)
+register_config('Debug', bool, False)
+register_config('ParallelSync', bool, True)
+register_config('DeltaSync', bool, True)
+register_config('AgentStats', bool, False)
+register_config('DisabledCollectors', list, [])
+register_config('CollectorWorkers', int, COLLECTOR_WORKERS, 1, 32)
+register_config('FullSyncInterval', int, FULL_SYNC_INTERVAL, 60)
+register_config('MinimalSyncInterval', int, MINIMAL_SYNC_INTERVAL, 30)
+register_config('RemoteCheckInterval', int, REMOTE_CHECK_INTERVAL, 2)
+register_config('UpdateCheckInterval', int, UPDATE_CHECK_INTERVAL, 60)
+register_config('SpoolDrainInterval', int, SPOOL_DRAIN_INTERVAL, 10)
+register_config('SpoolBatch', int, SPOOL_BATCH, 1)
+register_config('SpoolRate', float, SPOOL_RATE, 0.01)
+register_config('SpoolMaxMB', int, SPOOL_MAX_BYTES // (1024 * 1024), 1)
+
+CONFIG.watch('Log', set_log_enabled)
+
+# =================== INSTRUMENTATION ===================
+# Métricas internas do agente, acumuladas desde o arranque: tempo real e de CPU
+# por coletor, processos lançados, bytes lidos, tamanho dos payloads e latência
+# HTTP. Enviadas na secção AgentStats (AgentStats=1) e gravadas localmente
+# com SIGUSR1.
+TIME_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000, 60000)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Estimativa pelo limite superior do bucket (nunca acima do máximo real)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= q * self.count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return 0
+
+    def to_dict(self):
+        buckets = {}
+        for i, n in enumerate(self.counts):
+            if n:
+                label = f"<={self.bounds[i]}" if i < len(self.bounds) else f">{self.bounds[-1]}"
+                buckets[label] = n
+        return {
+            'Count': self.count,
+            'Avg': round(self.total / self.count, 1) if self.count else 0,
+            'Max': round(self.max, 1),
+            'P50': round(self.quantile(0.5), 1),
+            'P95': round(self.quantile(0.95), 1),
+            'Buckets': buckets
+        }
+
+class AgentStats:
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # Coletor em execução na thread atual, para atribuir processos e leituras
+        self._local = threading.local()
+        self.collectors = {}
+        self.subprocesses = {'Count': 0, 'Errors': 0, 'Time': Histogram(TIME_BUCKETS_MS)}
+        self.bytes_read = 0
+        self.payloads = Histogram(SIZE_BUCKETS)
+        self.http = {}
+
+    def _collector(self, section):
+        return self.collectors.setdefault(section, {
+            'Runs': 0, 'Errors': 0, 'Timeouts': 0, 'LastWallMs': 0.0,
+            'Subprocesses': 0, 'SubprocessMs': 0.0, 'BytesRead': 0,
+            'WallMs': Histogram(TIME_BUCKETS_MS), 'CpuMs': Histogram(TIME_BUCKETS_MS)
+        })
+
+    def measure(self, section, func):
+        # Executa um coletor medindo o tempo real e o tempo de CPU da thread
+        previous = getattr(self._local, 'section', None)
+        self._local.section = section
+        wall, cpu = time.monotonic(), time.thread_time()
+        error = False
+        try:
+            return func()
+        except Exception:
+            error = True
+            raise
+        finally:
+            wall_ms = (time.monotonic() - wall) * 1000
+            cpu_ms = (time.thread_time() - cpu) * 1000
+            self._local.section = previous
+            with self._lock:
+                stats = self._collector(section)
+                stats['Runs'] += 1
+                stats['Errors'] += 1 if error else 0
+                stats['LastWallMs'] = wall_ms
+                stats['WallMs'].observe(wall_ms)
+                stats['CpuMs'].observe(cpu_ms)
+
+    def record_timeout(self, section):
+        with self._lock:
+            self._collector(section)['Timeouts'] += 1
+
+    def record_subprocess(self, elapsed, error=False):
+        section = getattr(self._local, 'section', None)
+        with self._lock:
+            self.subprocesses['Count'] += 1
+            self.subprocesses['Errors'] += 1 if error else 0
+            self.subprocesses['Time'].observe(elapsed * 1000)
+            if section:
+                stats = self._collector(section)
+                stats['Subprocesses'] += 1
+                stats['SubprocessMs'] += elapsed * 1000
+
+    def record_read(self, nbytes):
+        section = getattr(self._local, 'section', None)
+        with self._lock:
+            self.bytes_read += nbytes
+            if section:
+                self._collector(section)['BytesRead'] += nbytes
+
+    def record_payload(self, nbytes):
+        with self._lock:
+            self.payloads.observe(nbytes)
+
+    def record_http(self, endpoint, elapsed):
+        with self._lock:
+            self.http.setdefault(endpoint, Histogram(TIME_BUCKETS_MS)).observe(elapsed * 1000)
+
+    def slowest(self, limit=3):
+        with self._lock:
+            ranked = sorted(self.collectors.items(), key=lambda item: item[1]['LastWallMs'], reverse=True)
+            return [f"{section}={stats['LastWallMs']:.0f}ms" for section, stats in ranked[:limit]]
+
+    def snapshot(self):
+        http_stats = HTTP.stats()
+        with self._lock:
+            collectors = {}
+            for section, s in self.collectors.items():
+                collectors[section] = {
+                    'Runs': s['Runs'],
+                    'Errors': s['Errors'],
+                    'Timeouts': s['Timeouts'],
+                    'LastWallMs': round(s['LastWallMs'], 1),
+                    'WallMs': s['WallMs'].to_dict(),
+                    'CpuMs': s['CpuMs'].to_dict(),
+                    'Subprocesses': s['Subprocesses'],
+                    'SubprocessMs': round(s['SubprocessMs'], 1),
+                    'BytesRead': s['BytesRead']
+                }
+            for endpoint, histogram in self.http.items():
+                http_stats.setdefault(endpoint, {})['LatencyMs'] = histogram.to_dict()
+            return {
+                'StartedAt': datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                'UptimeSeconds': int(time.time() - self.started),
+                'Collectors': collectors,
+                'Subprocesses': {
+                    'Count': self.subprocesses['Count'],
+                    'Errors': self.subprocesses['Errors'],
+                    'TimeMs': self.subprocesses['Time'].to_dict()
+                },
+                'BytesRead': self.bytes_read,
+                'PayloadBytes': self.payloads.to_dict(),
+                'HTTP': http_stats
+            }
+
+STATS = AgentStats()
+
+# Prazo do coletor em execução na thread atual: os processos lançados por ele
+# recebem o tempo que resta como timeout, para não ficarem presos depois de o
+# coletor ser abandonado por timeout
+_command_budget = threading.local()
+
+def command_deadline():
+    return getattr(_command_budget, 'deadline', None)
+
+@contextlib.contextmanager
+def command_budget(deadline):
+    previous = command_deadline()
+    _command_budget.deadline = deadline
+    try:
+        yield
+    finally:
+        _command_budget.deadline = previous
+
+def command_timeout(default=None):
+    deadline = command_deadline()
+    if deadline is None:
+        return default
+    return max(deadline - time.monotonic(), 1)
+
+def run_command(args, **kwargs):
+    # subprocess.run com contagem de processos, tempo e bytes lidos
+    if 'timeout' not in kwargs and command_deadline() is not None:
+        kwargs['timeout'] = command_timeout()
+    started = time.monotonic()
+    error = True
+    try:
+        result = subprocess.run(args, **kwargs)
+        error = result.returncode != 0
+        if result.stdout:
+            STATS.record_read(len(result.stdout))
+        return result
+    finally:
+        STATS.record_subprocess(time.monotonic() - started, error)
+
+def command_output(args, **kwargs):
+    # Equivalente a subprocess.check_output, contabilizado em STATS
+    return run_command(args, stdout=subprocess.PIPE, check=True, **kwargs).stdout
+
+def dump_agent_stats():
+    try:
+        data = STATS.snapshot()
+        if SCHEDULER:
+            data['Scheduler'] = SCHEDULER.stats()
+        save_state(STATS_DUMP_FILE, data)
+        log(f"Estatísticas do agente gravadas em {state_path(STATS_DUMP_FILE)}")
+    except Exception as e:
+        log(f"Erro ao gravar estatísticas do agente: {e}", level='ERROR')
+
+# =================== HTTP ===================
+# Cliente HTTP partilhado por todo o agente: mantém as ligações abertas
+# (keep-alive) entre ciclos, aplica timeouts e retry com backoff, e conta
+# latência/bytes por endpoint.
+class CappedRetry(Retry):
+    # Um Retry-After grande (ex.: 429 do ipinfo.io) não pode bloquear o pedido
+    # durante minutos: cada espera fica limitada a HTTP_RETRY_AFTER_MAX segundos
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, HTTP_RETRY_AFTER_MAX)
+
+class HttpClient:
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, pool_size=10):
+        self.timeout = timeout
+        # Pedidos não idempotentes (POST) só são repetidos em erros de ligação
+        retry = CappedRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = f'iWebITAgent/{VERSION}'
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if endpoint is None:
+            parsed = urllib.parse.urlparse(url)
+            endpoint = f"{parsed.netloc}{parsed.path}"
+
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            self._record(endpoint, time.monotonic() - start, 0, 0, error=True)
+            raise
+
+        sent = len(response.request.body or b'')
+        if kwargs.get('stream'):
+            received = int(response.headers.get('Content-Length') or 0)
+        else:
+            received = len(response.content)
+        self._record(endpoint, time.monotonic() - start, sent, received, error=response.status_code >= 500)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def _record(self, endpoint, elapsed, sent, received, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                'Requests': 0, 'Errors': 0, 'TotalLatencyMs': 0.0, 'MaxLatencyMs': 0.0,
+                'BytesSent': 0, 'BytesReceived': 0
+            })
+            latency = elapsed * 1000
+            stats['Requests'] += 1
+            stats['Errors'] += 1 if error else 0
+            stats['TotalLatencyMs'] += latency
+            stats['MaxLatencyMs'] = max(stats['MaxLatencyMs'], latency)
+            stats['BytesSent'] += sent
+            stats['BytesReceived'] += received
+        STATS.record_http(endpoint, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'Requests': s['Requests'],
+                    'Errors': s['Errors'],
+                    'AvgLatencyMs': round(s['TotalLatencyMs'] / s['Requests'], 1) if s['Requests'] else 0,
+                    'MaxLatencyMs': round(s['MaxLatencyMs'], 1),
+                    'BytesSent': s['BytesSent'],
+                    'BytesReceived': s['BytesReceived']
+                }
+                for endpoint, s in self._stats.items()
+            }
+
+HTTP = HttpClient()
+
+# =================== STATE ===================
+# Estado persistente do agente (snapshots, caches), em JSON dentro de STATE_DIR
+def state_path(name):
+    return os.path.join(STATE_DIR, name)
+
+def load_state(name, default=None):
+    try:
+        with open(state_path(name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, data):
+    # Escrita atómica: ficheiro temporário + rename
+    path = state_path(name)
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        log(f"Erro ao gravar estado {name}: {e}", level='ERROR')
+
+def remove_state(name):
+    try:
+        os.remove(state_path(name))
+    except FileNotFoundError:
+        pass
+
+# =================== SYNC CACHE ===================
+# Dados partilhados pelos coletores durante um único sync (ex.: snapshot de
+# processos). É limpa no início de cada send_data; cada valor é calculado uma
+# só vez, mesmo com os coletores a correr em paralelo.
+_sync_cache = {}
+_sync_cache_locks = {}
+_sync_cache_lock = threading.Lock()
+# Ações a executar só depois de o payload ser aceite (ex.: gravar cursores),
+# por secção: secções parciais não chegam ao servidor e não são confirmadas
+_sync_commits = []
+
+def begin_sync_cache():
+    with _sync_cache_lock:
+        _sync_cache.clear()
+        _sync_cache_locks.clear()
+        _sync_commits.clear()
+
+def add_sync_commit(section, func):
+    with _sync_cache_lock:
+        _sync_commits.append((section, func))
+
+def run_sync_commits(data):
+    with _sync_cache_lock:
+        commits = list(_sync_commits)
+        _sync_commits.clear()
+    for section, func in commits:
+        value = data.get(section)
+        if isinstance(value, dict) and value.get('Partial'):
+            continue
+        if section not in data:
+            continue
+        try:
+            func()
+        except Exception as e:
+            log(f"Erro ao confirmar secção {section}: {e}", level='ERROR')
+
+def sync_cached(key, func):
+    with _sync_cache_lock:
+        key_lock = _sync_cache_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        if key not in _sync_cache:
+            _sync_cache[key] = func()
+        return _sync_cache[key]
+
+# =================== STATIC INVENTORY ===================
+# Inventário de hardware que só muda com um reboot (BIOS, motherboard, RAM, CPU).
+# Fica guardado em disco associado ao boot_id; é recolhido uma vez por boot.
+_boot_cache = None
+_boot_cache_lock = threading.Lock()
+
+def get_boot_id():
+    try:
+        with open(BOOT_ID_FILE, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def boot_cached(section, func):
+    global _boot_cache
+    boot_id = get_boot_id()
+    if boot_id is None:
+        return func()
+
+    with _boot_cache_lock:
+        if _boot_cache is None or _boot_cache.get('BootId') != boot_id:
+            stored = load_state('static_inventory.json')
+            if not isinstance(stored, dict) or stored.get('BootId') != boot_id:
+                stored = {'BootId': boot_id, 'Sections': {}}
+            _boot_cache = stored
+        if section in _boot_cache['Sections']:
+            return _boot_cache['Sections'][section]
+
+    value = func()
+    with _boot_cache_lock:
+        if _boot_cache.get('BootId') == boot_id:
+            _boot_cache['Sections'][section] = value
+            save_state('static_inventory.json', _boot_cache)
+    return value
 
 # =================== DATA COLLECTION ===================
 def get_cpu_usage():
-    return psutil.cpu_percent(interval=1)
+    # Sem espera: CPU desde a leitura anterior (o sampler faz a primeira ao ser criado)
+    return psutil.cpu_percent(interval=None)
 
-def get_cpu_info():
+# =================== RESOURCE SAMPLER ===================
+SAMPLE_INTERVAL = 5        # segundos entre amostras
+SAMPLE_BUFFER = 720        # 1 hora de amostras a cada 5s
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize(values):
+    return {
+        'Avg': round(sum(values) / len(values), 1),
+        'Max': round(max(values), 1),
+        'P95': round(percentile(values, 95), 1)
+    }
+
+class ResourceSampler(threading.Thread):
+    # Recolhe CPU (total e por core), memória, swap e load average em segundo
+    # plano para um buffer circular. O sync lê o buffer sem bloquear e reporta
+    # média/máximo/p95 do intervalo desde o último sync.
+    def __init__(self, interval=SAMPLE_INTERVAL, size=SAMPLE_BUFFER):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.last_summary = time.time()
+        self._lock = threading.Lock()
+        # A primeira leitura sem intervalo só serve de referência; feita já aqui,
+        # get_cpu_usage() tem um valor real antes da primeira amostra
+        psutil.cpu_percent(interval=None)
+        psutil.cpu_percent(interval=None, percpu=True)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                sample = {
+                    'Time': time.time(),
+                    'CPU': psutil.cpu_percent(interval=None),
+                    'PerCore': psutil.cpu_percent(interval=None, percpu=True),
+                    'Memory': psutil.virtual_memory().percent,
+                    'Swap': psutil.swap_memory().percent,
+                    'LoadAvg': os.getloadavg()
+                }
+            except Exception as e:
+                log(f"Erro ao recolher amostra de recursos: {e}", level='ERROR')
+                continue
+            with self._lock:
+                self.samples.append(sample)
+
+    def summary(self):
+        # Estatísticas desde o último summary(); None se ainda não houver amostras
+        with self._lock:
+            since = self.last_summary
+            window = [s for s in self.samples if s['Time'] > since]
+            if not window:
+                return None
+            self.last_summary = window[-1]['Time']
+
+        cores = len(window[0]['PerCore'])
+        per_core = [[s['PerCore'][i] for s in window if len(s['PerCore']) == cores] for i in range(cores)]
+        latest = window[-1]
+        return {
+            'Samples': len(window),
+            'WindowSeconds': int(latest['Time'] - since),
+            'CPU': summarize([s['CPU'] for s in window]),
+            'PerCore': {
+                'Avg': [round(sum(v) / len(v), 1) for v in per_core],
+                'Max': [round(max(v), 1) for v in per_core]
+            },
+            'Memory': summarize([s['Memory'] for s in window]),
+            'Swap': summarize([s['Swap'] for s in window]),
+            'LoadAvg': {
+                '1m': round(latest['LoadAvg'][0], 2),
+                '5m': round(latest['LoadAvg'][1], 2),
+                '15m': round(latest['LoadAvg'][2], 2),
+                'Max1m': round(max(s['LoadAvg'][0] for s in window), 2)
+            }
+        }
+
+SAMPLER = ResourceSampler()
+
+def collect_cpu_info():
     info = {}
 
     try:
@@ -71,12 +836,14 @@ def get_cpu_info():
             info['CPU_Freq_Max_MHz'] = round(freq.max, 2)
             info['CPU_Freq_Current_MHz'] = round(freq.current, 2)
 
-        # Informações do /proc/cpuinfo
+        # Informações do /proc/cpuinfo (apenas o primeiro processador)
+        first_proc = []
         with open('/proc/cpuinfo') as f:
-            cpuinfo = f.read()
-
-        # Primeiro processador listado
-        first_proc = cpuinfo.split('\n\n')[0]
+            for line in f:
+                if not line.strip():
+                    break
+                first_proc.append(line)
+        first_proc = ''.join(first_proc)
 
         # Modelo e fabricante
         model_match = re.search(r'model name\s+:\s+(.+)', first_proc)
@@ -94,6 +861,17 @@ def get_cpu_info():
 
     return info
 
+def get_cpu_info():
+    info = dict(boot_cached('CPU_Info', collect_cpu_info))
+    # A frequência atual é o único valor que muda durante o boot
+    try:
+        freq = psutil.cpu_freq()
+        if freq:
+            info['CPU_Freq_Current_MHz'] = round(freq.current, 2)
+    except Exception:
+        pass
+    return info
+
 def get_memory_usage():
     return psutil.virtual_memory().percent
 
@@ -107,8 +885,151 @@ def get_mac_address():
                 return addr.address
     return '00:00:00:00:00:00'
 
+# =================== PROCESSES ===================
+# Uma única passagem por /proc: stat (estado, tempos, RSS, threads), cmdline e o
+# UID real (status). O CPU% é calculado pela diferença de tempo de CPU face à
+# passagem anterior (sem esperar); processos novos usam a média desde o arranque.
+PROC_DIR = '/proc'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+PROCESS_TOP_N = 25
+PROCESS_STATES = {
+    'R': 'Running', 'S': 'Sleeping', 'D': 'DiskSleep', 'Z': 'Zombie',
+    'T': 'Stopped', 't': 'Stopped', 'I': 'Idle'
+}
+register_config('ProcessTopN', int, PROCESS_TOP_N, 1, 1000)
+register_config('ProcessListMode', str, 'top', choices=('top', 'full'))
+
+_usernames = {}
+_process_cpu = {'Time': None, 'Ticks': {}, 'Window': None}
+_process_cpu_lock = threading.Lock()
+
+def get_username(uid):
+    if uid not in _usernames:
+        try:
+            _usernames[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            _usernames[uid] = str(uid)
+    return _usernames[uid]
+
+def read_proc_boot_time():
+    with open(os.path.join(PROC_DIR, 'stat'), 'rb') as f:
+        for line in f:
+            if line.startswith(b'btime'):
+                return int(line.split()[1])
+    return 0
+
+def read_process_uid(base):
+    # UID real (1.º campo de Uid:). O dono de /proc/<pid> é root nos processos
+    # não "dumpable" (setuid, filhos de sessões sshd), por isso não serve
+    with open(os.path.join(base, 'status'), 'rb') as f:
+        for line in f:
+            if line.startswith(b'Uid:'):
+                return int(line.split()[1]), len(line)
+    raise ValueError("status sem Uid")
+
+def read_process(pid):
+    base = os.path.join(PROC_DIR, pid)
+    uid, status_bytes = read_process_uid(base)
+    with open(os.path.join(base, 'stat'), 'rb') as f:
+        stat = f.read()
+    with open(os.path.join(base, 'cmdline'), 'rb') as f:
+        cmdline_raw = f.read()
+
+    # O nome (comm) pode conter espaços e parênteses: os campos começam após o último ')'
+    rpar = stat.rindex(b')')
+    name = stat[stat.index(b'(') + 1:rpar].decode(errors='replace')
+    fields = stat[rpar + 2:].split()
+    cmdline = [arg.decode(errors='replace') for arg in cmdline_raw.split(b'\0') if arg]
+    if len(name) >= 15 and cmdline:
+        # comm é truncado a 15 caracteres; o nome completo vem do executável
+        full_name = os.path.basename(cmdline[0])
+        if full_name.startswith(name):
+            name = full_name
+
+    return {
+        'pid': int(pid),
+        'name': name,
+        'username': get_username(uid),
+        'cmdline': cmdline,
+        'State': fields[0].decode(),
+        'PPid': int(fields[1]),
+        'Threads': int(fields[17]),
+        'RSSKB': int(fields[21]) * PAGE_SIZE // 1024,
+        'CmdlineHash': hashlib.sha1(cmdline_raw).hexdigest()[:16] if cmdline_raw else None,
+        '_Ticks': int(fields[11]) + int(fields[12]),
+        '_Start': int(fields[19]),
+        '_Bytes': len(stat) + len(cmdline_raw) + status_bytes
+    }
+
+def scan_processes():
+    now = time.monotonic()
+    boot_time = read_proc_boot_time()
+    uptime = time.time() - boot_time
+    processes = []
+    nbytes = 0
+    for entry in os.listdir(PROC_DIR):
+        if not entry.isdigit():
+            continue
+        try:
+            proc = read_process(entry)
+        except (OSError, ValueError, IndexError):
+            continue  # processo terminou durante a leitura
+        nbytes += proc.pop('_Bytes')
+        processes.append(proc)
+    STATS.record_read(nbytes)
+
+    with _process_cpu_lock:
+        previous = _process_cpu['Ticks']
+        window = now - _process_cpu['Time'] if _process_cpu['Time'] else None
+        ticks = {}
+        for proc in processes:
+            key = (proc['pid'], proc.pop('_Start'))
+            proc_ticks = proc.pop('_Ticks')
+            ticks[key] = proc_ticks
+            start_seconds = key[1] / CLOCK_TICKS
+            if window and key in previous:
+                cpu = (proc_ticks - previous[key]) / CLOCK_TICKS / window * 100
+            else:
+                cpu = proc_ticks / CLOCK_TICKS / max(uptime - start_seconds, 1) * 100
+            proc['CPUPercent'] = round(max(cpu, 0.0), 1)
+            proc['CPUTimeSeconds'] = round(proc_ticks / CLOCK_TICKS, 2)
+            proc['StartTime'] = datetime.fromtimestamp(boot_time + start_seconds).strftime('%Y-%m-%d %H:%M:%S')
+        _process_cpu.update({'Time': now, 'Ticks': ticks, 'Window': round(window, 1) if window else None})
+    return processes
+
+def get_process_snapshot():
+    # Tabela de processos lida uma vez por sync e partilhada pelos coletores
+    return sync_cached('processes', scan_processes)
+
 def get_process_list():
-    return [p.info for p in psutil.process_iter(attrs=['pid', 'name', 'username'])]
+    # Por omissão só os ProcessTopN com mais CPU e com mais memória;
+    # ProcessListMode = full envia todos
+    processes = [{k: v for k, v in p.items() if k != 'cmdline'} for p in get_process_snapshot()]
+    if CONFIG.get('ProcessListMode') == 'full':
+        return processes
+
+    top_n = CONFIG.get('ProcessTopN')
+    top = {p['pid']: p for p in heapq.nlargest(top_n, processes, key=lambda p: p['CPUPercent'])}
+    for p in heapq.nlargest(top_n, processes, key=lambda p: p['RSSKB']):
+        top[p['pid']] = p
+    return sorted(top.values(), key=lambda p: (-p['CPUPercent'], -p['RSSKB']))
+
+def get_process_summary():
+    processes = get_process_snapshot()
+    states = collections.Counter(PROCESS_STATES.get(p['State'], 'Other') for p in processes)
+    users = collections.Counter(p['username'] for p in processes)
+    return {
+        'Total': len(processes),
+        'States': dict(states),
+        'Threads': sum(p['Threads'] for p in processes),
+        'TotalRSSKB': sum(p['RSSKB'] for p in processes),
+        'TotalCPUPercent': round(sum(p['CPUPercent'] for p in processes), 1),
+        'Users': dict(users.most_common(10)),
+        'CPUWindowSeconds': _process_cpu['Window'],
+        'Mode': CONFIG.get('ProcessListMode'),
+        'TopN': CONFIG.get('ProcessTopN')
+    }
 
 def get_hostname():
     return socket.gethostname()
@@ -138,19 +1059,98 @@ def get_current_user():
     except Exception:
         return "NULL"
 
-def get_public_ip():
+EGRESS_TTL = 6 * 60 * 60          # segundos entre consultas ao ipinfo.io
+EGRESS_RETRY_INTERVAL = 5 * 60    # após uma falha, mantém o último valor e espera antes de tentar de novo
+_egress_lock = threading.Lock()
+register_config('EgressTTL', int, EGRESS_TTL, 60)
+
+def get_network_fingerprint():
+    # Gateway por omissão + endereços da interface de saída. Se mudar, o IP
+    # público/localização provavelmente mudou também.
     try:
-        return requests.get('https://api.ipify.org').text
-    except:
-        return 'Unavailable'
+        default = netifaces.gateways().get('default', {}).get(netifaces.AF_INET)
+        if not default:
+            return None
+        gateway, iface = default[0], default[1]
+        addresses = sorted(
+            addr.address for addr in psutil.net_if_addrs().get(iface, [])
+            if addr.family in (socket.AF_INET, socket.AF_INET6)
+        )
+        return hashlib.sha256(f"{gateway}|{iface}|{','.join(addresses)}".encode()).hexdigest()
+    except Exception:
+        return None
 
-def get_location():
+def valid_ip(value):
     try:
-        res = requests.get('https://ipinfo.io/json').json()
-        loc = res.get('loc', '0,0').split(',')
-        return loc[0], loc[1]
-    except:
-        return '0', '0'
+        ipaddress.ip_address(value)
+        return isinstance(value, str)
+    except ValueError:
+        return False
+
+def lookup_egress_identity():
+    # O ipinfo.io devolve IP e localização no mesmo pedido; o ipify fica como recurso.
+    # Respostas de erro (429, 503...) ou sem um IP válido contam como falha,
+    # para não substituírem o último valor conhecido.
+    try:
+        resp = HTTP.get('https://ipinfo.io/json', endpoint='ipinfo')
+        resp.raise_for_status()
+        res = resp.json()
+        if not valid_ip(res.get('ip')):
+            raise ValueError(f"IP inválido: {str(res.get('ip'))[:50]}")
+        loc = res.get('loc')
+        loc = loc.split(',') if isinstance(loc, str) else []
+        latitude, longitude = loc if len(loc) == 2 else (None, None)
+        return {'PublicIP': res['ip'], 'Latitude': latitude, 'Longitude': longitude}
+    except Exception as e:
+        log(f"Falha ao consultar ipinfo.io: {e}", level='WARNING')
+    try:
+        resp = HTTP.get('https://api.ipify.org', endpoint='ipify')
+        resp.raise_for_status()
+        ip = resp.text.strip()
+        if not valid_ip(ip):
+            raise ValueError(f"IP inválido: {ip[:50]}")
+        return {'PublicIP': ip, 'Latitude': None, 'Longitude': None}
+    except Exception as e:
+        log(f"Falha ao consultar api.ipify.org: {e}", level='WARNING')
+    return None
+
+def get_egress_identity():
+    # IP público + localização em cache (memória e disco) durante EgressTTL segundos.
+    # Renova antes do prazo se a rede local mudar; se a consulta falhar mantém o último valor.
+    ttl = CONFIG.get('EgressTTL')
+
+    with _egress_lock:
+        cached = load_state('egress_identity.json', {})
+        if not isinstance(cached, dict):
+            cached = {}
+        now = time.time()
+        fingerprint = get_network_fingerprint()
+
+        fresh = cached.get('PublicIP') and now - cached.get('Updated', 0) < ttl
+        same_network = fingerprint == cached.get('Fingerprint')
+        retry_wait = now - cached.get('LastAttempt', 0) < min(ttl, EGRESS_RETRY_INTERVAL)
+        if (fresh and same_network) or (retry_wait and same_network):
+            return cached
+
+        identity = lookup_egress_identity()
+        cached['LastAttempt'] = now
+        cached['Fingerprint'] = fingerprint
+        if identity:
+            if identity['Latitude'] is None:
+                # Sem localização (só o ipify respondeu): mantém a última conhecida
+                identity['Latitude'] = cached.get('Latitude', '0')
+                identity['Longitude'] = cached.get('Longitude', '0')
+            cached.update(identity)
+            cached['Updated'] = now
+        save_state('egress_identity.json', cached)
+        return cached
+
+def get_public_ip():
+    return get_egress_identity().get('PublicIP') or 'Unavailable'
+
+def get_location():
+    identity = get_egress_identity()
+    return identity.get('Latitude') or '0', identity.get('Longitude') or '0'
 
 def get_device_type():
     try:
@@ -171,8 +1171,11 @@ def get_device_type():
 
 
 def get_physical_memory_info():
+    return boot_cached('MemoryInfo', collect_physical_memory_info)
+
+def collect_physical_memory_info():
     try:
-        output = subprocess.check_output(['dmidecode', '--type', '17'], text=True, stderr=subprocess.DEVNULL)
+        output = command_output(['dmidecode', '--type', '17'], text=True, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError:
         return []
 
@@ -207,45 +1210,101 @@ def get_physical_memory_info():
 
 
 
+SYS_CLASS_BLOCK = '/sys/class/block'
+DEV_DISK_DIR = '/dev/disk'
+
+def read_sys_value(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_disk_links(kind):
+    # /dev/disk/by-uuid, /dev/disk/by-label: nome do link -> kernel name do dispositivo
+    links = {}
+    directory = os.path.join(DEV_DISK_DIR, kind)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return links
+    for name in names:
+        target = os.path.basename(os.path.realpath(os.path.join(directory, name)))
+        # udev escapa caracteres especiais nos labels (ex.: \x20 para espaço)
+        links[target] = re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), name)
+    return links
+
+def build_block_device_index():
+    # Uma única passagem por /sys/class/block + /dev/disk/by-*, sem criar processos.
+    # Cada dispositivo fica com os "pais" (disco de uma partição, slaves de dm/md).
+    index = {}
+    try:
+        names = os.listdir(SYS_CLASS_BLOCK)
+    except OSError:
+        return index
+
+    uuids = read_disk_links('by-uuid')
+    labels = read_disk_links('by-label')
+
+    for name in names:
+        sys_path = os.path.realpath(os.path.join(SYS_CLASS_BLOCK, name))
+        if os.path.exists(os.path.join(sys_path, 'partition')):
+            parents = [os.path.basename(os.path.dirname(sys_path))]
+        else:
+            try:
+                parents = os.listdir(os.path.join(sys_path, 'slaves'))
+            except OSError:
+                parents = []
+
+        dm_uuid = read_sys_value(os.path.join(sys_path, 'dm', 'uuid')) or ''
+        index[name] = {
+            'Parents': parents,
+            'Crypt': dm_uuid.startswith('CRYPT-'),
+            'Rotational': read_sys_value(os.path.join(sys_path, 'queue', 'rotational')),
+            'UUID': uuids.get(name),
+            'Label': labels.get(name)
+        }
+    return index
+
+def resolve_block_device(index, device):
+    # Devolve (encriptado, tipo de disco) percorrendo os pais até aos discos físicos
+    name = os.path.basename(os.path.realpath(device))
+    if name not in index:
+        return False, "Unknown"
+
+    encrypted = False
+    rotational = set()
+    seen = set()
+    stack = [name]
+    while stack:
+        current = stack.pop()
+        if current in seen or current not in index:
+            continue
+        seen.add(current)
+        entry = index[current]
+        encrypted = encrypted or entry['Crypt']
+        if entry['Parents']:
+            stack.extend(entry['Parents'])
+        elif entry['Rotational'] is not None:
+            rotational.add(entry['Rotational'])
+
+    if not rotational:
+        drive_type = "Unknown"
+    else:
+        drive_type = "HDD" if '1' in rotational else "SSD"
+    return encrypted, drive_type
+
 def get_disk_info():
     disks = []
     partitions = psutil.disk_partitions(all=False)
+    block_index = build_block_device_index()
 
     for part in partitions:
         try:
             usage = psutil.disk_usage(part.mountpoint)
 
-            # Verificar se está encriptado
-            try:
-                lsblk_output = subprocess.check_output(['lsblk', '-no', 'TYPE', part.device], text=True).strip()
-                encrypted = 'crypt' in lsblk_output or 'luks' in lsblk_output.lower()
-            except Exception:
-                encrypted = False
-
-            # Buscar LABEL e UUID com blkid
-            label = None
-            uuid = None
-            try:
-                blkid_output = subprocess.check_output(['blkid', part.device], text=True).strip()
-                for entry in blkid_output.split():
-                    if entry.startswith("LABEL="):
-                        label = entry.split('=')[1].strip('"')
-                    elif entry.startswith("UUID="):
-                        uuid = entry.split('=')[1].strip('"')
-            except Exception:
-                pass
-
-            # Detectar se é SSD ou HDD (via /sys/block/*/queue/rotational)
-            drive_type = "Unknown"
-            try:
-                base_device = os.path.basename(part.device).rstrip("0123456789")
-                rotational_path = f"/sys/block/{base_device}/queue/rotational"
-                if os.path.exists(rotational_path):
-                    with open(rotational_path, 'r') as f:
-                        is_rotational = f.read().strip()
-                        drive_type = "HDD" if is_rotational == "1" else "SSD"
-            except Exception:
-                pass
+            encrypted, drive_type = resolve_block_device(block_index, part.device)
+            entry = block_index.get(os.path.basename(os.path.realpath(part.device)), {})
 
             disks.append({
                 'Device': part.device,
@@ -256,20 +1315,78 @@ def get_disk_info():
                 'FreeGB': round(usage.free / (1024 ** 3), 2),
                 'PercentUsed': usage.percent,
                 'Encrypted': encrypted,
-                'Label': label,
-                'UUID': uuid,
+                'Label': entry.get('Label'),
+                'UUID': entry.get('UUID'),
                 'DriveType': drive_type
             })
 
         except PermissionError:
             continue  # Ignorar partições sem permissão
         except Exception as e:
-            print(f"Erro ao processar {part.device}: {e}")
+            log(f"Erro ao processar {part.device}: {e}", level='WARNING', section='DiskInfo')
             continue
 
     return disks
 
 
+NETWORKD_LEASES_DIR = '/run/systemd/netif/leases'
+NM_DEVICES_DIR = '/run/NetworkManager/devices'
+DHCP_CLIENTS = ('dhclient', 'dhcpcd', 'udhcpc')
+
+def get_dhcp_interfaces():
+    # Conjunto de interfaces com DHCP ativo, calculado uma vez por sync a partir de:
+    # leases do systemd-networkd, estado do NetworkManager e clientes DHCP em execução
+    return sync_cached('dhcp_interfaces', collect_dhcp_interfaces)
+
+def collect_dhcp_interfaces():
+    dhcp = set()
+    try:
+        index_to_name = {str(index): name for index, name in socket.if_nameindex()}
+    except OSError:
+        index_to_name = {}
+
+    # systemd-networkd: /run/systemd/netif/leases/<ifindex>
+    try:
+        for entry in os.listdir(NETWORKD_LEASES_DIR):
+            if entry in index_to_name:
+                dhcp.add(index_to_name[entry])
+    except OSError:
+        pass
+
+    # NetworkManager: /run/NetworkManager/devices/<ifindex> com secção [dhcp4]/[dhcp6]
+    try:
+        for entry in os.listdir(NM_DEVICES_DIR):
+            if entry not in index_to_name:
+                continue
+            try:
+                with open(os.path.join(NM_DEVICES_DIR, entry), 'r') as f:
+                    content = f.read()
+                if '[dhcp4]' in content or '[dhcp6]' in content:
+                    dhcp.add(index_to_name[entry])
+            except OSError:
+                pass
+    except OSError:
+        pass
+
+    # dhclient/dhcpcd/udhcpc: interface passada como argumento ou no nome do ficheiro de lease
+    names = set(index_to_name.values())
+    for proc in get_process_snapshot():
+        if proc.get('name') not in DHCP_CLIENTS:
+            continue
+        for arg in proc.get('cmdline') or []:
+            if arg in names:
+                dhcp.add(arg)
+            elif arg.endswith(('.lease', '.leases')):
+                # dhclient-<iface>.leases, dhclient.<iface>.leases: comparação literal,
+                # porque os nomes podem ter '-' e '.' (br-lan, eth0.100)
+                stem = os.path.basename(arg).rsplit('.', 1)[0]
+                matches = [name for name in names
+                           if stem == name or stem.endswith(('-' + name, '.' + name))]
+                if matches:
+                    dhcp.add(max(matches, key=len))
+
+    return dhcp
+
 def get_network_interfaces_info():
     interfaces = psutil.net_if_addrs()
     gateways = netifaces.gateways()
@@ -281,15 +1398,7 @@ def get_network_interfaces_info():
             return gw[0]
         return None
 
-    def dhcp_enabled(iface):
-        try:
-            output = subprocess.check_output(['ps', 'aux'], text=True)
-            for line in output.splitlines():
-                if 'dhclient' in line and iface in line:
-                    return True
-        except Exception:
-            pass
-        return False
+    dhcp_interfaces = get_dhcp_interfaces()
 
     result = []
 
@@ -306,7 +1415,7 @@ def get_network_interfaces_info():
                 subnet_mask = addr.netmask
 
         gateway = get_gateway_for_interface(iface)
-        dhcp = dhcp_enabled(iface)
+        dhcp = iface in dhcp_interfaces
 
         result.append({
             'Interface': iface,
@@ -338,9 +1447,10 @@ def is_reboot_pending():
     # systemd way (algumas distros modernas)
     try:
         with open("/proc/1/comm") as f:
-            if f.read().strip() == "systemd":
-                result = os.system("needs-restarting -r > /dev/null 2>&1")
-                if result == 1:
+            if f.read().strip() == "systemd" and shutil.which("needs-restarting"):
+                result = run_command(["needs-restarting", "-r"],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if result.returncode == 1:
                     return True
     except:
         pass
@@ -349,100 +1459,165 @@ def is_reboot_pending():
 
 
 
-def get_all_installed_software():
-    software_list = []
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+
+# Cache em memória de ficheiros já interpretados: (loader, args) -> (mtime/tamanho, resultado).
+# key_paths: ficheiros/pastas de que o resultado depende (o primeiro tem de existir,
+# ex.: a base de dados + o -wal do SQLite). Enquanto não mudam, a leitura custa só stat().
+_parsed_file_cache = {}
+_parsed_file_lock = threading.Lock()
 
-    # --------------------- DPKG (APT) ---------------------
+def file_stat_key(path):
     try:
-        output = subprocess.check_output(
-            ['dpkg-query', '-W', '-f=${Package}\t${Version}\t${Installed-Size}\t${Status}\n'],
-            stderr=subprocess.DEVNULL
-        ).decode().strip().split('\n')
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def cached_file_parse(key_paths, loader, *args):
+    st = os.stat(key_paths[0])
+    key = ((key_paths[0], st.st_mtime_ns, st.st_size),) + tuple((p, file_stat_key(p)) for p in key_paths[1:])
+    with _parsed_file_lock:
+        cached = _parsed_file_cache.get((loader, args))
+        if cached and cached[0] == key:
+            return cached[1]
+    result = loader(*args)
+    STATS.record_read(st.st_size)
+    with _parsed_file_lock:
+        _parsed_file_cache[(loader, args)] = (key, result)
+    return result
+
+def parse_dpkg_status(path):
+    packages = []
+    fields = {}
+
+    def flush():
+        if fields.get('Package') and fields.get('Version'):
+            size = fields.get('Installed-Size', '')
+            packages.append({
+                "Name": fields['Package'],
+                "Version": fields['Version'],
+                "Identifier": fields['Package'],
+                "InstallDate": "NULL",
+                "Source": "dpkg",
+                "InstalledSize": int(size) if size.isdigit() else "NULL",  # KiB
+                "Status": fields.get('Status', 'NULL')
+            })
+
+    # Leitura em streaming, stanza a stanza
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line == '\n':
+                flush()
+                fields = {}
+            elif line[0] not in ' \t':
+                key, sep, value = line.partition(':')
+                if sep and key in ('Package', 'Version', 'Installed-Size', 'Status'):
+                    fields[key] = value.strip()
+    flush()
+    return packages
+
+def read_dpkg_status():
+    return cached_file_parse((DPKG_STATUS_FILE,), parse_dpkg_status, DPKG_STATUS_FILE)
+
+def list_snap_packages():
+    packages = []
+    snap_output = command_output(['snap', 'list'], stderr=subprocess.DEVNULL).decode().strip().split('\n')[1:]
+    for line in snap_output:
+        parts = line.split()
+        if len(parts) >= 4:
+            name = parts[0]
+            version = parts[1]
+            install_date = parts[-1]  # Última coluna costuma ser data
+            packages.append({
+                "Name": name,
+                "Version": version,
+                "Identifier": name,
+                "InstallDate": install_date,
+                "Source": "snap"
+            })
+    return packages
 
-        for line in output:
+def list_flatpak_packages():
+    packages = []
+    flatpak_output = command_output(
+        ['flatpak', 'list', '--columns=application,version,installation'],
+        stderr=subprocess.DEVNULL
+    ).decode().strip().split('\n')
+
+    for line in flatpak_output:
+        if '\t' in line:
             parts = line.split('\t')
             if len(parts) >= 2:
-                name = parts[0]
-                version = parts[1]
-                identifier = name
-                software_list.append({
-                    "Name": name,
+                app_id = parts[0]
+                version = parts[1] or "Unknown"
+                packages.append({
+                    "Name": app_id,
                     "Version": version,
-                    "Identifier": identifier,
-                    "InstallDate": "NULL"
+                    "Identifier": app_id,
+                    "InstallDate": "NULL",
+                    "Source": "flatpak"
                 })
-    except Exception as e:
-        pass
-
-    # --------------------- SNAP ---------------------
-    try:
-        snap_output = subprocess.check_output(['snap', 'list'], stderr=subprocess.DEVNULL).decode().strip().split('\n')[1:]
-        for line in snap_output:
-            parts = line.split()
-            if len(parts) >= 4:
-                name = parts[0]
-                version = parts[1]
-                install_date = parts[-1]  # Última coluna costuma ser data
-                software_list.append({
-                    "Name": name,
-                    "Version": version,
-                    "Identifier": name,
-                    "InstallDate": install_date
-                })
-    except Exception as e:
-        pass
-
-    # --------------------- FLATPAK ---------------------
-    try:
-        flatpak_output = subprocess.check_output(
-            ['flatpak', 'list', '--columns=application,version,installation'],
-            stderr=subprocess.DEVNULL
-        ).decode().strip().split('\n')
-
-        for line in flatpak_output:
-            if '\t' in line:
-                parts = line.split('\t')
-                if len(parts) >= 2:
-                    app_id = parts[0]
-                    version = parts[1] or "Unknown"
-                    software_list.append({
-                        "Name": app_id,
-                        "Version": version,
-                        "Identifier": app_id,
-                        "InstallDate": "NULL"
-                    })
-    except Exception as e:
-        pass
-
-    return software_list
+    return packages
 
 
 
 def run_dmidecode(keyword):
     try:
-        output = subprocess.check_output(['dmidecode', '-t', keyword], text=True, stderr=subprocess.DEVNULL)
+        output = command_output(['dmidecode', '-t', keyword], text=True, stderr=subprocess.DEVNULL)
         return output
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, FileNotFoundError):
         return ''
     except PermissionError:
         return 'Permission denied (requires sudo)'
 
+def read_dmi_id(name):
+    # /sys/class/dmi/id expõe os mesmos valores do dmidecode sem criar processos
+    try:
+        with open(os.path.join(DMI_ID_DIR, name), 'r') as f:
+            value = f.read().strip()
+        return value or None
+    except OSError:
+        return None
+
+def dmi_field(output, label):
+    match = re.search(rf'{label}:\s*(.+)', output)
+    return match.group(1) if match else "NULL"
+
+def read_dmi_section(fields, keyword):
+    # fields: {chave do payload: (ficheiro em /sys/class/dmi/id, etiqueta do dmidecode)}
+    # Campos sem ficheiro em sysfs só são preenchidos se o dmidecode tiver de correr
+    info = {key: read_dmi_id(sysfs_name) if sysfs_name else None
+            for key, (sysfs_name, _) in fields.items()}
+    output = ''
+    if any(info[key] is None for key, (sysfs_name, _) in fields.items() if sysfs_name):
+        # Valores inexistentes ou só legíveis como root: recorre ao dmidecode (uma vez)
+        output = run_dmidecode(keyword)
+    for key, (_, label) in fields.items():
+        if info[key] is None:
+            info[key] = dmi_field(output, label)
+    return info
+
+def collect_motherboard_info():
+    return read_dmi_section({
+        "Manufacturer": ('board_vendor', 'Manufacturer'),
+        "Model": ('board_name', 'Product Name'),
+        "SerialNumber": ('board_serial', 'Serial Number')
+    }, 'baseboard')
+
+def collect_bios_info():
+    return read_dmi_section({
+        "BIOS_Manufacturer": ('bios_vendor', 'Vendor'),
+        "BIOS_Version": ('bios_version', 'Version'),
+        "BIOS_SerialNumber": (None, 'Serial Number'),
+        "BIOS_ReleaseDate": ('bios_date', 'Release Date')
+    }, 'bios')
+
 def get_motherboard_info():
-    output = run_dmidecode('baseboard')
-    return {
-        "Manufacturer": re.search(r'Manufacturer:\s*(.+)', output).group(1) if re.search(r'Manufacturer:\s*(.+)', output) else "NULL",
-        "Model": re.search(r'Product Name:\s*(.+)', output).group(1) if re.search(r'Product Name:\s*(.+)', output) else "NULL",
-        "SerialNumber": re.search(r'Serial Number:\s*(.+)', output).group(1) if re.search(r'Serial Number:\s*(.+)', output) else "NULL"
-    }
+    return boot_cached('MB_Info', collect_motherboard_info)
 
 def get_bios_info():
-    output = run_dmidecode('bios')
-    return {
-        "BIOS_Manufacturer": re.search(r'Vendor:\s*(.+)', output).group(1) if re.search(r'Vendor:\s*(.+)', output) else "NULL",
-        "BIOS_Version": re.search(r'Version:\s*(.+)', output).group(1) if re.search(r'Version:\s*(.+)', output) else "NULL",
-        "BIOS_SerialNumber": re.search(r'Serial Number:\s*(.+)', output).group(1) if re.search(r'Serial Number:\s*(.+)', output) else "NULL",
-        "BIOS_ReleaseDate": re.search(r'Release Date:\s*(.+)', output).group(1) if re.search(r'Release Date:\s*(.+)', output) else "NULL"
-    }
+    return boot_cached('Bios_Info', collect_bios_info)
 
 def get_os_info():
     try:
@@ -465,152 +1640,328 @@ def get_os_info():
             "OS_ID": "NULL"
         }
 
-def get_bios_last_upgrade_date():
+def collect_bios_last_upgrade_date():
     try:
-        output = subprocess.check_output(['stat', '/sys/class/dmi/id/bios_date'], text=True)
-        match = re.search(r'Modify:\s(.+)', output)
-        if match:
-            return match.group(1)
-    except:
+        # Mesmo formato da linha "Modify:" do comando stat
+        mtime_ns = os.stat(os.path.join(DMI_ID_DIR, 'bios_date')).st_mtime_ns
+        modified = datetime.fromtimestamp(mtime_ns // 1_000_000_000).astimezone()
+        return f"{modified:%Y-%m-%d %H:%M:%S}.{mtime_ns % 1_000_000_000:09d} {modified:%z}"
+    except OSError:
         pass
     return "Unknown"
 
+def get_bios_last_upgrade_date():
+    return boot_cached('BiosUpgrade', collect_bios_last_upgrade_date)
 
-import subprocess
-import re
 
-def get_pending_updates():
+APT_LISTS_DIR = '/var/lib/apt/lists'
+APT_SHOW_BATCH = 200  # pacotes por invocação de apt-cache show
+
+def apt_lists_fingerprint():
+    # Muda sempre que um apt update altera as listas de pacotes
+    entries = []
+    try:
+        with os.scandir(APT_LISTS_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('_Packages') or entry.name.endswith('Release'):
+                    st = entry.stat()
+                    entries.append(f"{entry.name}:{st.st_mtime_ns}:{st.st_size}")
+    except OSError:
+        return None
+    entries.sort()
+    return hashlib.sha256('\n'.join(entries).encode()).hexdigest()
+
+def parse_apt_show(output):
+    # Devolve {(pacote, versão): {...}} + {pacote: primeira entrada}
+    by_version = {}
+    first = {}
+    for stanza in output.split('\n\n'):
+        fields = {}
+        for line in stanza.splitlines():
+            if not line or line[0] in ' \t' or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            fields.setdefault(key, value.strip())
+
+        name = fields.get('Package')
+        if not name:
+            continue
+        meta = {
+            "Origin": fields.get('Origin'),
+            "Date": fields.get('Date'),
+            "Description": fields.get('Description') or fields.get('Description-en')
+        }
+        by_version.setdefault((name, fields.get('Version')), meta)
+        first.setdefault(name, meta)
+    return by_version, first
+
+def get_package_metadata(packages):
+    # packages: lista de (nome, versão candidata).
+    # Cache em disco chaveada por nome=versão, invalidada quando as listas do apt mudam.
+    fingerprint = apt_lists_fingerprint()
+    cache = load_state('apt_metadata.json', {})
+    if not isinstance(cache, dict) or cache.get('Fingerprint') != fingerprint:
+        cache = {'Fingerprint': fingerprint, 'Packages': {}}
+    cached = cache['Packages']
+
+    missing = sorted({name for name, version in packages if f"{name}={version}" not in cached})
+    for i in range(0, len(missing), APT_SHOW_BATCH):
+        batch = missing[i:i + APT_SHOW_BATCH]
+        try:
+            # Uma única invocação por lote; pacotes desconhecidos não anulam os restantes
+            result = run_command(
+                ['apt-cache', 'show'] + batch,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+            )
+        except Exception:
+            break
+        by_version, first = parse_apt_show(result.stdout)
+        batch_names = set(batch)
+        for name, version in packages:
+            if name in batch_names:
+                meta = by_version.get((name, version)) or first.get(name)
+                cached[f"{name}={version}"] = meta or {}
+
+    wanted = {f"{name}={version}" for name, version in packages}
+    cache['Packages'] = {k: v for k, v in cached.items() if k in wanted}
+    if missing:
+        save_state('apt_metadata.json', cache)
+    return cache['Packages']
+
+def get_apt_updates():
     updates = []
+    output = command_output(
+        ['apt', 'list', '--upgradeable'],
+        stderr=subprocess.DEVNULL
+    ).decode().splitlines()
+
+    pending = []
+    for line in output:
+        if not line or '/' not in line or line.startswith("Listing..."):
+            continue
 
+        # Exemplo:
+        # bash/jammy 5.1-6ubuntu1.1 amd64 [upgradable from: 5.1-6ubuntu1]
+        parts = line.split()
+        if len(parts) < 4:
+            continue
+
+        name = parts[0].split('/')[0]
+        new_version = parts[1]
+        architecture = parts[2]
+        installed_version = None
+
+        match = re.search(r'\[upgradable from: (.+)\]', line)
+        if match:
+            installed_version = match.group(1)
+
+        pending.append((name, new_version, architecture, installed_version))
+
+    metadata = get_package_metadata([(name, new_version) for name, new_version, _, _ in pending])
+
+    for name, new_version, architecture, installed_version in pending:
+        meta = metadata.get(f"{name}={new_version}") or {}
+        updates.append({
+            "Name": name,
+            "InstalledVersion": installed_version or "NULL",
+            "NewVersion": new_version,
+            "Architecture": architecture,
+            "Origin": meta.get("Origin") or "NULL",
+            "ReleaseDate": meta.get("Date") or "NULL",
+            "Description": meta.get("Description") or "NULL",
+            "Source": "apt"
+        })
+
+    return updates
+
+
+GUI_FILES = {
+    "iwebit_gui.py": "https://raw.githubusercontent.com/RDFonseca82/iWebITAgent_Linux/main/iwebit_gui.py",
+    "assets/iwebit_online.png": "https://intranet.iwebit.app/winsrv/iwebit_online.png",
+    "assets/iwebit_offline.png": "https://intranet.iwebit.app/winsrv/iwebit_offline.png",
+    "assets/iwebit_inactive.png": "https://intranet.iwebit.app/winsrv/iwebit_inactive.png"
+}
+
+def atomic_write(path, content, mode=None, expected_sha256=None):
+    # Ficheiro temporário na mesma pasta + fsync + rename: nunca fica um
+    # ficheiro a meio. Com expected_sha256 o conteúdo gravado é verificado
+    # antes de substituir o original.
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=directory)
     try:
-        output = subprocess.check_output(
-            ['apt', 'list', '--upgradeable'],
-            stderr=subprocess.DEVNULL
-        ).decode().splitlines()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        if expected_sha256 is not None and file_sha256(tmp_path) != expected_sha256:
+            raise ValueError("SHA-256 do ficheiro gravado não corresponde")
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
 
-        for line in output:
-            if not line or '/' not in line or line.startswith("Listing..."):
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def local_script_sha256(state):
+    # O digest local fica em cache enquanto o mtime/tamanho do script não mudam
+    st = os.stat(SCRIPT_PATH)
+    key = [st.st_mtime_ns, st.st_size]
+    if state.get('LocalKey') != key or not state.get('LocalSHA256'):
+        state['LocalSHA256'] = file_sha256(SCRIPT_PATH)
+        state['LocalKey'] = key
+    return state['LocalSHA256']
+
+def fetch_if_changed(url, etags):
+    # GET condicional: devolve o conteúdo novo, ou None se não mudou (304)
+    headers = {'If-None-Match': etags[url]} if etags.get(url) else {}
+    response = HTTP.get(url, headers=headers, endpoint='self_update')
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    if response.headers.get('ETag'):
+        etags[url] = response.headers['ETag']
+    return response.content
+
+def fetch_expected_sha256():
+    # SHA-256 publicado no manifesto, ou None se o servidor não o tiver
+    response = HTTP.get(UPDATE_SHA256_URL, endpoint='self_update')
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    fields = response.text.split()
+    if not fields or not re.fullmatch(r'[0-9a-fA-F]{64}', fields[0]):
+        raise ValueError("Manifesto SHA-256 inválido")
+    return fields[0].lower()
+
+def update_gui_files(etags):
+    base_path = "/opt/iwebit_agent"
+    for filename, url in GUI_FILES.items():
+        local_path = os.path.join(base_path, filename)
+        try:
+            if not os.path.exists(local_path):
+                etags.pop(url, None)
+            content = fetch_if_changed(url, etags)
+            if content is None:
                 continue
+            atomic_write(local_path, content)
+            log(f"[GUI] Atualizado: {filename}")
+        except Exception as e:
+            log(f"[GUI] Falha ao atualizar {filename}: {e}", level='WARNING')
 
-            # Exemplo:
-            # bash/jammy 5.1-6ubuntu1.1 amd64 [upgradable from: 5.1-6ubuntu1]
-            parts = line.split()
-            if len(parts) < 4:
-                continue
+def check_for_updates():
+    state = load_state('self_update.json', {})
+    if not isinstance(state, dict):
+        state = {}
+    etags = state.setdefault('ETags', {})
 
-            name = parts[0].split('/')[0]
-            new_version = parts[1]
-            architecture = parts[2]
-            installed_version = None
-            origin = None
-            release_date = None
-            description = None
+    try:
+        # O ETag só é válido enquanto o script local for o que lhe corresponde
+        # (ETagSHA256); se foi editado ou reposto, faz-se o download completo
+        local_sha256 = local_script_sha256(state)
+        if state.get('ETagSHA256') != local_sha256:
+            etags.pop(UPDATE_URL, None)
+
+        # Buscar script remoto apenas se mudou (ETag); normalmente é um 304 sem corpo
+        remote = fetch_if_changed(UPDATE_URL, etags)
+        if remote is None:
+            return
 
-            match = re.search(r'\[upgradable from: (.+)\]', line)
-            if match:
-                installed_version = match.group(1)
+        remote_sha256 = hashlib.sha256(remote).hexdigest()
+        if remote_sha256 == local_sha256:
+            state['ETagSHA256'] = local_sha256
+            return
 
-            try:
-                apt_show = subprocess.check_output(
-                    ['apt-cache', 'show', name],
-                    stderr=subprocess.DEVNULL
-                ).decode()
+        # O digest esperado vem do manifesto, não do próprio download: um script
+        # truncado ou alterado não corresponde. Sem manifesto só há a verificação
+        # de sintaxe, que apanha a maioria dos downloads truncados.
+        expected_sha256 = fetch_expected_sha256()
+        if expected_sha256 is None:
+            log("Manifesto SHA-256 não publicado; atualização sem verificação de integridade.",
+                level='WARNING')
+        elif expected_sha256 != remote_sha256:
+            raise ValueError("SHA-256 do script descarregado não corresponde ao manifesto")
+        compile(remote, SCRIPT_PATH, 'exec')
+
+        # O execv termina o processo: com scripts remotos em curso adia-se para a
+        # próxima verificação em vez de esperar, porque esta tarefa tem os grupos
+        # 'sync' e 'commands' e bloquearia os syncs e os comandos remotos. Enquanto
+        # corre nenhum script novo é lançado (o grupo 'commands' está ocupado).
+        if scripts_running():
+            etags.pop(UPDATE_URL, None)
+            log("Scripts remotos ainda em execução; atualização adiada.", level='WARNING')
+            return
 
-                origin_match = re.search(r'^Origin:\s*(.+)', apt_show, re.MULTILINE)
-                date_match = re.search(r'^Date:\s*(.+)', apt_show, re.MULTILINE)
-                desc_match = re.search(r'^Description(?:-en)?:\s*(.+)', apt_show, re.MULTILINE)
+        log(f"Update disponível {VERSION}. A atualizar...")
 
-                origin = origin_match.group(1) if origin_match else None
-                release_date = date_match.group(1) if date_match else None
-                description = desc_match.group(1) if desc_match else None
+        # Atualizar script principal
+        atomic_write(SCRIPT_PATH, remote, mode=0o755, expected_sha256=remote_sha256)
+        state['LocalSHA256'] = remote_sha256
+        state['ETagSHA256'] = remote_sha256
+        state.pop('LocalKey', None)
+        log("Script principal atualizado.")
 
-            except:
-                pass
+        # Verificar se ambiente gráfico está presente
+        is_graphical = os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
 
-            updates.append({
-                "Name": name,
-                "InstalledVersion": installed_version or "NULL",
-                "NewVersion": new_version,
-                "Architecture": architecture,
-                "Origin": origin or "NULL",
-                "ReleaseDate": release_date or "NULL",
-                "Description": description or "NULL"
-            })
-
-    except Exception as e:
-        updates.append({"Error": str(e)})
+        if is_graphical:
+            log("Ambiente desktop detetado. A verificar GUI...")
+            update_gui_files(etags)
 
-    return updates
+        save_state('self_update.json', state)
 
-    
-def check_for_updates():
-    try:
-        # Buscar script remoto
-        remote = requests.get(UPDATE_URL, timeout=10).text
-        with open(SCRIPT_PATH, 'r') as f:
-            local = f.read()
-
-        if remote.strip() != local.strip():
-            log(f"Update disponível {VERSION}. A atualizar...")
-
-            # Atualizar script principal
-            with open(SCRIPT_PATH, 'w') as f:
-                f.write(remote)
-            os.chmod(SCRIPT_PATH, 0o755)
-            log("Script principal atualizado.")
-
-            # Verificar se ambiente gráfico está presente
-            is_graphical = os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
-
-            if is_graphical:
-                log("Ambiente desktop detetado. A verificar GUI...")
-                # URLs dos componentes GUI
-                gui_files = {
-                    "iwebit_gui.py": "https://raw.githubusercontent.com/RDFonseca82/iWebITAgent_Linux/main/iwebit_gui.py",
-                    "assets/iwebit_online.png": "https://intranet.iwebit.app/winsrv/iwebit_online.png",
-                    "assets/iwebit_offline.png": "https://intranet.iwebit.app/winsrv/iwebit_offline.png",
-                    "assets/iwebit_inactive.png": "https://intranet.iwebit.app/winsrv/iwebit_inactive.png"
-                }
+        # Confirma o script instalado antes de reiniciar
+        if file_sha256(SCRIPT_PATH) != remote_sha256:
+            log("Script instalado não corresponde ao descarregado; reinício cancelado.")
+            return
 
-                base_path = "/opt/iwebit_agent"
-                for filename, url in gui_files.items():
-                    local_path = os.path.join(base_path, filename)
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    try:
-                        content = requests.get(url, timeout=10).content
-                        with open(local_path, "wb") as f:
-                            f.write(content)
-                        log(f"[GUI] Atualizado: {filename}")
-                    except Exception as e:
-                        log(f"[GUI] Falha ao atualizar {filename}: {e}")
-
-            # Reiniciar o agente com novo script
-            log("A reiniciar o agente...")
-            os.execv("/usr/bin/python3", ['python3', SCRIPT_PATH])
+        # Reiniciar o agente com novo script
+        log("A reiniciar o agente...")
+        flush_log()
+        os.execv("/usr/bin/python3", ['python3', SCRIPT_PATH])
 
     except Exception as e:
-        log(f"Falha na verificação de atualizações: {e}")
+        # Sem ETag a próxima verificação descarrega o script de novo
+        etags.pop(UPDATE_URL, None)
+        log(f"Falha na verificação de atualizações: {e}", level='WARNING')
+
+    finally:
+        save_state('self_update.json', state)
         
 
-def is_connected(url="https://agent.iwebit.app", timeout=5):
+def is_connected(url=None, timeout=5):
+    url = url or SERVER_URL
     try:
-        response = requests.head(url, timeout=timeout, allow_redirects=True)
+        response = HTTP.head(url, timeout=timeout, allow_redirects=True)
         return response.status_code < 500
     except requests.RequestException as e:
-        log(f"Erro ao verificar conexão: {e}")
+        log(f"Erro ao verificar conexão: {e}", level='ERROR')
         return False
 
 
 def check_and_run_remote_scripts():
-    config = load_config()
-    uniqueid = config.get('UniqueId', '0')
-    script_dir = '/opt/iwebit_agent/scripts'
-    os.makedirs(script_dir, exist_ok=True)
+    uniqueid = CONFIG.get('UniqueId')
 
     try:
         # Passo 1: Verifica se há script para executar
-        check_url = f'https://agent.iwebit.app/scripts/script_api.php?UniqueID={uniqueid}&ScriptRun=1'
-        response = requests.get(check_url, timeout=10)
+        check_url = f'{SCRIPT_API_URL}?UniqueID={uniqueid}&ScriptRun=1'
+        response = HTTP.get(check_url, endpoint='script_api:ScriptRun')
 
         # Verifica se a resposta é válida e em JSON
         try:
@@ -619,125 +1970,1024 @@ def check_and_run_remote_scripts():
             log("Nenhum script para executar.")
             return
 
+        handle_remote_script(data, uniqueid)
+
+    except Exception as e:
+        log(f"Erro ao processar script remoto: {e}", level='ERROR')
+
+SCRIPT_DIR = '/opt/iwebit_agent/scripts'
+SCRIPT_TIMEOUT = 60               # segundos
+SCRIPT_CONCURRENCY = 2            # scripts em simultâneo
+SCRIPT_OUTPUT_HEAD = 32 * 1024    # bytes guardados do início da saída
+SCRIPT_OUTPUT_TAIL = 32 * 1024    # bytes guardados do fim da saída
+SCRIPT_UPLOAD_CHUNK = 16 * 1024   # tamanho de cada parte enviada por POST
+register_config('ScriptConcurrency', int, SCRIPT_CONCURRENCY, 1, 16)
+register_config('ScriptTimeout', int, SCRIPT_TIMEOUT, 1)
+
+class BoundedOutput:
+    # Guarda o início e o fim da saída de um processo com memória limitada;
+    # o meio é descartado e contado
+    def __init__(self, head=SCRIPT_OUTPUT_HEAD, tail=SCRIPT_OUTPUT_TAIL):
+        self.head_size = head
+        self.tail_size = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            if len(self.tail) > self.tail_size:
+                del self.tail[:len(self.tail) - self.tail_size]
+
+    def text(self):
+        dropped = self.total - len(self.head) - len(self.tail)
+        output = self.head.decode(errors='ignore')
+        if dropped > 0:
+            output += f"\n... [truncado {dropped} bytes] ...\n"
+        return (output + self.tail.decode(errors='ignore')).strip()
+
+_script_pool = None
+_script_pool_lock = threading.Lock()
+
+def get_script_pool(size):
+    # Se ScriptConcurrency mudar, os scripts em curso terminam no pool antigo
+    global _script_pool
+    with _script_pool_lock:
+        if _script_pool is not None and _script_pool._max_workers != size:
+            _script_pool.shutdown(wait=False)
+            _script_pool = None
+        if _script_pool is None:
+            _script_pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='script')
+        return _script_pool
+
+# Scripts em fila ou a correr: URL -> Future. Um script ainda em curso que
+# volte a ser devolvido pelo servidor (long-poll, pedidos antigos) não é repetido.
+_running_scripts = {}
+_running_scripts_lock = threading.Lock()
+
+def script_finished(script_url):
+    with _running_scripts_lock:
+        _running_scripts.pop(script_url, None)
+
+def handle_remote_script(data, uniqueid):
+    # Aceita um script {"URL": ...} ou uma lista de scripts; cada um corre num
+    # worker próprio, fora do ciclo principal
+    scripts = data if isinstance(data, list) else [data]
+    pool = get_script_pool(CONFIG.get('ScriptConcurrency'))
+    timeout = CONFIG.get('ScriptTimeout')
+
+    queued = 0
+    for script in scripts:
         # Se não houver campo URL ou estiver vazio
-        if not isinstance(data, dict) or 'URL' not in data or not data['URL']:
-            log("Nenhum script remoto para executar.")
-            return
+        if not isinstance(script, dict) or not script.get('URL'):
+            continue
+        script_url = script['URL']
+        with _running_scripts_lock:
+            if script_url in _running_scripts:
+                log(f"Script já em execução, ignorado: {script_url}")
+                continue
+            future = pool.submit(run_remote_script, script_url, uniqueid, timeout)
+            _running_scripts[script_url] = future
+        future.add_done_callback(lambda _, url=script_url: script_finished(url))
+        queued += 1
+
+    if not queued:
+        log("Nenhum script remoto para executar.")
+
+def scripts_running():
+    with _running_scripts_lock:
+        return bool(_running_scripts)
+
+def wait_for_scripts():
+    # Espera pelos scripts em fila/em curso (ex.: antes de um reboot), no máximo
+    # ScriptTimeout por cada "vaga" de ScriptConcurrency scripts, mais o download/envio
+    with _running_scripts_lock:
+        futures = list(_running_scripts.values())
+    if not futures:
+        return True
+    waves = math.ceil(len(futures) / CONFIG.get('ScriptConcurrency'))
+    limit = waves * CONFIG.get('ScriptTimeout') + 2 * sum(HTTP_TIMEOUT)
+    log(f"A aguardar {len(futures)} scripts remotos (máximo {limit}s).")
+    _, not_done = wait(futures, timeout=limit)
+    return not not_done
+
+def run_remote_script(script_url, uniqueid, timeout=SCRIPT_TIMEOUT):
+    os.makedirs(SCRIPT_DIR, exist_ok=True)
+    script_path = None
 
-        script_url = data['URL']
-        script_name = os.path.basename(urllib.parse.urlparse(script_url).path)
-        script_path = os.path.join(script_dir, script_name)
+    try:
+        script_name = os.path.basename(urllib.parse.urlparse(script_url).path) or 'script'
 
-        # Passo 2: Baixar script
+        # Passo 1: Baixar script (nome único, podem correr vários em paralelo)
         log(f"Baixando script de: {script_url}")
-        script_resp = requests.get(script_url, timeout=10)
-        with open(script_path, 'w') as f:
+        script_resp = HTTP.get(script_url)
+        fd, script_path = tempfile.mkstemp(prefix='run_', suffix=f"_{script_name}", dir=SCRIPT_DIR)
+        with os.fdopen(fd, 'w') as f:
             f.write(script_resp.text)
         os.chmod(script_path, 0o755)
 
-        # Passo 3: Executar script
+        # Passo 2: Executar script com a saída lida em streaming
         log(f"Executando script: {script_path}")
-        result = subprocess.run([script_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
-        output = result.stdout.decode(errors='ignore').strip()
+        output = BoundedOutput(SCRIPT_OUTPUT_HEAD, SCRIPT_OUTPUT_TAIL)
+        started = time.monotonic()
+        proc = subprocess.Popen([script_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill():
+            # Termina o script e todos os processos que lançou
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
-        if len(output) > 3000:
-            output = output[:3000] + '... [truncado]'
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            for chunk in iter(lambda: proc.stdout.read1(4096), b''):
+                output.write(chunk)
+            proc.wait()
+        finally:
+            timer.cancel()
+            STATS.record_subprocess(time.monotonic() - started, proc.returncode != 0)
+        STATS.record_read(output.total)
+
+        text = output.text()
+        if timed_out.is_set():
+            text += f"\n... [timeout após {timeout}s]"
+
+        # Passo 3: Enviar resposta
+        log(f"Script terminado (código {proc.returncode}, {output.total} bytes de saída).")
+        upload_script_output(uniqueid, text, proc.returncode)
 
-        # Passo 4: Enviar resposta
-        return_url = f'https://agent.iwebit.app/scripts/script_api.php?UniqueID={uniqueid}&ScriptRunned=1&Output={urllib.parse.quote_plus(output)}'
-        log(f"Enviando saída do script para API. ({output})")
-        requests.get(return_url, timeout=10)
+    except Exception as e:
+        log(f"Erro ao processar script remoto: {e}", level='ERROR')
 
+    finally:
         # Remover script após execução
-        if script_path.startswith(script_dir):
+        if script_path and script_path.startswith(SCRIPT_DIR):
             try:
                 os.remove(script_path)
                 log(f"Script removido após execução: {script_path}")
             except Exception as e:
-                log(f"Erro ao remover script {script_path}: {e}")
+                log(f"Erro ao remover script {script_path}: {e}", level='ERROR')
+
+def upload_script_output(uniqueid, output, exit_code):
+    # Envia a saída por POST, em partes de SCRIPT_UPLOAD_CHUNK caracteres
+    chunks = [output[i:i + SCRIPT_UPLOAD_CHUNK] for i in range(0, len(output), SCRIPT_UPLOAD_CHUNK)] or ['']
+    run_id = hashlib.sha256(f"{uniqueid}:{time.time()}:{output[:64]}".encode()).hexdigest()[:16]
+    for index, chunk in enumerate(chunks):
+        HTTP.post(SCRIPT_API_URL, data={
+            'UniqueID': uniqueid,
+            'ScriptRunned': 1,
+            'RunId': run_id,
+            'Chunk': index,
+            'Chunks': len(chunks),
+            'ExitCode': exit_code,
+            'Output': chunk
+        }, endpoint='script_api:ScriptRunned')
+    log(f"Saída do script enviada para API ({len(chunks)} partes).")
+
+
+
+
+JSON_TOKEN = re.compile(r'[\\"{}\[\]]')
+JSON_SCALAR_END = re.compile(r'[\s,\]{\[]')
+
+def find_json_value_end(buffer, start, state):
+    # Procura o fim do valor JSON que começa em 'start', contando chavetas e
+    # parênteses fora das strings. Devolve (fim, None) quando está completo, ou
+    # (None, estado) para retomar a procura quando chegarem mais dados.
+    i, depth, in_string, escape = state
+    if buffer[start] not in '{["':
+        # Número/literal (ou lixo): termina no próximo separador
+        m = JSON_SCALAR_END.search(buffer, max(i, start + 1))
+        if m:
+            return m.start(), None
+        return None, (len(buffer), 0, False, False)
+
+    n = len(buffer)
+    if escape:
+        if i >= n:
+            return None, state
+        i += 1
+    while True:
+        m = JSON_TOKEN.search(buffer, i)
+        if m is None:
+            return None, (n, depth, in_string, False)
+        c = m.group()
+        i = m.end()
+        if in_string:
+            if c == '\\':
+                if i >= n:
+                    return None, (n, depth, True, True)
+                i += 1
+            elif c == '"':
+                in_string = False
+                if depth == 0:
+                    return i, None
+        elif c == '"':
+            in_string = True
+        elif c in '{[':
+            depth += 1
         else:
-            log(f"Caminho do script inválido, não removido: {script_path}")
+            depth -= 1
+            if depth <= 0:
+                return i, None
+
+def iter_json_objects(chunks):
+    # Decoder incremental: aceita um array JSON, NDJSON ou objetos concatenados
+    # e devolve (objeto, None) à medida que chegam, ou (None, erro) para
+    # entradas inválidas, que são ignoradas sem interromper as seguintes.
+    # Cada valor só é descodificado depois de delimitado por completo, por isso
+    # a divisão em chunks nunca parte uma entrada válida.
+    buffer = ''
+    pos = 0
+    in_array = None
+    scan = None  # (índice, profundidade, dentro de string, escape) do valor em curso
+
+    def skip(buffer, pos):
+        # Ignora espaços, vírgulas entre valores e o fecho do array
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','
+                                     or (in_array and buffer[pos] == ']')):
+            pos += 1
+        return pos
+
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            if scan is not None:
+                scan = (scan[0] - pos,) + scan[1:]
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        while True:
+            if scan is None:
+                pos = skip(buffer, pos)
+                if pos >= len(buffer):
+                    break
+                if in_array is None:
+                    in_array = buffer[pos] == '['
+                    if in_array:
+                        pos += 1
+                        continue
+                scan = (pos, 0, False, False)
+
+            end, scan = find_json_value_end(buffer, pos, scan)
+            if end is None and final and buffer[pos] not in '{[' and (buffer[pos] != '"' or not in_array):
+                # Um número/literal sem separador termina no fim do stream (ex.: "null");
+                # fora de um array, o texto solto até ao fim também
+                scan = None
+                end = len(buffer)
+            if end is None:
+                if not final:
+                    break
+                # Fim do stream com a entrada por fechar: é descartada até à
+                # linha seguinte (ou próximo objeto) e a leitura continua daí
+                scan = None
+                end = buffer.find('\n', pos)
+                if end == -1:
+                    end = buffer.find('{', pos + 1)
+                if end == -1:
+                    end = len(buffer)
+                yield None, f"Entrada incompleta: {buffer[pos:end].strip()[:200]}"
+                pos = end
+                continue
 
-    except Exception as e:
-        log(f"Erro ao processar script remoto: {e}")
+            text = buffer[pos:end]
+            pos = end
+            if not in_array and text[0] not in '{[':
+                # Fora de um array só os objetos são entradas: "null", "0" ou uma
+                # mensagem em texto simples significam que não há nada a fazer
+                continue
+            try:
+                obj = json.loads(text)
+            except json.JSONDecodeError as e:
+                yield None, f"{e.msg}: {text.strip()[:200]}"
+                continue
+            yield obj, None
 
+def read_stream_in_background(response):
+    # Lê a resposta numa thread própria, para que as atualizações já recebidas
+    # comecem a ser instaladas enquanto as restantes ainda estão a chegar
+    items = queue.Queue()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
 
+    def reader():
+        try:
+            chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size=8192))
+            for item in iter_json_objects(chunks):
+                items.put(item)
+        except Exception as e:
+            items.put((None, f"Erro ao ler resposta: {e}"))
+        finally:
+            response.close()
+            items.put(None)
 
+    threading.Thread(target=reader, name='updates-reader', daemon=True).start()
+    return iter(items.get, None)
 
 def check_and_run_updates():
-    config = load_config()
-    uniqueid = config.get('UniqueId', '0')    
-    url = f"https://agent.iwebit.app/scripts/script_api.php?UniqueID={uniqueid}&LinuxUpdatesRun=1"
+    uniqueid = CONFIG.get('UniqueId')
+    url = f"{SCRIPT_API_URL}?UniqueID={uniqueid}&LinuxUpdatesRun=1"
     try:
-        response = requests.get(url, timeout=30)
-        raw_data = response.text.strip()
-        
-        # Extrai cada bloco JSON separadamente com regex
-        json_blocks = re.findall(r'\{.*?\}', raw_data)
+        response = HTTP.get(url, stream=True, endpoint='script_api:LinuxUpdatesRun')
+        process_update_stream(read_stream_in_background(response), uniqueid)
+    except Exception as e:
+        log(f"Erro ao verificar atualizações remotas: {e}", level='ERROR')
+
+UPDATE_BATCH_SIZE = 50        # pacotes por transação apt
+UPDATE_TIMEOUT = 30 * 60      # segundos por transação
+UPDATE_TERM_GRACE = 5 * 60    # segundos após o SIGTERM antes de um SIGKILL
+register_config('UpdateBatchSize', int, UPDATE_BATCH_SIZE, 1)
+register_config('UpdateTimeout', int, UPDATE_TIMEOUT, 60)
+
+def parse_apt_upgrade_output(output):
+    # Resultado por pacote a partir da saída do apt-get/dpkg
+    upgraded = set(re.findall(r'^Setting up ([^\s:]+)(?::\S+)? ', output, re.MULTILINE))
+    newest = set(re.findall(r'^([^\s:]+)(?::\S+)? is already the newest version', output, re.MULTILINE))
+    skipped = set(re.findall(r'^Skipping ([^\s:,]+)(?::\S+)?, it is not installed', output, re.MULTILINE))
+    unknown = set(re.findall(r'^E: Unable to locate package (\S+)', output, re.MULTILINE))
+    return upgraded, newest, skipped, unknown
+
+def dpkg_running():
+    # dpkg em execução (tem o lock da base de dados): não pode ser morto a meio
+    try:
+        entries = os.listdir(PROC_DIR)
+    except OSError:
+        return False
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIR, entry, 'comm')) as f:
+                if f.read().strip() == 'dpkg':
+                    return True
+        except OSError:
+            continue
+    return False
 
-        if not json_blocks:
-            log("Nenhuma atualização Linux remota encontrada.")
-            return
+def dpkg_package_states():
+    # {pacote: ((versão, estado), ...)} a partir do dpkg/status (várias arquiteturas)
+    states = {}
+    for pkg in parse_dpkg_status(DPKG_STATUS_FILE):
+        states.setdefault(pkg['Name'], []).append((pkg['Version'], pkg['Status']))
+    return {name: tuple(sorted(values)) for name, values in states.items()}
+
+def run_apt_transaction(args, timeout, env):
+    # Como run_command, mas o timeout não mata o apt-get a meio do dpkg: envia
+    # SIGTERM, espera UPDATE_TERM_GRACE e só usa SIGKILL se o dpkg já não corre.
+    # Devolve (código, saída, interrompido).
+    started = time.monotonic()
+    error = True
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env,
+                            start_new_session=True)
+    try:
+        try:
+            output, _ = proc.communicate(timeout=timeout)
+            error = proc.returncode != 0
+            return proc.returncode, output, False
+        except subprocess.TimeoutExpired:
+            pass
 
-        log(f"{len(json_blocks)} atualizações remotas encontradas.")
-        
-        for block in json_blocks:
+        log(f"Timeout da transação apt ({timeout}s): a enviar SIGTERM.", level='WARNING')
+        proc.terminate()
+        deadline = time.monotonic() + UPDATE_TERM_GRACE
+        waiting_logged = False
+        while True:
             try:
-                update = json.loads(block)
-                package = update.get("LinuxUpdateID")
-                new_version = update.get("NewVersion")
-                update_id = update.get("IdLinuxUpdateRun")
+                output, _ = proc.communicate(timeout=5)
+                break
+            except subprocess.TimeoutExpired:
+                if time.monotonic() < deadline:
+                    continue
+                if dpkg_running():
+                    if not waiting_logged:
+                        log("dpkg ainda em execução; a aguardar que termine antes de parar o apt-get.",
+                            level='WARNING')
+                        waiting_logged = True
+                    continue
+                # Sem dpkg a correr, o grupo inteiro (apt-get e métodos de download,
+                # que mantêm a saída aberta) pode ser morto
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        return proc.returncode, output or '', True
+    finally:
+        STATS.record_subprocess(time.monotonic() - started, error)
+
+def run_apt_upgrade(packages, timeout=UPDATE_TIMEOUT):
+    # Atualiza todos os pacotes numa só transação; devolve {pacote: estado}.
+    # Pacotes desconhecidos abortam a transação inteira: são marcados como
+    # falhados e a transação repete-se sem eles.
+    statuses = {}
+    pending = list(packages)
+    # As mensagens do apt/dpkg são interpretadas em inglês: força o locale C
+    env = dict(os.environ, DEBIAN_FRONTEND='noninteractive',
+               LC_ALL='C', LANG='C', LANGUAGE='C')
+
+    while pending:
+        try:
+            before = dpkg_package_states()
+        except OSError:
+            before = None
+        try:
+            returncode, output, interrupted = run_apt_transaction(
+                ["apt-get", "install", "--only-upgrade", "-y"] + pending, timeout, env
+            )
+        except FileNotFoundError:
+            log("Comando apt-get não disponível no sistema.")
+            statuses.update({pkg: "Indisponivel" for pkg in pending})
+            break
+
+        if interrupted:
+            log(f"Transação apt interrompida ({len(pending)} pacotes).", level='WARNING')
+            statuses.update(reconcile_apt_statuses(pending, before))
+            break
+
+        upgraded, newest, skipped, unknown = parse_apt_upgrade_output(output)
+        unknown &= set(pending)
+        if returncode != 0 and unknown:
+            statuses.update({pkg: "Falhou" for pkg in unknown})
+            pending = [pkg for pkg in pending if pkg not in unknown]
+            continue
+
+        for pkg in pending:
+            if pkg in skipped:
+                statuses[pkg] = "Falhou"
+            elif pkg in upgraded or pkg in newest or returncode == 0:
+                statuses[pkg] = "Sucesso"
+            else:
+                statuses[pkg] = "Falhou"
+        if returncode != 0:
+            log(f"Falha na transação apt: {output.strip()[-500:]}", level='WARNING')
+            if 'dpkg --configure -a' in output:
+                log("dpkg interrompido: é necessário executar 'dpkg --configure -a'.", level='ERROR')
+        break
+
+    return statuses
+
+def reconcile_apt_statuses(packages, before):
+    # Depois de uma transação interrompida, o estado de cada pacote vem do
+    # dpkg/status: atualizado se a versão mudou e ficou instalado por completo
+    try:
+        after = dpkg_package_states()
+    except OSError:
+        after = None
+    if before is None or after is None:
+        return {pkg: "Falhou" for pkg in packages}
+
+    statuses = {}
+    half_installed = []
+    for pkg in packages:
+        states = after.get(pkg, ())
+        if any(not status.endswith(' installed') for _, status in states):
+            half_installed.append(pkg)
+            statuses[pkg] = "Falhou"
+        elif states and states != before.get(pkg, ()):
+            statuses[pkg] = "Sucesso"
+        else:
+            statuses[pkg] = "Falhou"
+    if half_installed:
+        log(f"Pacotes por configurar após a interrupção ({' '.join(half_installed)}): "
+            f"é necessário executar 'dpkg --configure -a'.", level='ERROR')
+    return statuses
+
+def handle_remote_updates(updates, uniqueid):
+    process_update_stream(((update, None) for update in updates), uniqueid)
+
+def process_update_stream(items, uniqueid):
+    # items: (atualização, erro). Cada lote de UpdateBatchSize pacotes é
+    # instalado logo que fica completo; entradas inválidas são reportadas.
+    batch_size = CONFIG.get('UpdateBatchSize')
+    timeout = CONFIG.get('UpdateTimeout')
+
+    requested = []
+    results = []
+    statuses = {}
+    batch = []
+
+    def run_batch():
+        log(f"Iniciando atualização de {len(batch)} pacotes: {' '.join(batch)}")
+        statuses.update(run_apt_upgrade(list(batch), timeout))
+        batch.clear()
+
+    for update, error in items:
+        if error is None and update is None:
+            continue
+        if error is None and not (isinstance(update, dict) and update.get("LinuxUpdateID")):
+            error = f"Entrada sem LinuxUpdateID: {json.dumps(update)[:200]}"
+        if error is not None:
+            log(f"Entrada de atualização inválida: {error}", level='WARNING')
+            results.append({"LinuxUpdateID": None, "Output": "Invalido", "Error": error})
+            continue
 
-                log(f"Iniciando atualização do pacote '{package}' para versão '{new_version}'")
+        requested.append(update)
+        package = update["LinuxUpdateID"]
+        if package not in statuses and package not in batch:
+            batch.append(package)
+            if len(batch) >= batch_size:
+                run_batch()
 
-                # Tenta atualizar o pacote
-                try:
-                    result = subprocess.run(
-                        ["apt-get", "install", "--only-upgrade", "-y", package],
-                        capture_output=True, text=True
-                    )
-                    if result.returncode == 0:
-                        status = "Sucesso"
-                        log(f"Atualização de '{package}' concluída com sucesso.")
-                    else:
-                        status = "Falhou"
-                        log(f"Falha ao atualizar '{package}': {result.stderr.strip()}")
-                except FileNotFoundError:
-                    status = "Indisponivel"
-                    log(f"Comando apt-get não disponível no sistema.")
-                
-                # Enviar resultado
-                encoded_output = urllib.parse.quote_plus(status)
-                response_url = (
-                    f"https://agent.iwebit.app/scripts/script_api.php?"
-                    f"UniqueID={uniqueid}&LinuxUpdateID={package}"
-                    f"&NewVersion={urllib.parse.quote_plus(new_version)}"
-                    f"&LinuxUpdatesRunned=1&Output={encoded_output}"
-                )
-                log(f"Enviando status '{status}' para API.")
-                requests.get(response_url, timeout=20)
+    if batch:
+        run_batch()
 
-            except Exception as e:
-                log(f"Erro ao processar bloco de atualização: {e}")
-    except Exception as e:
-        log(f"Erro ao verificar atualizações remotas: {e}")
+    if not requested and not results:
+        log("Nenhuma atualização Linux remota encontrada.")
+        return
+    log(f"{len(requested)} atualizações remotas processadas.")
+
+    for update in requested:
+        package = update["LinuxUpdateID"]
+        status = statuses.get(package, "Falhou")
+        log(f"Atualização de '{package}': {status}")
+        results.append({
+            "LinuxUpdateID": package,
+            "NewVersion": update.get("NewVersion") or "",
+            "IdLinuxUpdateRun": update.get("IdLinuxUpdateRun"),
+            "Output": status
+        })
 
+    report_update_results(uniqueid, results)
 
-def get_linux_errors_warnings(max_events=50):
+def report_update_results(uniqueid, results):
+    # Todos os resultados num único pedido
     try:
-        cmd = [
-            "journalctl",
-            "--no-pager",
-            "-p", "3..4",
-            "-n", str(max_events),
-            "-o", "short-iso"
-        ]
+        HTTP.post(SCRIPT_API_URL, params={'UniqueID': uniqueid, 'LinuxUpdatesRunned': 1, 'Bulk': 1},
+                  json={'UniqueID': uniqueid, 'Results': results},
+                  endpoint='script_api:LinuxUpdatesRunned')
+        log(f"Enviados {len(results)} estados de atualização para API.")
+    except Exception as e:
+        log(f"Erro ao enviar estados de atualização: {e}", level='ERROR')
+
+
+# =================== PACKAGE BACKENDS ===================
+# Cada gestor de pacotes é um backend: deteção, inventário e atualizações pendentes.
+# Os backends presentes correm em paralelo e cada resultado fica em cache enquanto
+# a base de dados do gestor (mtime/tamanho) não muda.
+RPMDB_DIRS = ('/var/lib/rpm', '/usr/lib/sysimage/rpm')
+DNF_CACHE_DIRS = {'dnf': ('/var/cache/libdnf5', '/var/cache/dnf'), 'yum': ('/var/cache/yum',)}
+PACMAN_DB_DIR = '/var/lib/pacman'
+SNAPD_STATE_FILE = '/var/lib/snapd/state.json'
+FLATPAK_CHANGED_FILES = ('/var/lib/flatpak/.changed', os.path.expanduser('~/.local/share/flatpak/.changed'))
+
+# Tags e tipos do cabeçalho RPM (rpmtag.h)
+RPM_TAGS = {
+    1000: 'Name', 1001: 'Version', 1002: 'Release', 1003: 'Epoch',
+    1008: 'InstallTime', 1009: 'Size', 1022: 'Arch', 5009: 'LongSize'
+}
+RPM_INT32, RPM_INT64, RPM_STRING, RPM_STRING_ARRAY, RPM_I18NSTRING = 4, 5, 6, 8, 9
+RPM_QUERY_FORMAT = '%{NAME}\t%{EPOCHNUM}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\t%{INSTALLTIME}\t%{SIZE}\n'
+
+def read_snap_packages():
+    # O snapd reescreve o state.json sempre que um snap é instalado/removido
+    if os.path.exists(SNAPD_STATE_FILE):
+        return cached_file_parse((SNAPD_STATE_FILE,), list_snap_packages)
+    return list_snap_packages()
+
+def read_flatpak_packages():
+    # O flatpak toca em .changed a cada instalação/remoção (sistema e utilizador)
+    if os.path.exists(FLATPAK_CHANGED_FILES[0]):
+        return cached_file_parse(FLATPAK_CHANGED_FILES, list_flatpak_packages)
+    return list_flatpak_packages()
+
+def read_apt_updates():
+    if not shutil.which('apt'):
+        return []
+    # A lista muda com um apt update (listas) ou com a instalação de pacotes (status)
+    if os.path.isdir(APT_LISTS_DIR):
+        return cached_file_parse((APT_LISTS_DIR, DPKG_STATUS_FILE), get_apt_updates)
+    return get_apt_updates()
+
+def parse_rpm_header(blob):
+    # Cabeçalho tal como guardado no rpmdb (big-endian): nº de entradas, tamanho
+    # dos dados, entradas de 16 bytes (tag, tipo, offset, count) e a zona de dados
+    count, data_length = struct.unpack_from('>II', blob)
+    data_start = 8 + count * 16
+    data_end = data_start + data_length
+    if data_end > len(blob):
+        raise ValueError("Cabeçalho RPM truncado")
+
+    header = {}
+    for i in range(count):
+        tag, kind, offset, _ = struct.unpack_from('>iIiI', blob, 8 + i * 16)
+        field = RPM_TAGS.get(tag)
+        if field is None or not 0 <= offset < data_length:
+            continue
+        pos = data_start + offset
+        if kind in (RPM_STRING, RPM_STRING_ARRAY, RPM_I18NSTRING):
+            # Arrays e traduções: fica o primeiro valor (locale C)
+            end = blob.find(b'\0', pos, data_end)
+            header[field] = blob[pos:end if end >= 0 else data_end].decode('utf-8', errors='replace')
+        elif kind == RPM_INT32:
+            header[field] = struct.unpack_from('>I', blob, pos)[0]
+        elif kind == RPM_INT64:
+            header[field] = struct.unpack_from('>Q', blob, pos)[0]
+    return header
+
+def rpm_package_entry(header):
+    name = header.get('Name')
+    version = header.get('Version')
+    if not name or not version:
+        return None
+    evr = f"{version}-{header['Release']}" if header.get('Release') else version
+    if header.get('Epoch'):
+        evr = f"{header['Epoch']}:{evr}"
+    arch = header.get('Arch')
+    size = header.get('LongSize', header.get('Size'))
+    installed = header.get('InstallTime')
+    return {
+        "Name": name,
+        "Version": evr,
+        # name.arch: pacotes multilib (ex.: glibc.i686 e glibc.x86_64) ficam distintos
+        "Identifier": f"{name}.{arch}" if arch else f"{name}-{evr}",
+        "InstallDate": datetime.fromtimestamp(installed).strftime('%Y-%m-%d %H:%M:%S') if installed else "NULL",
+        "Source": "rpm",
+        "InstalledSize": size // 1024 if isinstance(size, int) else "NULL",  # KiB
+        "Architecture": arch or "NULL",
+        "Status": "installed"
+    }
+
+def parse_rpmdb_sqlite(path):
+    # Leitura direta do rpmdb.sqlite, só de leitura: sem lançar rpm/dnf
+    packages = []
+    conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True, timeout=10)
+    try:
+        for (blob,) in conn.execute("SELECT blob FROM Packages ORDER BY hnum"):
+            try:
+                entry = rpm_package_entry(parse_rpm_header(bytes(blob)))
+            except (ValueError, struct.error):
+                continue
+            if entry:
+                packages.append(entry)
+    finally:
+        conn.close()
+    return packages
+
+def query_rpm_packages():
+    # rpmdb em BerkeleyDB/ndb (RHEL 7/8, SUSE): uma única invocação do rpm
+    output = command_output(['rpm', '-qa', '--queryformat', RPM_QUERY_FORMAT],
+                            stderr=subprocess.DEVNULL, text=True)
+    packages = []
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) != 7:
+            continue
+        name, epoch, version, release, arch, installed, size = parts
+        entry = rpm_package_entry({
+            'Name': name,
+            'Epoch': int(epoch) if epoch.isdigit() else 0,
+            'Version': version,
+            'Release': release,
+            'Arch': None if arch == '(none)' else arch,
+            'InstallTime': int(installed) if installed.isdigit() else None,
+            'Size': int(size) if size.isdigit() else None
+        })
+        if entry:
+            packages.append(entry)
+    return packages
+
+def find_rpmdb():
+    # Devolve (caminho, é_sqlite); rpmdb.sqlite existe desde o Fedora 33 / RHEL 9
+    for directory in RPMDB_DIRS:
+        path = os.path.join(directory, 'rpmdb.sqlite')
+        if os.path.exists(path):
+            return path, True
+    for directory in RPMDB_DIRS:
+        for name in ('Packages', 'Packages.db'):
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                return path, False
+    return None, False
+
+def read_rpm_packages():
+    path, is_sqlite = find_rpmdb()
+    if path is None:
+        return []
+    if is_sqlite:
+        # Em modo WAL as alterações recentes ainda podem estar só no -wal
+        return cached_file_parse((path, path + '-wal'), parse_rpmdb_sqlite, path)
+    return cached_file_parse((path,), query_rpm_packages)
+
+# Metadata de cada repositório dentro da cache: dnf4 (<repo>/repodata + <repo>.solv),
+# libdnf5 (<repo>/repodata + <repo>/solv/) e yum (<arch>/<versão>/<repo>/repomd.xml)
+DNF_METADATA_PATTERNS = ('*/repodata/repomd.xml', '*.solv', '*/solv/*.solv', '*/*/*/repomd.xml')
+
+def dnf_metadata_files(cache_dir):
+    # O makecache atualiza estes ficheiros dentro das pastas dos repositórios,
+    # sem alterar o mtime da pasta da cache
+    base = glob.escape(cache_dir)
+    return sorted({path for pattern in DNF_METADATA_PATTERNS for path in glob.glob(os.path.join(base, pattern))})
+
+def find_dnf():
+    # Devolve (comando, pasta da cache de metadata) ou (None, None)
+    for tool, cache_dirs in DNF_CACHE_DIRS.items():
+        if shutil.which(tool):
+            for cache_dir in cache_dirs:
+                if os.path.isdir(cache_dir):
+                    return tool, cache_dir
+    return None, None
+
+def get_dnf_updates():
+    # -C: apenas a metadata já em cache (dnf-makecache.timer), sem acesso à rede
+    tool, _ = find_dnf()
+    result = run_command([tool, '-q', '-C', 'check-update'],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # Código 100: há atualizações; 0: nenhuma
+    if result.returncode not in (0, 100):
+        raise RuntimeError(f"{tool} check-update terminou com código {result.returncode}")
+
+    installed = {p['Identifier']: p['Version'] for p in read_rpm_packages()}
+    updates = []
+    tokens = []
+    for line in result.stdout.splitlines():
+        # Exemplo:
+        # bash.x86_64    5.2.26-3.fc40    updates
+        if line.lower().startswith('obsoleting'):
+            break
+        # Nomes longos podem passar a coluna seguinte para outra linha
+        tokens.extend(line.split())
+        if len(tokens) < 3:
+            continue
+        package, new_version, repo = tokens[:3]
+        tokens = []
+        name, _, arch = package.rpartition('.')
+        if not name:
+            continue
+        updates.append({
+            "Name": name,
+            "InstalledVersion": installed.get(package, "NULL"),
+            "NewVersion": new_version,
+            "Architecture": arch,
+            "Origin": repo,
+            "ReleaseDate": "NULL",
+            "Description": "NULL",
+            "Source": tool
+        })
+    return updates
+
+def read_dnf_updates():
+    tool, cache_dir = find_dnf()
+    if tool is None:
+        return []
+    key_paths = [cache_dir] + dnf_metadata_files(cache_dir)
+    rpmdb, is_sqlite = find_rpmdb()
+    if rpmdb:
+        key_paths += [rpmdb, rpmdb + '-wal'] if is_sqlite else [rpmdb]
+    return cached_file_parse(key_paths, get_dnf_updates)
+
+def parse_pacman_desc(path):
+    # Formato: %CHAVE% numa linha, valor(es) nas seguintes, linha vazia no fim
+    fields = {}
+    key = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 2 and line[0] == '%' and line[-1] == '%':
+                key = line[1:-1]
+            elif not line:
+                key = None
+            elif key and key not in fields:
+                fields[key] = line
+    return fields
+
+def parse_pacman_local(local_dir):
+    # Uma pasta por pacote instalado (nome-versão), com o ficheiro desc
+    with os.scandir(local_dir) as it:
+        names = sorted(entry.name for entry in it if entry.is_dir())
+
+    packages = []
+    for name in names:
+        try:
+            fields = parse_pacman_desc(os.path.join(local_dir, name, 'desc'))
+        except OSError:
+            continue
+        if not fields.get('NAME') or not fields.get('VERSION'):
+            continue
+        installed = fields.get('INSTALLDATE', '')
+        size = fields.get('SIZE', '')
+        packages.append({
+            "Name": fields['NAME'],
+            "Version": fields['VERSION'],
+            "Identifier": fields['NAME'],
+            "InstallDate": datetime.fromtimestamp(int(installed)).strftime('%Y-%m-%d %H:%M:%S') if installed.isdigit() else "NULL",
+            "Source": "pacman",
+            "InstalledSize": int(size) // 1024 if size.isdigit() else "NULL",  # KiB
+            "Architecture": fields.get('ARCH') or "NULL",
+            "Status": "installed"
+        })
+    return packages
+
+def read_pacman_packages():
+    # A pasta local muda (mtime) sempre que um pacote é instalado, atualizado ou removido
+    local_dir = os.path.join(PACMAN_DB_DIR, 'local')
+    return cached_file_parse((local_dir,), parse_pacman_local, local_dir)
+
+def get_pacman_updates():
+    # pacman -Qu compara com as bases de sincronização locais (último pacman -Sy), sem rede
+    result = run_command(['pacman', '-Qu'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # Código 1: nenhuma atualização
+    if result.returncode not in (0, 1):
+        raise RuntimeError(f"pacman -Qu terminou com código {result.returncode}")
+
+    architectures = {p['Name']: p['Architecture'] for p in read_pacman_packages()}
+    updates = []
+    for line in result.stdout.splitlines():
+        # Exemplo:
+        # bash 5.2.026-2 -> 5.2.032-1
+        parts = line.split()
+        if len(parts) < 4 or parts[2] != '->':
+            continue
+        updates.append({
+            "Name": parts[0],
+            "InstalledVersion": parts[1],
+            "NewVersion": parts[3],
+            "Architecture": architectures.get(parts[0], "NULL"),
+            "Origin": "NULL",
+            "ReleaseDate": "NULL",
+            "Description": "NULL",
+            "Source": "pacman"
+        })
+    return updates
+
+def read_pacman_updates():
+    sync_dir = os.path.join(PACMAN_DB_DIR, 'sync')
+    if not shutil.which('pacman') or not os.path.isdir(sync_dir):
+        return []
+    return cached_file_parse((sync_dir, os.path.join(PACMAN_DB_DIR, 'local')), get_pacman_updates)
+
+PACKAGE_BACKENDS = []
+
+def register_package_backend(name, detect, installed, updates=None):
+    PACKAGE_BACKENDS.append({'Name': name, 'Detect': detect, 'Installed': installed, 'Updates': updates})
+
+register_package_backend('dpkg', lambda: os.path.exists(DPKG_STATUS_FILE), read_dpkg_status, read_apt_updates)
+register_package_backend('snap', lambda: shutil.which('snap') is not None, read_snap_packages)
+register_package_backend('flatpak', lambda: shutil.which('flatpak') is not None, read_flatpak_packages)
+register_package_backend('rpm', lambda: find_rpmdb()[0] is not None, read_rpm_packages, read_dnf_updates)
+register_package_backend('pacman', lambda: os.path.isdir(os.path.join(PACMAN_DB_DIR, 'local')),
+                         read_pacman_packages, read_pacman_updates)
+
+register_config('DisabledPackageBackends', list, [])
+
+def run_package_backends(kind, section):
+    # kind: 'Installed' ou 'Updates'. Devolve [(backend, resultado ou exceção)]
+    disabled = set(CONFIG.get('DisabledPackageBackends'))
+    backends = [
+        backend for backend in PACKAGE_BACKENDS
+        if backend[kind] and backend['Name'] not in disabled and backend['Detect']()
+    ]
+    if not backends:
+        return []
+
+    # Os workers herdam o prazo do coletor
+    deadline = command_deadline()
+
+    def run(backend):
+        with command_budget(deadline):
+            return STATS.measure(f"{section}:{backend['Name']}", backend[kind])
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(backends), thread_name_prefix='packages') as pool:
+        futures = [(backend['Name'], pool.submit(run, backend)) for backend in backends]
+        for name, future in futures:
+            try:
+                results.append((name, future.result()))
+            except Exception as e:
+                log(f"Erro no backend de pacotes {name}: {e}", level='WARNING', section=section)
+                results.append((name, e))
+    return results
+
+def get_all_installed_software():
+    software_list = []
+    for name, result in run_package_backends('Installed', 'InstalledSoftware'):
+        if not isinstance(result, Exception):
+            software_list.extend(result)
+    return software_list
+
+def get_pending_updates():
+    updates = []
+    for name, result in run_package_backends('Updates', 'PendingUpdates'):
+        if isinstance(result, Exception):
+            updates.append({"Error": str(result), "Backend": name})
+        else:
+            updates.extend(result)
+    return updates
 
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
+
+
+# =================== JOURNAL ===================
+# Leitura incremental do journal: cada leitor guarda o cursor da última entrada
+# enviada e no sync seguinte lê apenas as entradas posteriores. O cursor só é
+# gravado depois de o payload ser aceite pelo servidor.
+JOURNAL_PRIORITY_MAP = {
+    "0": "EMERG",
+    "1": "ALERT",
+    "2": "CRITICAL",
+    "3": "ERROR",
+    "4": "WARNING",
+    "5": "NOTICE",
+    "6": "INFO",
+    "7": "DEBUG"
+}
+
+register_config('JournalMaxEvents', int, 50, 1, 100000)
+register_config('JournalMaxKernelEvents', int, 100, 1, 100000)
+
+def journal_message(entry):
+    message = entry.get("MESSAGE", "")
+    if isinstance(message, list):  # mensagens não UTF-8 vêm como lista de bytes
+        message = bytes(message).decode(errors='replace')
+    return message
+
+def journal_datetime(entry):
+    ts_raw = entry.get("__REALTIME_TIMESTAMP")
+    if not ts_raw:
+        return None
+    return datetime.fromtimestamp(int(ts_raw) / 1_000_000).astimezone()
+
+def save_journal_cursor(name, cursor):
+    cursors = load_state('journal_cursors.json', {})
+    if not isinstance(cursors, dict):
+        cursors = {}
+    cursors[name] = cursor
+    save_state('journal_cursors.json', cursors)
+
+def read_journal(section, name, args, max_events):
+    # Devolve (entradas, descartadas). Mantém apenas as max_events mais recentes;
+    # as restantes são contadas como descartadas.
+    cursors = load_state('journal_cursors.json', {})
+    cursor = cursors.get(name) if isinstance(cursors, dict) else None
+
+    def run(cursor):
+        cmd = ["journalctl", "--no-pager", "-o", "json"] + args
+        cmd += ["--after-cursor", cursor] if cursor else ["-n", str(max_events)]
+        kept = collections.deque(maxlen=max_events)
+        total = 0
+        nbytes = 0
+        started = time.monotonic()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        timeout = command_timeout()
+        timer = threading.Timer(timeout, proc.kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            for line in proc.stdout:
+                total += 1
+                nbytes += len(line)
+                kept.append(line)
+            proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+        STATS.record_subprocess(time.monotonic() - started, proc.returncode != 0)
+        STATS.record_read(nbytes)
+        return kept, total, proc.returncode
+
+    kept, total, returncode = run(cursor)
+    if cursor and returncode != 0 and total == 0:
+        # Cursor inválido (journal rodado/limpo): recomeça pelas últimas entradas
+        log(f"Cursor do journal '{name}' inválido, a recomeçar.", level='WARNING')
+        kept, total, returncode = run(None)
+
+    entries = []
+    for line in kept:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+
+    if entries and entries[-1].get("__CURSOR"):
+        last_cursor = entries[-1]["__CURSOR"]
+        add_sync_commit(section, lambda: save_journal_cursor(name, last_cursor))
+
+    return entries, total - len(kept)
+
+def get_linux_errors_warnings():
+    try:
+        max_events = CONFIG.get('JournalMaxEvents')
+        entries, dropped = read_journal('SystemErrorsWarnings', 'errors', ["-p", "3..4"], max_events)
 
         events = []
 
-        for line in result.stdout.splitlines():
+        for entry in entries:
+            ts = journal_datetime(entry)
+            # Mesmo formato do journalctl -o short-iso
+            line = "{} {} {}{}: {}".format(
+                ts.strftime('%Y-%m-%dT%H:%M:%S%z') if ts else "",
+                entry.get("_HOSTNAME", ""),
+                entry.get("SYSLOG_IDENTIFIER", ""),
+                f"[{entry['_PID']}]" if entry.get("_PID") else "",
+                journal_message(entry)
+            )
             events.append({
                 "Timestamp": line[:19],
                 "Level": "ERROR/WARNING",
@@ -746,7 +2996,8 @@ def get_linux_errors_warnings(max_events=50):
 
         return {
             "Source": "journalctl",
-            "Events": events
+            "Events": events,
+            "Dropped": dropped
         }
 
     except Exception as e:
@@ -754,72 +3005,633 @@ def get_linux_errors_warnings(max_events=50):
 
 
 
-def get_kernel_events(max_events=100):
-    cmd = [
-        "journalctl",
-        "--no-pager",
-        "-k",
-        "-n", str(max_events),
-        "-o", "json"
-    ]
+def get_kernel_events():
+    max_events = CONFIG.get('JournalMaxKernelEvents')
+    entries, dropped = read_journal('KernelEvents', 'kernel', ["-k"], max_events)
+
+    events = []
+
+    for entry in entries:
+        # 🔹 converter microsegundos → formato antigo
+        ts = journal_datetime(entry)
+        timestamp = ts.strftime('%Y-%m-%d %H:%M:%S') if ts else "NULL"
+
+        priority = entry.get("PRIORITY", "6")
 
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
-
-    PRIORITY_MAP = {
-        "0": "EMERG",
-        "1": "ALERT",
-        "2": "CRITICAL",
-        "3": "ERROR",
-        "4": "WARNING",
-        "5": "NOTICE",
-        "6": "INFO",
-        "7": "DEBUG"
+        events.append({
+            "Source": "Kernel",
+            "Level": JOURNAL_PRIORITY_MAP.get(priority, "INFO"),
+            "Timestamp": timestamp,
+            "Message": journal_message(entry)
+        })
+
+    return {
+        "Source": "Kernel",
+        "Events": events,
+        "Dropped": dropped
     }
 
-    events = []
 
-    for line in result.stdout.splitlines():
-        try:
-            entry = json.loads(line)
 
-            # 🔹 converter microsegundos → formato antigo
-            ts_raw = entry.get("__REALTIME_TIMESTAMP")
-            if ts_raw:
-                ts = datetime.fromtimestamp(int(ts_raw) / 1_000_000)
-                timestamp = ts.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                timestamp = "NULL"
+# =================== COLLECTORS ===================
+# Registo dos coletores do full sync: secção do payload -> função + timeout.
+# Os coletores são independentes entre si e podem correr em paralelo.
+COLLECTORS = []
+
+def register_collector(section, func, timeout=COLLECTOR_TIMEOUT):
+    COLLECTORS.append({'Section': section, 'Func': func, 'Timeout': timeout})
+
+register_collector('MACAddress', get_mac_address, 10)
+register_collector('ProcessList', get_process_list, 30)
+register_collector('ProcessSummary', get_process_summary, 30)
+register_collector('Uptime', get_uptime, 10)
+register_collector('LastBoot', get_last_boot, 10)
+register_collector('TimeZone', get_timezone, 10)
+register_collector('KernelVersion', get_kernel_version, 10)
+register_collector('CPUArchitecture', get_architecture, 10)
+register_collector('NumLoggedUsers', get_logged_users, 10)
+register_collector('PublicIP', get_public_ip, 15)
+register_collector('TotalRAM', get_total_memory, 10)
+register_collector('IdDeviceType', get_device_type, 10)
+register_collector('InstalledSoftware', get_all_installed_software, 120)
+register_collector('PendingUpdates', get_pending_updates, 120)
+register_collector('BiosUpgrade', get_bios_last_upgrade_date, 10)
+register_collector('OS_Info', get_os_info, 10)
+register_collector('Bios_Info', get_bios_info, 30)
+register_collector('MB_Info', get_motherboard_info, 30)
+register_collector('CPU_Info', get_cpu_info, 10)
+register_collector('NetworkInfo', get_network_interfaces_info, 30)
+register_collector('DiskInfo', get_disk_info, 60)
+register_collector('MemoryInfo', get_physical_memory_info, 30)
+register_collector('SystemErrorsWarnings', get_linux_errors_warnings, 60)
+register_collector('KernelEvents', get_kernel_events, 60)
+
+
+def partial_section(error):
+    # Secção marcada como parcial quando o coletor falha ou excede o timeout
+    return {'Partial': 1, 'Error': error}
+
+
+def run_collectors(collectors, parallel=True, max_workers=COLLECTOR_WORKERS):
+    # Executa os coletores e devolve (resultados, secções parciais).
+    # Em modo paralelo cada coletor tem o seu próprio timeout, contado a partir
+    # do momento em que começa a correr; um coletor lento ou com erro não
+    # bloqueia o resto do payload.
+    results = {}
+    partial = []
+
+    if not parallel:
+        for collector in collectors:
+            section = collector['Section']
+            try:
+                with command_budget(time.monotonic() + collector['Timeout']):
+                    results[section] = STATS.measure(section, collector['Func'])
+            except Exception as e:
+                log(f"Coletor {section} falhou: {e}", level='WARNING', section=section)
+                results[section] = partial_section(str(e))
+                partial.append(section)
+        return results, partial
 
-            priority = entry.get("PRIORITY", "6")
+    started = {}
 
-            events.append({
-                "Source": "Kernel",
-                "Level": PRIORITY_MAP.get(priority, "INFO"),
-                "Timestamp": timestamp,
-                "Message": entry.get("MESSAGE", "")
-            })
+    def run(collector):
+        started[collector['Section']] = time.monotonic()
+        with command_budget(started[collector['Section']] + collector['Timeout']):
+            return STATS.measure(collector['Section'], collector['Func'])
 
-        except Exception:
-            continue
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='collector')
+    futures = {}
+    try:
+        futures = {executor.submit(run, c): c for c in collectors}
+        # Limite global para coletores que nunca chegam a arrancar
+        # (todas as threads ocupadas por coletores presos)
+        hard_deadline = time.monotonic() + 2 * max(c['Timeout'] for c in collectors)
+        pending = set(futures)
+
+        while pending:
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                section = futures[future]['Section']
+                try:
+                    results[section] = future.result()
+                except Exception as e:
+                    log(f"Coletor {section} falhou: {e}", level='WARNING', section=section)
+                    results[section] = partial_section(str(e))
+                    partial.append(section)
+            pending -= done
+
+            now = time.monotonic()
+            for future in list(pending):
+                collector = futures[future]
+                section = collector['Section']
+                start = started.get(section)
+                if start is not None and now - start > collector['Timeout']:
+                    error = f"Timeout após {collector['Timeout']}s"
+                elif now > hard_deadline:
+                    error = "Timeout: coletor não iniciado"
+                else:
+                    continue
+                log(f"Coletor {section}: {error}", level='WARNING', section=section)
+                STATS.record_timeout(section)
+                results[section] = partial_section(error)
+                partial.append(section)
+                pending.discard(future)
+    finally:
+        # Não espera por coletores presos; as threads terminam sozinhas (os
+        # processos que lançaram têm o timeout do coletor). cancel_futures só
+        # existe a partir do Python 3.9: os que não arrancaram cancelam-se aqui.
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return results, partial
+
+
+# =================== DELTA SYNC ===================
+# Secções que podem ser enviadas como delta: secção -> chave de cada entrada.
+# O agente envia a lista completa + hash até o servidor confirmar o snapshot
+# (SnapshotAck); a partir daí envia apenas Added/Removed/Changed face ao último
+# snapshot confirmado. O servidor pode pedir a lista completa com Resync.
+# A ProcessList não entra: CPU%, tempo de CPU e RSS mudam em quase todas as
+# linhas a cada recolha, e o delta ficava maior do que a lista completa
+DELTA_SECTIONS = {
+    'InstalledSoftware': lambda item: f"{item.get('Source', '')}:{item.get('Identifier', '')}",
+}
+
+def snapshot_hash(items_by_key):
+    encoded = json.dumps(items_by_key, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def index_snapshot_items(section, items):
+    key_func = DELTA_SECTIONS[section]
+    indexed = {}
+    for item in items:
+        key = key_func(item)
+        # Entradas repetidas (ex.: flatpak system + user) recebem sufixo estável
+        unique_key, n = key, 1
+        while unique_key in indexed:
+            n += 1
+            unique_key = f"{key}#{n}"
+        indexed[unique_key] = item
+    return indexed
+
+def build_delta_payload(section, items):
+    current = index_snapshot_items(section, items)
+    current_hash = snapshot_hash(current)
+    # Fica pendente até o servidor confirmar a receção deste hash
+    save_state(f"snapshot_{section}.pending.json", {'Hash': current_hash, 'Items': current})
+
+    base = load_state(f"snapshot_{section}.json")
+    if not isinstance(base, dict) or base.get('Hash') != snapshot_hash(base.get('Items', {})):
+        return {section: items, f"{section}Hash": current_hash}
+
+    base_items = base['Items']
+    added = [item for key, item in current.items() if key not in base_items]
+    removed = [item for key, item in base_items.items() if key not in current]
+    changed = [item for key, item in current.items()
+               if key in base_items and base_items[key] != item]
 
     return {
-        "Source": "Kernel",
-        "Events": events
+        f"{section}Delta": {
+            'BaseHash': base['Hash'],
+            'Hash': current_hash,
+            'Added': added,
+            'Removed': removed,
+            'Changed': changed
+        }
     }
 
+def apply_delta_sync(data):
+    for section in DELTA_SECTIONS:
+        items = data.get(section)
+        if isinstance(items, list):  # secções parciais seguem como estão
+            del data[section]
+            data.update(build_delta_payload(section, items))
+
+def handle_snapshot_response(reply):
+    # SnapshotAck: {"InstalledSoftware": "<hash>", ...}
+    acks = reply.get('SnapshotAck')
+    if isinstance(acks, dict):
+        for section, ack_hash in acks.items():
+            if section not in DELTA_SECTIONS:
+                continue
+            pending = load_state(f"snapshot_{section}.pending.json")
+            if isinstance(pending, dict) and pending.get('Hash') == ack_hash:
+                os.replace(state_path(f"snapshot_{section}.pending.json"),
+                           state_path(f"snapshot_{section}.json"))
+                log(f"Snapshot {section} confirmado pelo servidor.")
+
+    # Resync: 1 (todas as secções) ou ["InstalledSoftware", ...]
+    resync = reply.get('Resync')
+    if resync in (1, '1', True):
+        resync = list(DELTA_SECTIONS)
+    if isinstance(resync, list):
+        for section in resync:
+            if section in DELTA_SECTIONS:
+                remove_state(f"snapshot_{section}.json")
+                log(f"Servidor pediu resync completo de {section}.")
+
+def handle_sync_response(response):
+    try:
+        reply = response.json()
+    except ValueError:
+        return
+    if isinstance(reply, dict):
+        handle_snapshot_response(reply)
+
+
+# =================== PAYLOAD ENCODING ===================
+# Formato compacto opcional para o payload do sync: listas de objetos passam a
+# tabelas em colunas (nomes dos campos uma única vez) e os textos repetidos
+# ("NULL", "dpkg", nomes de utilizador...) ficam numa tabela de strings comum.
+# O corpo pode ainda ser comprimido (gzip, ou zstd se o módulo existir).
+# O servidor anuncia o que aceita nas respostas (X-IWebIT-Payload-Format e
+# Accept-Encoding); sem esse anúncio o envio continua em JSON simples.
+COLUMNAR_FORMAT = 'columnar/1'
+COLUMNAR_CONTENT_TYPE = 'application/vnd.iwebit.columnar+json'
+PAYLOAD_FORMAT_HEADER = 'X-IWebIT-Payload-Format'
+COLUMNAR_MIN_ROWS = 2
+register_config('PayloadFormat', str, 'auto', choices=('auto', 'json', 'columnar'))
+register_config('PayloadCompression', str, 'auto', choices=('auto', 'none', 'gzip', 'zstd'))
+
+_payload_server = None
+_payload_server_lock = threading.Lock()
+
+def encode_columnar(data):
+    strings = []
+    string_index = {}
+
+    def intern(value):
+        if value not in string_index:
+            string_index[value] = len(strings)
+            strings.append(value)
+        return string_index[value]
+
+    def encode(value):
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            if len(value) >= COLUMNAR_MIN_ROWS and all(isinstance(item, dict) for item in value):
+                return encode_table(value)
+            return [encode(item) for item in value]
+        return value
+
+    def encode_table(rows):
+        fields = list(dict.fromkeys(key for row in rows for key in row))
+        columns, interned, absent = [], [], {}
+        for i, field in enumerate(fields):
+            values = [row.get(field) for row in rows]
+            missing = [n for n, row in enumerate(rows) if field not in row]
+            if missing:
+                absent[str(i)] = missing
+            if all(value is None or isinstance(value, str) for value in values):
+                interned.append(i)
+                columns.append([None if value is None else intern(value) for value in values])
+            else:
+                columns.append([encode(value) for value in values])
+        table = {'Rows': len(rows), 'Fields': fields, 'Columns': columns}
+        if interned:
+            table['Interned'] = interned
+        if absent:
+            table['Absent'] = absent
+        return {'$table': table}
+
+    encoded = encode(data)
+    return {'Format': COLUMNAR_FORMAT, 'Strings': strings, 'Data': encoded}
+
+def decode_columnar(document):
+    strings = document['Strings']
+
+    def decode(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and '$table' in value:
+                return decode_table(value['$table'])
+            return {key: decode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return value
+
+    def decode_table(table):
+        rows = [{} for _ in range(table['Rows'])]
+        interned = set(table.get('Interned', ()))
+        absent = table.get('Absent', {})
+        for i, (field, column) in enumerate(zip(table['Fields'], table['Columns'])):
+            skip = set(absent.get(str(i), ()))
+            for n, value in enumerate(column):
+                if n in skip:
+                    continue
+                if i in interned:
+                    rows[n][field] = None if value is None else strings[value]
+                else:
+                    rows[n][field] = decode(value)
+        return rows
+
+    return decode(document['Data'])
+
+def encode_payload(data, payload_format='json', encoding=None):
+    # Devolve (corpo, cabeçalhos) prontos para o POST
+    if payload_format == COLUMNAR_FORMAT:
+        body = json.dumps(encode_columnar(data), separators=(',', ':')).encode()
+        headers = {'Content-Type': COLUMNAR_CONTENT_TYPE}
+    else:
+        body = json.dumps(data, separators=(',', ':')).encode()
+        headers = {'Content-Type': 'application/json'}
+
+    if encoding == 'zstd':
+        body = zstandard.ZstdCompressor(level=3).compress(body)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return body, headers
+
+def decode_payload(body, headers):
+    encoding = headers.get('Content-Encoding')
+    if encoding == 'zstd':
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif encoding == 'gzip':
+        body = gzip.decompress(body)
+    document = json.loads(body)
+    if headers.get('Content-Type') == COLUMNAR_CONTENT_TYPE:
+        return decode_columnar(document)
+    return document
+
+def header_values(value):
+    # "zstd, gzip;q=0.5" -> ['zstd', 'gzip']
+    return [item.split(';')[0].strip().lower() for item in (value or '').split(',') if item.strip()]
+
+def get_payload_server():
+    global _payload_server
+    with _payload_server_lock:
+        if _payload_server is None:
+            stored = load_state('payload_format.json', {})
+            if not isinstance(stored, dict):
+                stored = {}
+            _payload_server = {'Formats': stored.get('Formats', []), 'Encodings': stored.get('Encodings', [])}
+        return _payload_server
+
+def update_payload_server(formats, encodings):
+    # Guarda o que o servidor anunciou; só escreve em disco quando muda
+    global _payload_server
+    current = get_payload_server()
+    announced = {'Formats': formats, 'Encodings': encodings}
+    if announced == current:
+        return
+    with _payload_server_lock:
+        _payload_server = announced
+    save_state('payload_format.json', announced)
+    log(f"Formatos de payload aceites pelo servidor: {formats or ['json']}, compressão: {encodings or ['none']}")
+
+def choose_payload_format():
+    # (formato, compressão) para o próximo envio, de acordo com PayloadFormat,
+    # PayloadCompression e o que o servidor anunciou
+    server = get_payload_server()
+    preferred = CONFIG.get('PayloadFormat')
+    if preferred == 'columnar' or (preferred == 'auto' and COLUMNAR_FORMAT in server['Formats']):
+        payload_format = COLUMNAR_FORMAT
+    else:
+        payload_format = 'json'
+
+    available = ['zstd', 'gzip'] if zstandard else ['gzip']
+    compression = CONFIG.get('PayloadCompression')
+    if compression == 'none':
+        encoding = None
+    elif compression in ('gzip', 'zstd'):
+        encoding = compression if compression in available else 'gzip'
+    else:
+        encoding = next((e for e in available if e in server['Encodings']), None)
+    return payload_format, encoding
+
+
+# =================== SPOOL ===================
+# Payloads que não puderam ser enviados ficam guardados em SQLite e são
+# reenviados por ordem (mais antigo primeiro) quando a ligação volta.
+# Ao exceder o tamanho máximo, os mais antigos são descartados.
+# Um payload que o servidor continua a recusar (5xx) espera cada vez mais entre
+# tentativas e, ao fim de SPOOL_MAX_ATTEMPTS ou SPOOL_MAX_FAILURE_AGE, passa para
+# a tabela dead_letter, para não bloquear os restantes.
+# Nesse caso os payloads novos podem chegar antes dos antigos: quando um full sync
+# novo é aceite, os full syncs ainda no spool (mais antigos) são descartados; os
+# minimal syncs reenviados depois podem chegar fora de ordem e levam Spooled=1 e o
+# DateTime da recolha para o servidor os ordenar.
+class PayloadSpool:
+    def __init__(self, path, max_bytes=SPOOL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL, size INTEGER, payload TEXT)"
+            )
+            # Spools criados por versões anteriores não têm as colunas de tentativas
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(spool)")}
+            for name, definition in (('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+                                     ('first_failure', 'REAL'), ('next_attempt', 'REAL'),
+                                     ('full', 'INTEGER NOT NULL DEFAULT 0')):
+                if name not in columns:
+                    self._conn.execute(f"ALTER TABLE spool ADD COLUMN {name} {definition}")
+            if 'full' not in columns:
+                for row_id, payload in self._conn.execute("SELECT id, payload FROM spool").fetchall():
+                    full = 1 if json.loads(payload).get('FullSync') else 0
+                    self._conn.execute("UPDATE spool SET full = ? WHERE id = ?", (full, row_id))
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letter ("
+                "id INTEGER PRIMARY KEY, created REAL, failed REAL, attempts INTEGER, size INTEGER, payload TEXT)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def append(self, data):
+        payload = json.dumps(data, separators=(',', ':'))
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT INTO spool (created, size, payload, full) VALUES (?, ?, ?, ?)",
+                       (time.time(), len(payload), payload, 1 if data.get('FullSync') else 0))
+            evicted = 0
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM spool").fetchone()[0]
+            while total > self.max_bytes:
+                row = db.execute("SELECT id, size FROM spool ORDER BY id LIMIT 1").fetchone()
+                if row is None:
+                    break
+                db.execute("DELETE FROM spool WHERE id = ?", (row[0],))
+                total -= row[1]
+                evicted += 1
+            db.commit()
+        if evicted:
+            log(f"Spool cheio: {evicted} payloads antigos descartados.", level='WARNING')
+
+    def count(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def peek(self, limit):
+        # Lê um lote inteiro numa só consulta: (id, payload, próxima tentativa)
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT id, payload, next_attempt FROM spool ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row_id, json.loads(payload), next_attempt) for row_id, payload, next_attempt in rows]
+
+    def head_failed(self):
+        # O payload mais antigo já falhou pelo menos uma vez?
+        with self._lock:
+            row = self._db().execute("SELECT attempts FROM spool ORDER BY id LIMIT 1").fetchone()
+        return bool(row and row[0])
+
+    def record_failure(self, row_id, retry_base=SPOOL_DRAIN_INTERVAL):
+        # Regista uma tentativa falhada com backoff exponencial; devolve True se o
+        # payload excedeu as tentativas/idade e foi movido para dead_letter
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT attempts, first_failure FROM spool WHERE id = ?", (row_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row[0] + 1
+            first_failure = row[1] or now
+            if attempts >= SPOOL_MAX_ATTEMPTS or now - first_failure >= SPOOL_MAX_FAILURE_AGE:
+                db.execute(
+                    "INSERT INTO dead_letter (id, created, failed, attempts, size, payload) "
+                    "SELECT id, created, ?, ?, size, payload FROM spool WHERE id = ?",
+                    (now, attempts, row_id)
+                )
+                db.execute("DELETE FROM spool WHERE id = ?", (row_id,))
+                db.execute(
+                    "DELETE FROM dead_letter WHERE id NOT IN "
+                    "(SELECT id FROM dead_letter ORDER BY id DESC LIMIT ?)", (SPOOL_DEAD_LETTER_MAX,)
+                )
+                db.commit()
+                return True
+            delay = min(retry_base * 2 ** (attempts - 1), SPOOL_RETRY_MAX)
+            db.execute("UPDATE spool SET attempts = ?, first_failure = ?, next_attempt = ? WHERE id = ?",
+                       (attempts, first_failure, now + delay, row_id))
+            db.commit()
+        return False
+
+    def discard_full(self):
+        # Remove os full syncs em fila, substituídos por um mais recente já aceite
+        with self._lock:
+            db = self._db()
+            discarded = db.execute("DELETE FROM spool WHERE full = 1").rowcount
+            db.commit()
+        return discarded
+
+    def remove(self, row_id):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM spool WHERE id = ?", (row_id,))
+            db.commit()
+
+SPOOL = PayloadSpool(state_path('spool.db'))
+
+def set_spool_max_mb(megabytes):
+    SPOOL.max_bytes = megabytes * 1024 * 1024
+
+CONFIG.watch('SpoolMaxMB', set_spool_max_mb)
+
+def post_payload(data):
+    # Devolve a resposta se o servidor recebeu o payload, None se deve ir para o spool.
+    # Respostas 4xx (payload rejeitado) não são repetidas, como antes.
+    payload_format, encoding = choose_payload_format()
+    try:
+        body, headers = encode_payload(data, payload_format, encoding)
+        headers[PAYLOAD_FORMAT_HEADER] = f"{COLUMNAR_FORMAT}, json"
+        STATS.record_payload(len(body))
+        response = HTTP.post(API_URL, data=body, headers=headers, endpoint='script_linux')
+        log(f"Data sent. Status code: {response.status_code}", bytes=len(body),
+            format=payload_format, encoding=encoding or 'none')
+        if response.status_code == 415 and (payload_format != 'json' or encoding):
+            # O servidor deixou de aceitar o formato compacto: volta ao JSON simples
+            log("Formato de payload recusado pelo servidor, a reenviar em JSON.", level='WARNING')
+            update_payload_server([], [])
+            body, headers = encode_payload(data)
+            STATS.record_payload(len(body))
+            response = HTTP.post(API_URL, data=body, headers=headers, endpoint='script_linux')
+            log(f"Data sent. Status code: {response.status_code}", bytes=len(body))
+    except Exception as e:
+        log(f"Failed to send data: {e}", level='WARNING')
+        return None
+    if response.status_code >= 500 or response.status_code == 429:
+        return None
+    if response.status_code == 200:
+        update_payload_server(header_values(response.headers.get(PAYLOAD_FORMAT_HEADER)),
+                              header_values(response.headers.get('Accept-Encoding')))
+    return response
+
+def drain_spool(batch=SPOOL_BATCH, rate=SPOOL_RATE):
+    # Reenvia até 'batch' payloads, no máximo 'rate' por segundo, para não
+    # sobrecarregar o servidor quando muitos agentes voltam a ter ligação.
+    sent = 0
+    for row_id, data, next_attempt in SPOOL.peek(batch):
+        if next_attempt and next_attempt > time.time():
+            # Em backoff após falhas anteriores
+            break
+        if sent:
+            time.sleep(1 / rate)
+        response = post_payload(data)
+        if response is None:
+            if SPOOL.record_failure(row_id, CONFIG.get('SpoolDrainInterval')):
+                log(f"Spool: payload {row_id} recusado {SPOOL_MAX_ATTEMPTS} vezes ou há demasiado tempo, "
+                    f"movido para dead_letter.", level='WARNING')
+                continue
+            break
+        SPOOL.remove(row_id)
+        sent += 1
+        if response.status_code == 200:
+            handle_sync_response(response)
+    if sent:
+        log(f"Spool: {sent} payloads reenviados, {SPOOL.count()} pendentes.")
+    return sent
+
+def deliver_payload(data, online=True):
+    # Com payloads pendentes no spool o novo payload entra na fila, para manter
+    # a ordem. Um payload guardado no spool conta como aceite (commits executados).
+    # Se o mais antigo do spool já falhou (possivelmente recusado pelo servidor),
+    # o novo payload tenta primeiro o envio direto em vez de ficar preso atrás dele.
+    if online and (SPOOL.count() == 0 or SPOOL.head_failed()):
+        response = post_payload(data)
+        if response is not None:
+            if response.status_code == 200:
+                run_sync_commits(data)
+                handle_sync_response(response)
+                if data.get('FullSync'):
+                    discarded = SPOOL.discard_full()
+                    if discarded:
+                        log(f"Spool: {discarded} full syncs antigos descartados (substituídos).")
+            return
+
+    data['Spooled'] = 1
+    try:
+        SPOOL.append(data)
+        run_sync_commits(data)
+        log("Payload guardado no spool para envio posterior.")
+    except Exception as e:
+        log(f"Erro ao guardar payload no spool: {e}", level='ERROR')
 
 
 # =================== SYNC ===================
-def send_data(fullsync):
-    config = load_config()
-    # log(f"Config loaded in send_data: {config}")  # <-- linha para debug
-    idsync = config.get('IdSync', '0')
+def send_data(fullsync, online=True):
+    begin_sync_cache()
+    idsync = CONFIG.get('IdSync')
     hostname = get_hostname()
-    uniqueid = config.get('UniqueId', '0')
+    uniqueid = CONFIG.get('UniqueId')
     # log(f"UniqueId read: '{uniqueid}'")  # <-- linha para debug
     latitude, longitude = get_location()
     current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    debug_enabled = config.get('Debug', '0') == '1'
+    debug_enabled = CONFIG.get('Debug')
+    parallel = CONFIG.get('ParallelSync')
+    delta_enabled = CONFIG.get('DeltaSync')
+    agent_stats = CONFIG.get('AgentStats')
+
+    # Estatísticas do intervalo a partir do sampler; sem amostras (arranque)
+    # usa o CPU desde a leitura de referência do sampler, sem bloquear
+    resource_stats = SAMPLER.summary()
 
     data = {
         'IdSync': idsync,
@@ -828,132 +3640,387 @@ def send_data(fullsync):
         'AgentVersion': VERSION,
         'DateTime': current_datetime,
         'FullSync': 1 if fullsync else 0,
-        'CPUUsage': get_cpu_usage(),
+        'CPUUsage': resource_stats['CPU']['Avg'] if resource_stats else get_cpu_usage(),
         'MemoryUsage': get_memory_usage(),
         'CurrentUser': get_current_user(),
         'Latitude': latitude,
         'Longitude': longitude,
         'RebootPending': is_reboot_pending()
     }
+    if resource_stats:
+        data['ResourceStats'] = resource_stats
+    if fullsync and SCHEDULER:
+        data['SchedulerStats'] = SCHEDULER.stats()
 
     if fullsync:
-        data.update({
-            'MACAddress': get_mac_address(),
-            'ProcessList': get_process_list(),
-            'Uptime': get_uptime(),
-            'LastBoot': get_last_boot(),
-            'TimeZone': get_timezone(),
-            'DateTime': current_datetime,
-            'Hostname': hostname,
-            'KernelVersion': get_kernel_version(),
-            'CPUArchitecture': get_architecture(),
-            'NumLoggedUsers': get_logged_users(),
-            'CurrentUser': get_current_user(),
-            'PublicIP': get_public_ip(),
-            'TotalRAM': get_total_memory(),
-            'IdDeviceType': get_device_type(),
-            'AgentVersion': VERSION,
-            'InstalledSoftware': get_all_installed_software(),
-            'PendingUpdates': get_pending_updates(),
-            'BiosUpgrade': get_bios_last_upgrade_date(),
-            'OS_Info': get_os_info(),
-            'Bios_Info': get_bios_info(),
-            'MB_Info': get_motherboard_info(),
-            'CPU_Info': get_cpu_info(),
-            'NetworkInfo': get_network_interfaces_info(),
-            'DiskInfo': get_disk_info(),
-            'MemoryInfo': get_physical_memory_info(),
-            'RebootPending': is_reboot_pending(),
-            'SystemErrorsWarnings': get_linux_errors_warnings(),
-            'KernelEvents': get_kernel_events()           
-        })
-
-    # Salvar JSON se Debug=1
+        started = time.monotonic()
+        disabled = set(CONFIG.get('DisabledCollectors'))
+        collectors = [c for c in COLLECTORS if c['Section'] not in disabled]
+        results, partial = run_collectors(collectors, parallel=parallel, max_workers=CONFIG.get('CollectorWorkers'))
+        data.update(results)
+        if partial:
+            data['PartialSections'] = partial
+        log(f"Full sync recolhido em {time.monotonic() - started:.1f}s ({len(partial)} secções parciais); "
+            f"mais lentos: {', '.join(STATS.slowest())}")
+        if agent_stats:
+            data['AgentStats'] = STATS.snapshot()
+        if delta_enabled:
+            apply_delta_sync(data)
+
+    # Salvar JSON se Debug=1 (descodificado a partir do formato que vai ser enviado)
     if debug_enabled:
         try:
+            payload_format, encoding = choose_payload_format()
+            body, headers = encode_payload(data, payload_format, encoding)
             with open('/opt/iwebit_agent/iwebit_send.json', 'w') as json_file:
-                json.dump(data, json_file, indent=4)
-            log("Debug ativo: JSON enviado salvo em iwebit_send.json")
+                json.dump(decode_payload(body, headers), json_file, indent=4)
+            log("Debug ativo: JSON enviado salvo em iwebit_send.json",
+                format=payload_format, encoding=encoding or 'none', bytes=len(body))
         except Exception as e:
-            log(f"Erro ao gravar JSON de debug: {e}")
+            log(f"Erro ao gravar JSON de debug: {e}", level='ERROR')
             
     
-    try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(API_URL, json=data, headers=headers)
-        log(f"Data sent. Status code: {response.status_code}")
-    except Exception as e:
-        log(f"Failed to send data: {e}")
+    deliver_payload(data, online=online)
+
+    if fullsync:
+        log(f"HTTP stats: {json.dumps(HTTP.stats())}")
+        if SCHEDULER:
+            log(f"Scheduler stats: {json.dumps(SCHEDULER.stats())}")
 
 # =================== CHECK REMOTE ACTIONS ===================
 def check_remote_actions():
-    config = load_config()
-    uniqueid = config.get('UniqueId', '0')
+    uniqueid = CONFIG.get('UniqueId')
     if uniqueid == '0' or not uniqueid:
         log("UniqueId não definido, pulando verificação de ações remotas.")
         return
 
     try:
-        url = f"https://agent.iwebit.app/scripts/script_api.php?UniqueID={uniqueid}"
-        response = requests.get(url, timeout=10)
+        url = f"{SCRIPT_API_URL}?UniqueID={uniqueid}"
+        response = HTTP.get(url, endpoint='script_api:Actions')
         if response.status_code != 200:
-            log(f"Falha ao obter ações remotas. Código HTTP: {response.status_code}")
+            log(f"Falha ao obter ações remotas. Código HTTP: {response.status_code}", level='WARNING')
             return
 
-        data = response.json()
-        reboot = str(data.get('OperatingSystem_Reboot', '0')) == '1'
-        shutdown = str(data.get('OperatingSystem_ShutDown', '0')) == '1'
-
-        if reboot:
-            log("Comando remoto recebido: REBOOT")
-            os.system('reboot')
-        elif shutdown:
-            log("Comando remoto recebido: SHUTDOWN")
-            os.system('shutdown now')
-        else:
-            log("Nenhuma ação remota necessária.")
+        handle_remote_actions(response.json(), uniqueid)
 
     except Exception as e:
-        log(f"Erro ao verificar ações remotas: {e}")
+        log(f"Erro ao verificar ações remotas: {e}", level='ERROR')
+
+def handle_remote_actions(data, uniqueid):
+    reboot = str(data.get('OperatingSystem_Reboot', '0')) == '1'
+    shutdown = str(data.get('OperatingSystem_ShutDown', '0')) == '1'
+
+    if (reboot or shutdown) and not wait_for_scripts():
+        log("Scripts remotos ainda em execução; a continuar com o reboot/shutdown.", level='WARNING')
+
+    if reboot:
+        log("Comando remoto recebido: REBOOT")
+        os.system('reboot')
+    elif shutdown:
+        log("Comando remoto recebido: SHUTDOWN")
+        os.system('shutdown now')
+    else:
+        log("Nenhuma ação remota necessária.")
+
+
+# =================== COMMAND CHANNEL ===================
+# Um único pedido ao script_api.php (Commands=1) devolve todo o trabalho pendente:
+#   {"Commands": {"Actions": {...}, "Script": {"URL": ...}, "Updates": [...]}}
+# O pedido é condicional (ETag / If-None-Match -> 304 quando nada mudou) e pode
+# ser long-poll (Wait=<segundos>): o servidor só responde quando há comandos
+# novos ou o tempo expira. Servidores sem suporte continuam a usar os três
+# pedidos separados.
+COMMAND_CHANNEL_RETRY = 60 * 60   # volta a testar o canal unificado após 1 hora
+register_config('CommandLongPoll', int, 0, 0, 300)
+
+# Ordem de execução: atualizações e scripts antes de um eventual reboot/shutdown
+COMMAND_HANDLERS = [
+    ('Updates', handle_remote_updates),
+    ('Script', handle_remote_script),
+    ('Actions', handle_remote_actions),
+]
+
+_command_state = {'ETag': None, 'UnsupportedUntil': 0}
+
+def fetch_commands(uniqueid, wait=0):
+    # Devolve os comandos pendentes, {} se nada mudou, ou None se o servidor
+    # não suporta o canal unificado
+    params = {'UniqueID': uniqueid, 'Commands': 1}
+    if wait:
+        params['Wait'] = wait
+    headers = {}
+    if _command_state['ETag']:
+        headers['If-None-Match'] = _command_state['ETag']
+
+    response = HTTP.get(SCRIPT_API_URL, params=params, headers=headers,
+                        timeout=(HTTP_TIMEOUT[0], HTTP_TIMEOUT[1] + wait),
+                        endpoint='script_api:Commands')
+    if response.status_code == 304:
+        return {}
+    if 400 <= response.status_code < 500 and response.status_code not in (408, 429) \
+            or response.status_code == 501:
+        # Um script_api antigo rejeita Commands=1 (400/404/405/501): usa os pedidos separados
+        log(f"Canal de comandos rejeitado. Código HTTP: {response.status_code}", level='WARNING')
+        return None
+    if response.status_code != 200:
+        # Erro transitório (5xx, 408, 429): nada muda até à próxima verificação
+        log(f"Falha ao obter comandos remotos. Código HTTP: {response.status_code}", level='WARNING')
+        return {}
 
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('Commands'), dict):
+        return None
 
-# =================== MAIN LOOP ===================
-if __name__ == '__main__':
-    full_interval = 60 * 60
-    minimal_interval = 5 * 60
-    last_fullsync = 0
-    last_remote_check = 0
-    remote_check_interval = 2 * 60  # 2 minutos
+    _command_state['ETag'] = response.headers.get('ETag')
+    return data['Commands']
 
-    # Aguarda até haver conexão
-    while not is_connected():
-        log("Sem acesso à internet. Aguardando conexão...")
-        time.sleep(30)
+def dispatch_commands(commands, uniqueid):
+    for key, handler in COMMAND_HANDLERS:
+        if commands.get(key):
+            try:
+                handler(commands[key], uniqueid)
+            except Exception as e:
+                log(f"Erro ao processar comando {key}: {e}", level='ERROR')
 
-    log("Conexão com a internet estabelecida. Iniciando agente.")
+def check_remote_commands():
+    uniqueid = CONFIG.get('UniqueId')
+    if uniqueid == '0' or not uniqueid:
+        log("UniqueId não definido, pulando verificação de ações remotas.")
+        return
 
+    if time.time() >= _command_state['UnsupportedUntil']:
+        try:
+            commands = fetch_commands(uniqueid, wait=CONFIG.get('CommandLongPoll'))
+        except Exception as e:
+            log(f"Erro ao obter comandos remotos: {e}", level='ERROR')
+            return
+        if commands is not None:
+            dispatch_commands(commands, uniqueid)
+            return
+        log("Servidor sem canal de comandos unificado; a usar pedidos separados.")
+        _command_state['UnsupportedUntil'] = time.time() + COMMAND_CHANNEL_RETRY
+
+    check_remote_actions()
+    check_and_run_remote_scripts()
+    check_and_run_updates()
+
+
+# =================== SCHEDULER ===================
+# Agendador com fila de prioridade (heap): cada tarefa tem o seu intervalo e um
+# desfasamento determinístico derivado do UniqueId, para que os agentes da
+# frota não contactem o servidor todos ao mesmo tempo. Tarefas que vencem
+# dentro da mesma janela correm juntas; uma tarefa atrasada mais de um
+# intervalo não é repetida em rajada, salta para o próximo slot.
+class ScheduledTask:
+    def __init__(self, name, func, interval, group=None, supersedes=()):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        # Um ou mais grupos: a tarefa só corre quando nenhuma outra dos mesmos grupos corre
+        groups = group if isinstance(group, (list, tuple)) else [group or name]
+        self.groups = tuple(sorted(set(groups)))
+        self.supersedes = set(supersedes)
+        self.running = False
+        self.runs = 0
+        self.missed = 0
+        self.coalesced = 0
+        self.last_planned = None
+        self.last_actual = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.last_duration = 0.0
+
+class Scheduler:
+    def __init__(self, seed='', coalesce_window=5, max_workers=8):
+        # O mesmo desfasamento para todas as tarefas: como o intervalo do full sync
+        # é múltiplo do minimal, os slots coincidem e podem ser agrupados
+        self.phase_seed = int(hashlib.sha256(str(seed).encode()).hexdigest(), 16)
+        self.coalesce_window = coalesce_window
+        self.tasks = {}
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._group_locks = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+
+    def next_slot(self, task, after):
+        # Próximo instante > after alinhado com (k * intervalo + desfasamento)
+        phase = self.phase_seed % task.interval
+        slots = math.floor((after - phase) / task.interval) + 1
+        return slots * task.interval + phase
+
+    def _push(self, when, task):
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, task))
+
+    def add(self, name, func, interval, run_now=False, group=None, supersedes=()):
+        task = ScheduledTask(name, func, interval, group, supersedes)
+        now = time.time()
+        with self._lock:
+            self.tasks[name] = task
+            for group in task.groups:
+                self._group_locks.setdefault(group, threading.Lock())
+            self._push(now if run_now else self.next_slot(task, now), task)
+        self._wakeup.set()
+        return task
+
+    def set_interval(self, name, interval):
+        # Reagenda a tarefa para o próximo slot do novo intervalo
+        with self._lock:
+            task = self.tasks.get(name)
+            if not task or task.interval == interval:
+                return
+            task.interval = interval
+            self._heap = [(w, s, t) for w, s, t in self._heap if t is not task]
+            heapq.heapify(self._heap)
+            self._push(self.next_slot(task, time.time()), task)
+        self._wakeup.set()
+
+    def run_forever(self):
+        while True:
+            with self._lock:
+                due = self._heap[0][0] if self._heap else None
+            delay = 60 if due is None else due - time.time()
+            if delay > 0:
+                self._wakeup.wait(min(delay, 60))
+                self._wakeup.clear()
+                continue
 
-    while True:
-        if not is_connected():
-            log("Sem conexão com a internet. Pulando execução...")
-            time.sleep(minimal_interval)
-            continue
-        
+            # Agrupa todas as tarefas que vencem dentro da janela
+            limit = time.time() + self.coalesce_window
+            batch = []
+            with self._lock:
+                while self._heap and self._heap[0][0] <= limit:
+                    planned, _, task = heapq.heappop(self._heap)
+                    batch.append((planned, task))
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
         now = time.time()
-        
-        if now - last_fullsync >= full_interval:
-            log("Performing FULL sync")
-            send_data(fullsync=True)
-            last_fullsync = now
-        else:
-            log("Performing MINIMAL sync")
-            send_data(fullsync=False)
+        superseded = set()
+        for _, task in batch:
+            superseded |= task.supersedes
+
+        for planned, task in batch:
+            with self._lock:
+                self._push(self.next_slot(task, max(now, planned)), task)
+
+            if task.name in superseded:
+                task.coalesced += 1
+                continue
+
+            lag = max(0.0, now - planned)
+            if lag >= task.interval:
+                task.missed += int(lag // task.interval)
+            if task.running:
+                # A execução anterior ainda não terminou: perde este slot
+                task.missed += 1
+                log(f"Tarefa {task.name} ainda em execução, slot ignorado.")
+                continue
+
+            task.running = True
+            self._executor.submit(self._run, task, planned)
+
+    def _run(self, task, planned):
+        started = time.monotonic()
+        try:
+            # Locks adquiridos sempre pela mesma ordem (grupos ordenados)
+            with contextlib.ExitStack() as stack:
+                for group in task.groups:
+                    stack.enter_context(self._group_locks[group])
+                # O atraso conta até ao início real, incluindo a espera pelos
+                # grupos (ex.: atrás de um full sync longo)
+                started = time.monotonic()
+                actual = time.time()
+                lag = max(0.0, actual - planned)
+                task.last_planned = planned
+                task.last_actual = actual
+                task.last_lag = lag
+                task.max_lag = max(task.max_lag, lag)
+                task.total_lag += lag
+                task.func()
+        except Exception as e:
+            log(f"Erro na tarefa {task.name}: {e}", level='ERROR')
+        finally:
+            task.runs += 1
+            task.last_duration = time.monotonic() - started
+            task.running = False
 
-        if now - last_remote_check >= remote_check_interval:
-            check_remote_actions()
-            check_and_run_remote_scripts()
-            check_and_run_updates()
-            last_remote_check = now
+    def stats(self):
+        def fmt(ts):
+            return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else None
 
-        check_for_updates()
-        time.sleep(minimal_interval)
+        return {
+            task.name: {
+                'Interval': task.interval,
+                'Runs': task.runs,
+                'Missed': task.missed,
+                'Coalesced': task.coalesced,
+                'LastPlanned': fmt(task.last_planned),
+                'LastActual': fmt(task.last_actual),
+                'LastLagSeconds': round(task.last_lag, 2),
+                'MaxLagSeconds': round(task.max_lag, 2),
+                'AvgLagSeconds': round(task.total_lag / task.runs, 2) if task.runs else 0,
+                'LastDurationSeconds': round(task.last_duration, 2)
+            }
+            for task in self.tasks.values()
+        }
+
+SCHEDULER = None
+
+
+# =================== MAIN LOOP ===================
+def run_full_sync():
+    log("Performing FULL sync")
+    send_data(fullsync=True, online=is_connected())
+
+def run_minimal_sync():
+    log("Performing MINIMAL sync")
+    send_data(fullsync=False, online=is_connected())
+
+def run_spool_drain():
+    if SPOOL.count() == 0 or not is_connected():
+        return
+    drain_spool(CONFIG.get('SpoolBatch'), CONFIG.get('SpoolRate'))
+
+# Tarefa do scheduler -> chave com o intervalo (alterável sem reiniciar o serviço)
+TASK_INTERVALS = {
+    'full_sync': 'FullSyncInterval',
+    'minimal_sync': 'MinimalSyncInterval',
+    'spool_drain': 'SpoolDrainInterval',
+    'remote_check': 'RemoteCheckInterval',
+    'self_update': 'UpdateCheckInterval'
+}
+
+
+if __name__ == '__main__':
+    CONFIG.refresh(force=True)
+    SAMPLER.start()
+    # kill -USR1 <pid> grava as estatísticas internas em STATE_DIR/agent_stats.json
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=dump_agent_stats, daemon=True).start())
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    log("Iniciando agente.")
+
+    SCHEDULER = Scheduler(seed=CONFIG.get('UniqueId'))
+    # O sync e o reenvio do spool partilham o mesmo grupo (nunca correm em simultâneo);
+    # quando o full sync e o minimal coincidem, corre apenas o full
+    SCHEDULER.add('full_sync', run_full_sync, CONFIG.get('FullSyncInterval'), run_now=True,
+                  group='sync', supersedes=['minimal_sync'])
+    SCHEDULER.add('minimal_sync', run_minimal_sync, CONFIG.get('MinimalSyncInterval'), group='sync')
+    SCHEDULER.add('spool_drain', run_spool_drain, CONFIG.get('SpoolDrainInterval'), group='sync')
+    # Com CommandLongPoll ativo o intervalo pode descer para poucos segundos
+    SCHEDULER.add('remote_check', check_remote_commands, CONFIG.get('RemoteCheckInterval'), run_now=True,
+                  group='commands')
+    # O auto-update reinicia o processo (execv): só corre sem sync nem comandos em curso
+    SCHEDULER.add('self_update', check_for_updates, CONFIG.get('UpdateCheckInterval'),
+                  group=('sync', 'commands'))
+    SCHEDULER.add('config_reload', CONFIG.refresh, CONFIG_RELOAD_INTERVAL)
+    for task_name, key in TASK_INTERVALS.items():
+        CONFIG.watch(key, lambda interval, task_name=task_name: SCHEDULER.set_interval(task_name, interval))
+    SCHEDULER.run_forever()
@@ -62,10 +62,20 @@ def get_icon():
     except:
         return QIcon(ICON_FILES["inactive"])
 
+def read_log_tail(path, max_chars=5000):
+    # Lê apenas o fim do ficheiro, sem carregar o log inteiro em memória
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_chars * 4))
+        data = f.read().decode('utf-8', errors='replace')
+    if size > max_chars * 4:
+        data = data.split('\n', 1)[-1]  # descarta a linha cortada
+    return data[-max_chars:]
+
 def show_logs():
     if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r') as f:
-            log_content = f.read()[-5000:]  # Mostra últimas linhas
+        log_content = read_log_tail(LOG_FILE)  # Mostra últimas linhas
     else:
         log_content = "Log não encontrado."
 
@@ -0,0 +1,731 @@
+#!/usr/bin/env python3
+# Benchmark offline do agente: executa send_data(fullsync=True) contra um
+# sistema simulado (fixtures geradas em disco) e o mock do servidor, sem
+# tocar no sistema real nem no agent.iwebit.app.
+#
+# Uso:
+#   python3 tools/benchmark.py --profile large --runs 5 --output base.json
+#   python3 tools/benchmark.py --profile large --runs 5 --output novo.json
+#   python3 tools/benchmark.py --compare base.json novo.json [--threshold 10]
+#
+# Fixtures geradas por perfil (small/large):
+#   proc/          /proc falso (PROC_DIR e psutil.PROCFS_PATH): processos, stat, meminfo, mounts
+#   sys/           /sys/class/block + /sys/class/dmi/id
+#   dev/disk/      links by-uuid / by-label
+#   dpkg/status    base de dados do dpkg
+#   rpm/           rpmdb.sqlite com cabeçalhos RPM
+#   pacman/        base local do pacman (local/<pacote>/desc) e sync/
+#   bin/           dmidecode, journalctl, apt, apt-cache, snap, flatpak, dnf, pacman (à frente no PATH)
+#   state/         STATE_DIR do agente (vazio no primeiro run = arranque a frio)
+#
+# O primeiro run é "a frio" (sem estado nem caches); os seguintes são "a quente".
+# Os syncs correm num processo filho com apenas o agente carregado, pelo que
+# PeakRssKB é o RSS máximo do agente (sem as fixtures nem o mock).
+# Os resultados são JSON e podem ser comparados entre versões com --compare.
+#
+# O agente só é usado pelas entradas públicas (send_data e as funções get_*), por
+# isso o mesmo harness mede a versão base e as seguintes; cada resultado grava o
+# commit do agente medido:
+#   git worktree add /tmp/iwebit-base <commit-base>
+#   python3 tools/benchmark.py --agent /tmp/iwebit-base/iwebit_agent.py --output base.json
+#   python3 tools/benchmark.py --output novo.json
+# Na versão base os caminhos fixos no código (/proc/cpuinfo, /sys/block, ...) leem
+# o host e o CPU é lido com a espera bloqueante de 1s: só esses valores não vêm
+# das fixtures.
+import argparse
+import collections
+import functools
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_AGENT = os.path.join(os.path.dirname(TOOLS_DIR), 'iwebit_agent.py')
+sys.path.insert(0, TOOLS_DIR)
+
+from mock_server import MockServer
+
+
+PROFILES = {
+    'small': {
+        'Packages': 300, 'Processes': 80, 'Interfaces': 4, 'Mounts': 6, 'Disks': 1,
+        'Upgrades': 20, 'Snaps': 5, 'Flatpaks': 3, 'RpmPackages': 100, 'PacmanPackages': 100,
+        'MemoryModules': 2,
+        'JournalEvents': 50, 'KernelEvents': 100
+    },
+    'large': {
+        'Packages': 5000, 'Processes': 500, 'Interfaces': 60, 'Mounts': 200, 'Disks': 24,
+        'Upgrades': 400, 'Snaps': 60, 'Flatpaks': 40, 'RpmPackages': 2000, 'PacmanPackages': 2000,
+        'MemoryModules': 16,
+        'JournalEvents': 1000, 'KernelEvents': 1000
+    }
+}
+
+BOOT_TIME = 1700000000
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+WORDS = ('lib', 'core', 'data', 'net', 'utils', 'common', 'tools', 'dev', 'python3', 'perl', 'gtk', 'qt5', 'x11')
+
+
+# =================== FIXTURES ===================
+def write(path, content, mode=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+def disk_name(i):
+    letters = ''
+    i += 1
+    while i:
+        i, rem = divmod(i - 1, 26)
+        letters = chr(97 + rem) + letters
+    return f"sd{letters}"
+
+def package_names(rng, count):
+    names = set()
+    while len(names) < count:
+        names.add(f"{rng.choice(WORDS)}-{rng.choice(WORDS)}{rng.randint(0, 9999)}")
+    return sorted(names)
+
+def build_proc(root, rng, profile):
+    proc = os.path.join(root, 'proc')
+    cpus = os.cpu_count() or 1
+    cpu_lines = ''.join(f"cpu{i} 1000 0 500 100000 10 0 5 0 0 0\n" for i in range(cpus))
+    write(os.path.join(proc, 'stat'),
+          f"cpu  {1000 * cpus} 0 {500 * cpus} {100000 * cpus} 10 0 5 0 0 0\n{cpu_lines}"
+          f"intr 0\nctxt 0\nbtime {BOOT_TIME}\nprocesses 1000\nprocs_running 1\nprocs_blocked 0\n")
+    write(os.path.join(proc, 'uptime'), "86400.00 170000.00\n")
+    write(os.path.join(proc, 'meminfo'), ''.join(f"{k}: {v} kB\n" for k, v in [
+        ('MemTotal', 16318412), ('MemFree', 2301200), ('MemAvailable', 9120344), ('Buffers', 401220),
+        ('Cached', 6123400), ('SwapCached', 0), ('Active', 7012300), ('Inactive', 4512000),
+        ('Shmem', 512000), ('SReclaimable', 402100), ('SwapTotal', 2097148), ('SwapFree', 2097148)
+    ]))
+    write(os.path.join(proc, 'vmstat'), "pswpin 0\npswpout 0\n")
+    write(os.path.join(proc, 'filesystems'), "nodev\tsysfs\nnodev\tproc\nnodev\ttmpfs\n\text4\n\txfs\n\tvfat\n")
+
+    uids = sorted({0, os.getuid(), 65534})
+    names = ['systemd', 'sshd', 'cron', 'rsyslogd', 'nginx', 'postgres', 'python3', 'bash',
+             'containerd', 'kworker/0:1', 'gnome-shell', 'Xorg', 'dbus-daemon', 'snapd']
+    for i in range(profile['Processes']):
+        pid = i + 1
+        if i < 2:
+            # Clientes DHCP, para o coletor NetworkInfo
+            comm, cmdline = 'dhclient', ['/sbin/dhclient', '-1', '-4', f'eth{i}']
+        else:
+            comm = rng.choice(names)
+            cmdline = [f"/usr/bin/{comm}"] + [f"--opt{n}={rng.randint(0, 999)}" for n in range(rng.randint(0, 6))]
+        uid = rng.choice(uids)
+        utime, stime = rng.randint(0, 500000), rng.randint(0, 100000)
+        rss = rng.randint(100, 200000)
+        start = rng.randint(100, 8000000)
+        # 50 campos após "(comm)", como no kernel
+        fields = ['S', 1, pid, pid, 0, -1, 4194560, 100, 0, 0, 0, utime, stime, 0, 0, 20, 0,
+                  rng.randint(1, 32), 0, start, rss * 4096 * 4, rss, 18446744073709551615] + [0] * 27
+        fields[36] = rng.randrange(cpus)
+        base = os.path.join(proc, str(pid))
+        write(os.path.join(base, 'stat'), f"{pid} ({comm[:15]}) " + ' '.join(map(str, fields)) + "\n")
+        write(os.path.join(base, 'comm'), comm[:15] + "\n")
+        write(os.path.join(base, 'cmdline'), '\0'.join(cmdline) + '\0')
+        write(os.path.join(base, 'status'),
+              f"Name:\t{comm[:15]}\nState:\tS (sleeping)\nPid:\t{pid}\nPPid:\t1\n"
+              f"Uid:\t{uid}\t{uid}\t{uid}\t{uid}\nGid:\t{uid}\t{uid}\t{uid}\t{uid}\n"
+              f"VmRSS:\t{rss * 4} kB\nThreads:\t1\n")
+        write(os.path.join(base, 'statm'), f"{rss * 4} {rss} 0 0 0 0 0\n")
+    return proc
+
+def build_block_devices(root, rng, profile):
+    # /sys/class/block (links para /sys/devices/...), /dev/disk/by-*, montagens em proc/self/mounts
+    sys_block = os.path.join(root, 'sys', 'class', 'block')
+    devices = os.path.join(root, 'sys', 'devices')
+    dev_disk = os.path.join(root, 'dev', 'disk')
+    os.makedirs(sys_block, exist_ok=True)
+    for kind in ('by-uuid', 'by-label'):
+        os.makedirs(os.path.join(dev_disk, kind), exist_ok=True)
+
+    disks = [disk_name(i) for i in range(profile['Disks'])]
+    for disk in disks:
+        write(os.path.join(devices, 'block', disk, 'queue', 'rotational'), rng.choice('01') + "\n")
+        os.symlink(os.path.join(devices, 'block', disk), os.path.join(sys_block, disk))
+
+    mounts = []
+    for i in range(profile['Mounts']):
+        disk = disks[i % len(disks)]
+        part = f"{disk}{i // len(disks) + 1}"
+        part_dir = os.path.join(devices, 'block', disk, part)
+        write(os.path.join(part_dir, 'partition'), f"{i // len(disks) + 1}\n")
+        os.symlink(part_dir, os.path.join(sys_block, part))
+        device = part
+        if i % 10 == 9:
+            # Volume LUKS sobre a partição
+            device = f"dm-{i}"
+            dm_dir = os.path.join(devices, 'virtual', 'block', device)
+            write(os.path.join(dm_dir, 'dm', 'uuid'), f"CRYPT-LUKS2-{rng.getrandbits(64):016x}-{device}\n")
+            write(os.path.join(dm_dir, 'slaves', part), '')
+            os.symlink(dm_dir, os.path.join(sys_block, device))
+
+        uuid = f"{rng.getrandbits(32):08x}-{rng.getrandbits(16):04x}-{rng.getrandbits(16):04x}-{rng.getrandbits(16):04x}-{rng.getrandbits(48):012x}"
+        os.symlink(f"../../{device}", os.path.join(dev_disk, 'by-uuid', uuid))
+        os.symlink(f"../../{device}", os.path.join(dev_disk, 'by-label', f"data\\x20{i}"))
+
+        mountpoint = os.path.join(root, 'mnt', f"vol{i}")
+        os.makedirs(mountpoint, exist_ok=True)
+        mounts.append(f"/dev/{device} {mountpoint} {rng.choice(['ext4', 'xfs'])} rw,relatime 0 0\n")
+
+    write(os.path.join(root, 'proc', 'self', 'mounts'),
+          "proc /proc proc rw 0 0\ntmpfs /run tmpfs rw 0 0\n" + ''.join(mounts))
+    return sys_block, dev_disk
+
+def build_dmi(root):
+    dmi = os.path.join(root, 'sys', 'class', 'dmi', 'id')
+    for name, value in {
+        'board_vendor': 'Bench Corp', 'board_name': 'BX-1000', 'board_version': '1.0',
+        'board_serial': 'BS123456', 'bios_vendor': 'Bench BIOS', 'bios_version': '2.4.1',
+        'bios_date': '01/15/2024', 'product_serial': 'PS123456'
+    }.items():
+        write(os.path.join(dmi, name), value + "\n")
+    return dmi
+
+def dmidecode_memory(count):
+    blocks = ["# dmidecode 3.3\n"]
+    for i in range(count):
+        blocks.append(
+            f"Handle 0x{0x1100 + i:04X}, DMI type 17, 92 bytes\nMemory Device\n"
+            f"\tSize: 8 GB\n\tForm Factor: DIMM\n\tLocator: DIMM{i}\n\tBank Locator: BANK {i}\n"
+            f"\tType: DDR4\n\tSpeed: 3200 MT/s\n\tManufacturer: Bench\n\tSerial Number: {i:08X}\n"
+            f"\tPart Number: BENCH-8G\n\tConfigured Memory Speed: 3200 MT/s\n"
+        )
+    return '\n'.join(blocks)
+
+def journal_events(rng, count, kernel):
+    lines = []
+    now = int(time.time() * 1000000)
+    for i in range(count):
+        entry = {
+            '__CURSOR': f"s=bench;i={i:x}",
+            '__REALTIME_TIMESTAMP': str(now - (count - i) * 1000000),
+            'PRIORITY': str(rng.choice([2, 3, 4]) if not kernel else rng.randint(0, 6)),
+            '_HOSTNAME': 'bench-host',
+            'SYSLOG_IDENTIFIER': 'kernel' if kernel else rng.choice(['sshd', 'systemd', 'nginx', 'cron']),
+            'MESSAGE': f"Evento de teste {i}: " + ' '.join(rng.choice(WORDS) for _ in range(12))
+        }
+        if not kernel:
+            entry['_PID'] = str(rng.randint(1, 65535))
+        lines.append(json.dumps(entry))
+    return '\n'.join(lines) + '\n'
+
+def build_packages(root, rng, profile):
+    names = package_names(rng, profile['Packages'])
+    stanzas = []
+    for name in names:
+        stanzas.append(
+            f"Package: {name}\nStatus: install ok installed\nPriority: optional\nSection: libs\n"
+            f"Installed-Size: {rng.randint(10, 50000)}\nMaintainer: Bench <bench@example.com>\n"
+            f"Architecture: amd64\nVersion: {rng.randint(0, 9)}.{rng.randint(0, 99)}-{rng.randint(1, 9)}\n"
+            f"Depends: libc6 (>= 2.34)\nDescription: pacote de teste {name}\n"
+            f" Descrição longa do pacote {name}.\n .\n Segunda linha.\n"
+        )
+    write(os.path.join(root, 'dpkg', 'status'), '\n'.join(stanzas) + '\n')
+    write(os.path.join(root, 'apt-lists', 'bench_dists_stable_main_binary-amd64_Packages'), "")
+    write(os.path.join(root, 'apt-lists', 'bench_dists_stable_Release'), "")
+
+    upgrades = rng.sample(names, min(profile['Upgrades'], len(names)))
+    lines = ["Listing..."]
+    for name in upgrades:
+        new_version = f"{rng.randint(10, 20)}.0-1"
+        lines.append(f"{name}/stable-updates {new_version} amd64 [upgradable from: 1.0-1]")
+        write(os.path.join(root, 'apt-show', name),
+              f"Package: {name}\nVersion: {new_version}\nOrigin: Bench\n"
+              f"Date: 2024-01-01\nDescription: pacote de teste {name}\n\n")
+    write(os.path.join(root, 'apt-list.txt'), '\n'.join(lines) + '\n')
+
+    snaps = ["Name  Version  Rev  Tracking  Publisher  Notes"]
+    snaps += [f"snap{i}  1.{i}  {100 + i}  latest/stable  bench  -" for i in range(profile['Snaps'])]
+    write(os.path.join(root, 'snap-list.txt'), '\n'.join(snaps) + '\n')
+    write(os.path.join(root, 'flatpak-list.txt'),
+          ''.join(f"org.bench.App{i}\t1.{i}\tsystem\n" for i in range(profile['Flatpaks'])))
+    # Ficheiros que o snapd/flatpak alteram a cada instalação (chave da cache)
+    write(os.path.join(root, 'snapd', 'state.json'), '{}')
+    write(os.path.join(root, 'flatpak', '.changed'), '')
+
+def rpm_header(fields):
+    # Cabeçalho RPM como no rpmdb: (tag, tipo, valor) com tipos 4 (INT32) e 6 (STRING)
+    index, data = [], b''
+    for tag, kind, value in fields:
+        if kind == 4:
+            data += b'\0' * (-len(data) % 4)
+            index.append(struct.pack('>iIiI', tag, kind, len(data), 1))
+            data += struct.pack('>I', value)
+        else:
+            index.append(struct.pack('>iIiI', tag, kind, len(data), 1))
+            data += value.encode() + b'\0'
+    return struct.pack('>II', len(index), len(data)) + b''.join(index) + data
+
+def build_rpm_packages(root, rng, profile):
+    names = package_names(rng, profile['RpmPackages'])
+    os.makedirs(os.path.join(root, 'rpm'), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(root, 'rpm', 'rpmdb.sqlite'))
+    conn.execute("CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT, blob BLOB NOT NULL)")
+    conn.executemany("INSERT INTO Packages (blob) VALUES (?)", [
+        (rpm_header([
+            (1000, 6, name), (1001, 6, f"{rng.randint(0, 9)}.{rng.randint(0, 99)}"), (1002, 6, '1.fc40'),
+            (1004, 6, f"pacote de teste {name}"), (1008, 4, BOOT_TIME - rng.randint(0, 10 ** 7)),
+            (1009, 4, rng.randint(10, 50000) * 1024), (1022, 6, 'x86_64')
+        ]),)
+        for name in names
+    ])
+    conn.commit()
+    conn.close()
+
+    lines = [f"{name}.x86_64  {rng.randint(10, 20)}.0-1.fc40  updates"
+             for name in rng.sample(names, min(profile['Upgrades'], len(names)))]
+    write(os.path.join(root, 'dnf-check-update.txt'), '\n' + '\n'.join(lines) + '\n')
+    os.makedirs(os.path.join(root, 'dnf-cache'), exist_ok=True)
+
+def build_pacman_packages(root, rng, profile):
+    names = package_names(rng, profile['PacmanPackages'])
+    for name in names:
+        version = f"{rng.randint(0, 9)}.{rng.randint(0, 99)}-1"
+        write(os.path.join(root, 'pacman', 'local', f"{name}-{version}", 'desc'),
+              f"%NAME%\n{name}\n\n%VERSION%\n{version}\n\n%DESC%\npacote de teste {name}\n\n"
+              f"%ARCH%\nx86_64\n\n%INSTALLDATE%\n{BOOT_TIME - rng.randint(0, 10 ** 7)}\n\n"
+              f"%SIZE%\n{rng.randint(10, 50000) * 1024}\n\n%DEPENDS%\nglibc\nbash\n\n")
+    write(os.path.join(root, 'pacman', 'sync', 'core.db'), '')
+
+    lines = [f"{name} 1.0-1 -> {rng.randint(10, 20)}.0-1"
+             for name in rng.sample(names, min(profile['Upgrades'], len(names)))]
+    write(os.path.join(root, 'pacman-qu.txt'), '\n'.join(lines) + '\n')
+
+def build_commands(root, rng, profile):
+    # Scripts shell (cat de ficheiros) para o custo de lançar o processo ser
+    # próximo do dos binários reais
+    bin_dir = os.path.join(root, 'bin')
+    write(os.path.join(root, 'dmidecode-17.txt'), dmidecode_memory(profile['MemoryModules']))
+    write(os.path.join(root, 'journal-errors.json'), journal_events(rng, profile['JournalEvents'], False))
+    write(os.path.join(root, 'journal-kernel.json'), journal_events(rng, profile['KernelEvents'], True))
+
+    scripts = {
+        'dmidecode': f'case "$2" in 17) exec cat "{root}/dmidecode-17.txt";; esac\nexit 0\n',
+        'journalctl': (
+            'case " $* " in *" --after-cursor "*) exit 0;; esac\n'
+            f'case " $* " in *" -k "*) exec cat "{root}/journal-kernel.json";; esac\n'
+            f'exec cat "{root}/journal-errors.json"\n'
+        ),
+        'apt': f'exec cat "{root}/apt-list.txt"\n',
+        'apt-cache': f'shift\nfor p in "$@"; do cat "{root}/apt-show/$p" 2>/dev/null; done\nexit 0\n',
+        'snap': f'exec cat "{root}/snap-list.txt"\n',
+        'flatpak': f'exec cat "{root}/flatpak-list.txt"\n',
+        'dnf': f'cat "{root}/dnf-check-update.txt"\nexit 100\n',
+        'pacman': f'exec cat "{root}/pacman-qu.txt"\n',
+        'needs-restarting': 'exit 0\n'
+    }
+    for name, body in scripts.items():
+        write(os.path.join(bin_dir, name), "#!/bin/sh\n" + body, 0o755)
+    return bin_dir
+
+def build_interfaces(profile):
+    # Resposta de psutil.net_if_addrs() e netifaces.gateways() para N interfaces
+    import psutil
+    snicaddr = collections.namedtuple('snicaddr', ['family', 'address', 'netmask', 'broadcast', 'ptp'])
+    addrs = {}
+    for i in range(profile['Interfaces']):
+        name = f"eth{i}" if i < 2 else f"veth{i:04x}"
+        addrs[name] = [
+            snicaddr(psutil.AF_LINK, f"02:42:ac:11:{i // 256:02x}:{i % 256:02x}", None, 'ff:ff:ff:ff:ff:ff', None),
+            snicaddr(socket.AF_INET, f"10.{i // 256}.{i % 256}.2", '255.255.255.0', None, None),
+            snicaddr(socket.AF_INET6, f"fe80::42:acff:fe11:{i:x}%{name}", 'ffff:ffff:ffff:ffff::', None, None)
+        ]
+    return addrs
+
+def build_fixtures(root, profile, seed=1):
+    rng = random.Random(seed)
+    fixtures = {'Root': root}
+    fixtures['Proc'] = build_proc(root, rng, profile)
+    fixtures['SysBlock'], fixtures['DevDisk'] = build_block_devices(root, rng, profile)
+    fixtures['Dmi'] = build_dmi(root)
+    build_packages(root, rng, profile)
+    build_rpm_packages(root, rng, profile)
+    build_pacman_packages(root, rng, profile)
+    fixtures['Bin'] = build_commands(root, rng, profile)
+    write(os.path.join(root, 'boot_id'), "6f1c2b1e-bench-4e2a-9d0f-000000000001\n")
+    for name in ('leases', 'nm-devices', 'state'):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+    return fixtures
+
+
+# =================== SETUP ===================
+# Coletores do full sync (secção -> função pública do agente). O harness só usa
+# send_data e estas funções, para correr tanto na versão base como nas seguintes;
+# as funções que não existem numa versão são ignoradas.
+COLLECTOR_FUNCS = {
+    'MACAddress': 'get_mac_address', 'ProcessList': 'get_process_list',
+    'ProcessSummary': 'get_process_summary', 'Uptime': 'get_uptime', 'LastBoot': 'get_last_boot',
+    'TimeZone': 'get_timezone', 'KernelVersion': 'get_kernel_version',
+    'CPUArchitecture': 'get_architecture', 'NumLoggedUsers': 'get_logged_users',
+    'PublicIP': 'get_public_ip', 'TotalRAM': 'get_total_memory', 'IdDeviceType': 'get_device_type',
+    'InstalledSoftware': 'get_all_installed_software', 'PendingUpdates': 'get_pending_updates',
+    'BiosUpgrade': 'get_bios_last_upgrade_date', 'OS_Info': 'get_os_info', 'Bios_Info': 'get_bios_info',
+    'MB_Info': 'get_motherboard_info', 'CPU_Info': 'get_cpu_info',
+    'NetworkInfo': 'get_network_interfaces_info', 'DiskInfo': 'get_disk_info',
+    'MemoryInfo': 'get_physical_memory_info', 'SystemErrorsWarnings': 'get_linux_errors_warnings',
+    'KernelEvents': 'get_kernel_events'
+}
+
+def path_overrides(root, fixtures, server_url):
+    # Constantes de caminhos/URLs do módulo; só são aplicadas as que existem na
+    # versão carregada (a versão base tem caminhos fixos no código, que leem o host)
+    return {
+        'CONFIG_FILE': os.path.join(root, 'iwebit_agent.conf'),
+        'LOG_FILE': os.path.join(root, 'iwebit_agent.log'),
+        'STATE_DIR': os.path.join(root, 'state'),
+        'BOOT_ID_FILE': os.path.join(root, 'boot_id'),
+        'PROC_DIR': fixtures['Proc'],
+        'DMI_ID_DIR': fixtures['Dmi'],
+        'SYS_CLASS_BLOCK': fixtures['SysBlock'],
+        'DEV_DISK_DIR': fixtures['DevDisk'],
+        'DPKG_STATUS_FILE': os.path.join(root, 'dpkg', 'status'),
+        'APT_LISTS_DIR': os.path.join(root, 'apt-lists'),
+        'RPMDB_DIRS': (os.path.join(root, 'rpm'),),
+        'DNF_CACHE_DIRS': {'dnf': (os.path.join(root, 'dnf-cache'),)},
+        'PACMAN_DB_DIR': os.path.join(root, 'pacman'),
+        'SNAPD_STATE_FILE': os.path.join(root, 'snapd', 'state.json'),
+        'FLATPAK_CHANGED_FILES': (os.path.join(root, 'flatpak', '.changed'),),
+        'NETWORKD_LEASES_DIR': os.path.join(root, 'leases'),
+        'NM_DEVICES_DIR': os.path.join(root, 'nm-devices'),
+        'SERVER_URL': server_url,
+        'API_URL': f"{server_url}/scripts/script_linux.php",
+        'SCRIPT_API_URL': f"{server_url}/scripts/script_api.php"
+    }
+
+def agent_commit(agent_path):
+    # Commit da árvore do agente medido, para os resultados serem reproduzíveis
+    directory = os.path.dirname(os.path.abspath(agent_path))
+    try:
+        commit = subprocess.run(['git', '-C', directory, 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', '-C', directory, 'status', '--porcelain', '--',
+                                os.path.basename(agent_path)],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def load_agent(agent_path, fixtures, profile, server_url):
+    # O agente lê caminhos e URLs de constantes do módulo: basta substituí-las
+    # antes do primeiro sync
+    root = fixtures['Root']
+    os.environ['PATH'] = fixtures['Bin'] + os.pathsep + os.environ.get('PATH', '')
+
+    import psutil
+    import netifaces
+    psutil.PROCFS_PATH = fixtures['Proc']
+    interfaces = build_interfaces(profile)
+    psutil.net_if_addrs = lambda: interfaces
+    netifaces.gateways = lambda: {'default': {netifaces.AF_INET: ('10.0.0.1', 'eth0')},
+                                  netifaces.AF_INET: [('10.0.0.1', 'eth0', True)]}
+
+    spec = importlib.util.spec_from_file_location('iwebit_agent', agent_path)
+    agent = importlib.util.module_from_spec(spec)
+    sys.modules['iwebit_agent'] = agent
+    spec.loader.exec_module(agent)
+
+    write(os.path.join(root, 'iwebit_agent.conf'),
+          f"UniqueId = bench-{platform.node()}\nIdSync = 0\nLog = 0\nDebug = 0\n"
+          f"JournalMaxEvents = {profile['JournalEvents']}\n"
+          f"JournalMaxKernelEvents = {profile['KernelEvents']}\n")
+    for name, value in path_overrides(root, fixtures, server_url).items():
+        if hasattr(agent, name):
+            setattr(agent, name, value)
+    if hasattr(agent, 'PayloadSpool'):
+        agent.SPOOL = agent.PayloadSpool(agent.state_path('spool.db'))
+    return agent
+
+def seed_state(agent):
+    # IP público já em cache (o benchmark não consulta o ipinfo.io). Versões sem
+    # cache consultam-no em cada sync: recebem valores fixos
+    if hasattr(agent, 'get_network_fingerprint'):
+        now = time.time()
+        agent.save_state('egress_identity.json', {
+            'PublicIP': '203.0.113.10', 'Latitude': '38.72', 'Longitude': '-9.14',
+            'Updated': now, 'LastAttempt': now, 'Fingerprint': agent.get_network_fingerprint()
+        })
+    else:
+        agent.get_public_ip = lambda: '203.0.113.10'
+        agent.get_location = lambda: ('38.72', '-9.14')
+
+def seed_sample(agent):
+    # Uma amostra no buffer do sampler, como num agente já em execução (a versão
+    # base não tem sampler e lê sempre o CPU com uma espera de 1s)
+    sampler = getattr(agent, 'SAMPLER', None)
+    if sampler is None:
+        return
+    with sampler._lock:
+        sampler.samples.append({
+            'Time': time.time(), 'CPU': 0.0, 'PerCore': [0.0], 'Memory': 0.0,
+            'Swap': 0.0, 'LoadAvg': (0.0, 0.0, 0.0)
+        })
+
+class CollectorTimer:
+    # Mede cada coletor por fora: envolve as funções públicas (atributo do módulo
+    # e, se existir, a entrada no registo COLLECTORS) e conta os processos
+    # lançados pela thread do coletor. Processos de threads internas de um
+    # coletor só entram no total.
+    def __init__(self, agent):
+        self.collectors = {}
+        self.subprocesses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        registry = getattr(agent, 'COLLECTORS', [])
+        for section, name in COLLECTOR_FUNCS.items():
+            func = getattr(agent, name, None)
+            if func is None:
+                continue
+            timed = self.wrap(section, func)
+            setattr(agent, name, timed)
+            for entry in registry:
+                if entry.get('Func') is func:
+                    entry['Func'] = timed
+        self.patch_popen()
+
+    def reset(self):
+        with self._lock:
+            self.collectors = {}
+            self.subprocesses = 0
+
+    def stats(self, section):
+        return self.collectors.setdefault(
+            section, {'WallMs': 0.0, 'CpuMs': 0.0, 'Subprocesses': 0, 'Errors': 0})
+
+    def wrap(self, section, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            # Um coletor chamado por outro conta à parte; o de fora é reposto no fim
+            outer = getattr(self._local, 'section', None)
+            self._local.section = section
+            wall, cpu = time.monotonic(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.stats(section)['Errors'] += 1
+                raise
+            finally:
+                self._local.section = outer
+                with self._lock:
+                    s = self.stats(section)
+                    s['WallMs'] += (time.monotonic() - wall) * 1000
+                    s['CpuMs'] += (time.thread_time() - cpu) * 1000
+        return timed
+
+    def patch_popen(self):
+        timer = self
+
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                section = getattr(timer._local, 'section', None)
+                with timer._lock:
+                    timer.subprocesses += 1
+                    if section:
+                        timer.stats(section)['Subprocesses'] += 1
+                super().__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+
+def mock_wire(server_url):
+    with urllib.request.urlopen(f"{server_url}/mock/state") as response:
+        return json.load(response)['Wire']
+
+
+# =================== RUN ===================
+def run_once(agent, timer, server_url):
+    timer.reset()
+    seed_sample(agent)
+    sent = len(mock_wire(server_url))
+    started = time.monotonic()
+    agent.send_data(True)
+    total_ms = (time.monotonic() - started) * 1000
+
+    collectors = {
+        section: {key: round(value, 2) if isinstance(value, float) else value for key, value in s.items()}
+        for section, s in timer.collectors.items()
+    }
+    return {
+        'TotalMs': round(total_ms, 2),
+        'Collectors': collectors,
+        'Subprocesses': timer.subprocesses,
+        'PayloadBytes': sum(w['Bytes'] for w in mock_wire(server_url)[sent:]),
+        'PeakRssKB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def run_worker(spec_file):
+    # Processo filho: só o agente (sem fixtures nem mock), para o RSS máximo
+    # medir apenas o ciclo do agente
+    with open(spec_file) as f:
+        spec = json.load(f)
+    agent = load_agent(spec['Agent'], spec['Fixtures'], spec['Profile'], spec['ServerUrl'])
+    seed_state(agent)
+    timer = CollectorTimer(agent)
+    result = {
+        'AgentVersion': agent.VERSION,
+        'Runs': [run_once(agent, timer, spec['ServerUrl']) for _ in range(spec['Runs'])],
+        'ChildPeakRssKB': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+    with open(spec['Output'], 'w') as f:
+        json.dump(result, f)
+
+def run_agent_process(agent_path, root, fixtures, profile, server_url, runs):
+    spec_file = os.path.join(root, 'worker.json')
+    output = os.path.join(root, 'worker-result.json')
+    with open(spec_file, 'w') as f:
+        json.dump({'Agent': agent_path, 'Fixtures': fixtures, 'Profile': profile, 'ServerUrl': server_url,
+                   'Runs': runs, 'Output': output}, f)
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', spec_file], check=True)
+    with open(output) as f:
+        return json.load(f)
+
+def summarize_runs(runs):
+    cold, warm = runs[0], runs[1:] or runs[:1]
+
+    def median(values):
+        return round(statistics.median(values), 2)
+
+    collectors = {}
+    for section in sorted(cold['Collectors']):
+        warm_wall = [r['Collectors'].get(section, {}).get('WallMs', 0) for r in warm]
+        collectors[section] = {
+            'ColdMs': cold['Collectors'][section]['WallMs'],
+            'WarmMedianMs': median(warm_wall),
+            'WarmMaxMs': round(max(warm_wall), 2),
+            'CpuMs': median([r['Collectors'].get(section, {}).get('CpuMs', 0) for r in warm]),
+            'Subprocesses': cold['Collectors'][section]['Subprocesses'],
+            'WarmSubprocesses': warm[-1]['Collectors'].get(section, {}).get('Subprocesses', 0),
+            'Errors': sum(r['Collectors'].get(section, {}).get('Errors', 0) for r in runs)
+        }
+    return {
+        'Total': {'ColdMs': cold['TotalMs'], 'WarmMedianMs': median([r['TotalMs'] for r in warm])},
+        'Collectors': collectors,
+        'Subprocesses': {'Cold': cold['Subprocesses'], 'Warm': warm[-1]['Subprocesses']},
+        'PayloadBytes': {'Cold': cold['PayloadBytes'], 'Warm': warm[-1]['PayloadBytes']},
+        'PeakRssKB': runs[-1]['PeakRssKB']
+    }
+
+def run_benchmark(agent_path, profile_name, runs, keep=None):
+    profile = PROFILES[profile_name]
+    root = keep or tempfile.mkdtemp(prefix='iwebit_bench_')
+    if keep and os.path.exists(keep):
+        shutil.rmtree(keep)
+    os.makedirs(root, exist_ok=True)
+
+    server = MockServer().start()
+    try:
+        fixtures = build_fixtures(root, profile)
+        worker = run_agent_process(agent_path, root, fixtures, profile, server.url, runs)
+        received = server.state.received
+    finally:
+        server.stop()
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    summary = summarize_runs(worker['Runs'])
+    return {
+        'AgentVersion': worker['AgentVersion'],
+        'Commit': agent_commit(agent_path),
+        'Profile': profile_name,
+        'Fixtures': profile,
+        'Runs': runs,
+        'PayloadsReceived': received,
+        'Python': platform.python_version(),
+        'Host': platform.node(),
+        'DateTime': time.strftime('%Y-%m-%d %H:%M:%S'),
+        **summary,
+        'ChildPeakRssKB': worker['ChildPeakRssKB']
+    }
+
+
+# =================== COMPARE ===================
+def pct_change(base, new):
+    if not base:
+        return 0.0 if not new else float('inf')
+    return (new - base) / base * 100
+
+def compare(base, new, threshold):
+    # Tabela de diferenças; devolve o número de regressões acima do limiar (%)
+    if base.get('Profile') != new.get('Profile'):
+        print(f"Aviso: perfis diferentes ({base.get('Profile')} vs {new.get('Profile')})")
+
+    rows = [('TOTAL (quente)', base['Total']['WarmMedianMs'], new['Total']['WarmMedianMs']),
+            ('TOTAL (frio)', base['Total']['ColdMs'], new['Total']['ColdMs'])]
+    for section in sorted(set(base['Collectors']) | set(new['Collectors'])):
+        rows.append((section,
+                     base['Collectors'].get(section, {}).get('WarmMedianMs', 0),
+                     new['Collectors'].get(section, {}).get('WarmMedianMs', 0)))
+
+    regressions = 0
+    print(f"{'Coletor':<24}{base.get('AgentVersion', 'base'):>14}{new.get('AgentVersion', 'novo'):>14}{'Δ%':>10}")
+    for name, old, cur in rows:
+        change = pct_change(old, cur)
+        # Diferenças abaixo de 1ms são ruído
+        flag = ''
+        if change > threshold and cur - old >= 1:
+            flag = '  <-- regressão'
+            regressions += 1
+        print(f"{name:<24}{old:>12.1f}ms{cur:>12.1f}ms{change:>+9.1f}%{flag}")
+
+    for label, key in (('Processos (frio)', ('Subprocesses', 'Cold')),
+                       ('Processos (quente)', ('Subprocesses', 'Warm')),
+                       ('Payload (frio, bytes)', ('PayloadBytes', 'Cold')),
+                       ('Payload (quente, bytes)', ('PayloadBytes', 'Warm'))):
+        old, cur = base[key[0]][key[1]], new[key[0]][key[1]]
+        print(f"{label:<24}{old:>14}{cur:>14}{pct_change(old, cur):>+9.1f}%")
+    print(f"{'RSS máximo (KB)':<24}{base['PeakRssKB']:>14}{new['PeakRssKB']:>14}"
+          f"{pct_change(base['PeakRssKB'], new['PeakRssKB']):>+9.1f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark offline dos coletores do agente iWebIT')
+    parser.add_argument('--agent', default=DEFAULT_AGENT,
+                        help='iwebit_agent.py a medir (ex.: de um git worktree da versão base)')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small')
+    parser.add_argument('--runs', type=int, default=5, help='número de full syncs (o primeiro é a frio)')
+    parser.add_argument('--output', help='grava o resultado JSON neste ficheiro')
+    parser.add_argument('--keep-fixtures', metavar='DIR', help='gera as fixtures em DIR e não as apaga')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NOVO'), help='compara dois resultados')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regressão mínima (%%) assinalada')
+    parser.add_argument('--worker', metavar='SPEC', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_worker(args.worker)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(base, new, args.threshold) else 0)
+
+    result = run_benchmark(os.path.abspath(args.agent), args.profile, max(1, args.runs), args.keep_fixtures)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Verificação do decoder incremental das atualizações remotas (iter_json_objects):
+# cada documento é dividido em dois chunks em todos os offsets possíveis, e os
+# documentos maiores em chunks de tamanho fixo, como o iter_content do requests.
+# O resultado tem de ser sempre igual ao da leitura de uma só vez.
+#
+# Uso:
+#   python3 tools/check_json_stream.py
+import json
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+
+from iwebit_agent import iter_json_objects
+
+
+def updates(count):
+    return [
+        {
+            "LinuxUpdateID": f"u{i}",
+            "Package": f"pkg-{i}",
+            "Meta": {"Sec": i % 2 == 0, "Reboot": None, "Tags": ["a{", "}b", 'c"]'], "Level": i},
+            "Notes": "chave } e \\\" escapada" if i % 3 == 0 else ""
+        }
+        for i in range(count)
+    ]
+
+def documents(items):
+    return {
+        'array': json.dumps(items),
+        'pretty': json.dumps(items, indent=2),
+        'ndjson': '\n'.join(json.dumps(item) for item in items) + '\n',
+        'concatenated': ''.join(json.dumps(item) for item in items)
+    }
+
+def decode(chunks):
+    objects, errors = [], []
+    for obj, error in iter_json_objects(chunks):
+        if error:
+            errors.append(error)
+        else:
+            objects.append(obj)
+    return objects, errors
+
+def check(name, chunks, expected_objects, expected_errors=0):
+    objects, errors = decode(chunks)
+    if objects != expected_objects or len(errors) != expected_errors:
+        sizes = [len(chunk) for chunk in chunks]
+        print(f"FALHOU {name}: {len(objects)} objetos, erros={errors[:3]}, chunks={sizes[:5]}")
+        return False
+    return True
+
+def main():
+    failures = 0
+
+    # Todos os offsets de divisão em dois chunks
+    small = updates(6)
+    for kind, text in documents(small).items():
+        for offset in range(len(text) + 1):
+            failures += not check(f"{kind}@{offset}", [text[:offset], text[offset:]], small)
+
+    # Chunks de tamanho fixo sobre documentos grandes, com vários alinhamentos
+    large = updates(400)
+    for kind, text in documents(large).items():
+        for size in (1, 7, 1000, 8192):
+            for shift in range(0, min(size, 64)):
+                chunks = [text[:shift]] + [text[i:i + size] for i in range(shift, len(text), size)]
+                failures += not check(f"{kind}/{size}+{shift}", chunks, large)
+
+    # Entradas inválidas são reportadas sem perder as válidas; texto solto fora de
+    # um array não é uma entrada e é ignorado
+    valid = updates(3)
+    lines = [json.dumps(valid[0]), '{"LinuxUpdateID": "x", "Meta": {"Sec": fals}}',
+             json.dumps(valid[1]), 'lixo', json.dumps(valid[2])]
+    text = '\n'.join(lines) + '\n'
+    for offset in range(len(text) + 1):
+        failures += not check(f"invalido@{offset}", [text[:offset], text[offset:]], valid, 1)
+
+    # Objetos separados por vírgulas sem array
+    text = ','.join(json.dumps(item) for item in valid)
+    for offset in range(len(text) + 1):
+        failures += not check(f"virgulas@{offset}", [text[:offset], text[offset:]], valid)
+
+    # Respostas sem atualizações: nada a fazer, sem erros
+    for text in ('', 'null', '0', 'true', '[]', ' [ ] ', 'Sem atualizações pendentes.'):
+        for offset in range(len(text) + 1):
+            failures += not check(f"vazio {text!r}@{offset}", [text[:offset], text[offset:]], [])
+
+    # Um número no fim de um array não precisa de separador
+    failures += not check("escalar", ['[{"a": 1}, 7'], [{"a": 1}, 7])
+
+    # Entrada por fechar no fim do stream: as linhas seguintes recuperam-se
+    text = json.dumps(valid[0]) + '\n{"LinuxUpdateID": "y", "Meta": {\n' + json.dumps(valid[1]) + '\n'
+    failures += not check("incompleto", [text], valid[:2], 1)
+
+    print("OK" if not failures else f"{failures} falhas")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Verificação do dono dos processos (read_process): o utilizador vem do UID real
+# em /proc/<pid>/status e não do dono do diretório, que o kernel põe a root nos
+# processos não "dumpable". Usa um /proc falso em que os dois diferem.
+#
+# Uso:
+#   python3 tools/check_process_uid.py
+import os
+import shutil
+import sys
+import tempfile
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+
+import iwebit_agent
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def build_process(proc, pid, uid):
+    # Diretório criado pelo utilizador atual; o status indica outro UID real
+    base = os.path.join(proc, str(pid))
+    fields = ['S', 1, pid, pid, 0, -1, 0, 0, 0, 0, 0, 10, 5, 0, 0, 20, 0, 1, 0, 100, 4096, 1] + [0] * 28
+    write(os.path.join(base, 'stat'), f"{pid} (sshd) " + ' '.join(map(str, fields)) + "\n")
+    write(os.path.join(base, 'cmdline'), "sshd: user@pts/0\0")
+    write(os.path.join(base, 'status'),
+          f"Name:\tsshd\nState:\tS (sleeping)\nUid:\t{uid}\t0\t0\t0\nGid:\t{uid}\t{uid}\t{uid}\t{uid}\n")
+
+def main():
+    uid = 65534 if os.getuid() != 65534 else 65533
+    proc = tempfile.mkdtemp(prefix='iwebit_proc_')
+    try:
+        build_process(proc, 4242, uid)
+        iwebit_agent.PROC_DIR = proc
+        process = iwebit_agent.read_process('4242')
+    finally:
+        shutil.rmtree(proc, ignore_errors=True)
+
+    expected = iwebit_agent.get_username(uid)
+    if process['username'] != expected:
+        print(f"FALHOU: username={process['username']!r}, esperado {expected!r}")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
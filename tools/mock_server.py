@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# Servidor local que simula o agent.iwebit.app (script_linux.php e
+# script_api.php) para testar o agente sem contactar o servidor real.
+#
+# Uso:
+#   python3 tools/mock_server.py --port 8080 [--legacy]
+#
+# No agente basta apontar os URLs para o mock:
+#   import iwebit_agent
+#   iwebit_agent.SERVER_URL = 'http://127.0.0.1:8080'
+#   iwebit_agent.API_URL = 'http://127.0.0.1:8080/scripts/script_linux.php'
+#   iwebit_agent.SCRIPT_API_URL = 'http://127.0.0.1:8080/scripts/script_api.php'
+#
+# Endpoints de controlo:
+#   POST /mock/commands   {"Actions": {...}, "Script": {"Name": ..., "Content": ...}, "Updates": [...]}
+#   GET  /mock/state      payloads (contagem e tamanhos), resultados e pedidos recebidos
+#
+# Com --legacy o servidor ignora Commands=1 e não anuncia o formato compacto
+# (columnar/1 + gzip/zstd), tal como o servidor antigo.
+import argparse
+import gzip
+import json
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COLUMNAR_CONTENT_TYPE = 'application/vnd.iwebit.columnar+json'
+PAYLOAD_FORMAT_HEADER = 'X-IWebIT-Payload-Format'
+
+
+class MockState:
+    def __init__(self, legacy=False):
+        self.legacy = legacy
+        self.lock = threading.Condition()
+        self.version = 0
+        self.actions = {}
+        self.script = None
+        self.updates = []
+        self.scripts = {}
+        self.received = 0
+        self.wire = []
+        self.results = []
+        self.requests = []
+
+    def enqueue(self, base_url, commands):
+        with self.lock:
+            if commands.get('Actions'):
+                self.actions.update(commands['Actions'])
+            script = commands.get('Script')
+            if script:
+                if 'Content' in script:
+                    name = script.get('Name', 'script.sh')
+                    self.scripts[name] = script['Content']
+                    script = {'URL': f"{base_url}/mock/scripts/{name}"}
+                self.script = script
+            self.updates.extend(commands.get('Updates') or [])
+            self.version += 1
+            self.lock.notify_all()
+
+    def pending(self):
+        return bool(self.actions or self.script or self.updates)
+
+    def take_commands(self):
+        commands = {}
+        if self.actions:
+            commands['Actions'] = self.actions
+        if self.script:
+            commands['Script'] = self.script
+        if self.updates:
+            commands['Updates'] = self.updates
+        self.actions, self.script, self.updates = {}, None, []
+        return commands
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'Received': self.received,
+                'Wire': self.wire,
+                'Results': self.results,
+                'Requests': self.requests,
+                'Pending': {'Actions': self.actions, 'Script': self.script, 'Updates': self.updates}
+            }
+
+
+def snapshot_ack(payload):
+    # Confirma os snapshots recebidos (lista completa ou delta), como o servidor real
+    acks = {}
+    for key, value in payload.items():
+        if key.endswith('Hash') and isinstance(value, str):
+            acks[key[:-len('Hash')]] = value
+        elif key.endswith('Delta') and isinstance(value, dict) and value.get('Hash'):
+            acks[key[:-len('Delta')]] = value['Hash']
+    return acks
+
+
+def decode_columnar(document):
+    # Referência do lado do servidor para o formato columnar/1 do agente
+    strings = document['Strings']
+
+    def decode(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and '$table' in value:
+                table = value['$table']
+                rows = [{} for _ in range(table['Rows'])]
+                interned = set(table.get('Interned', ()))
+                absent = table.get('Absent', {})
+                for i, (field, column) in enumerate(zip(table['Fields'], table['Columns'])):
+                    skip = set(absent.get(str(i), ()))
+                    for n, item in enumerate(column):
+                        if n not in skip:
+                            rows[n][field] = (None if item is None else strings[item]) if i in interned else decode(item)
+                return rows
+            return {key: decode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return value
+
+    return decode(document['Data'])
+
+
+class UnsupportedPayload(Exception):
+    pass
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server_version = 'iWebITMock/1.0'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, status=200):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd' and zstandard and not self.state.legacy:
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif encoding:
+            raise UnsupportedPayload(encoding)
+        return body
+
+    def payload_headers(self):
+        # Anúncio dos formatos aceites (o servidor antigo não envia nada)
+        if self.state.legacy:
+            return {}
+        encodings = 'zstd, gzip' if zstandard else 'gzip'
+        return {PAYLOAD_FORMAT_HEADER: 'columnar/1, json', 'Accept-Encoding': encodings}
+
+    def query(self):
+        parsed = urllib.parse.urlparse(self.path)
+        return parsed.path, {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+
+    def record_request(self, path, params):
+        with self.state.lock:
+            self.state.requests.append({'Method': self.command, 'Path': path, 'Params': params})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):
+        path, params = self.query()
+        self.record_request(path, params)
+
+        if path == '/mock/state':
+            return self.send_json(self.state.snapshot())
+        if path.startswith('/mock/scripts/'):
+            name = path.rsplit('/', 1)[-1]
+            with self.state.lock:
+                content = self.state.scripts.get(name)
+            if content is None:
+                return self.send_text('', 404)
+            return self.send_text(content)
+        if path == '/scripts/script_api.php':
+            return self.script_api(params)
+        return self.send_text('', 404)
+
+    def do_POST(self):
+        path, params = self.query()
+        self.record_request(path, params)
+        try:
+            body = self.read_body()
+        except UnsupportedPayload:
+            return self.send_text('', 415)
+
+        if path == '/mock/commands':
+            self.state.enqueue(self.base_url(), json.loads(body or b'{}'))
+            return self.send_json({'Queued': True})
+        if path == '/scripts/script_linux.php':
+            content_type = self.headers.get('Content-Type', '')
+            if content_type == COLUMNAR_CONTENT_TYPE and not self.state.legacy:
+                payload = decode_columnar(json.loads(body))
+            elif content_type.startswith('application/json'):
+                payload = json.loads(body)
+            else:
+                return self.send_text('', 415)
+            # Só os tamanhos: guardar os payloads faria crescer o mock a cada sync
+            with self.state.lock:
+                self.state.received += 1
+                self.state.wire.append({
+                    'ContentType': content_type,
+                    'ContentEncoding': self.headers.get('Content-Encoding'),
+                    'Bytes': int(self.headers.get('Content-Length') or 0),
+                    'DecodedBytes': len(body),
+                    'Sections': len(payload)
+                })
+            return self.send_json({'SnapshotAck': snapshot_ack(payload)}, headers=self.payload_headers())
+        if path == '/scripts/script_api.php':
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update({'Body': json.loads(body or b'null')})
+            else:
+                params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()})
+            return self.script_api(params)
+        return self.send_text('', 404)
+
+    def script_api(self, params):
+        state = self.state
+
+        # Resultados enviados pelo agente
+        if 'ScriptRunned' in params or 'LinuxUpdatesRunned' in params:
+            with state.lock:
+                state.results.append(params)
+            return self.send_json({'Received': True})
+
+        if 'Commands' in params and not state.legacy:
+            return self.commands(params)
+
+        with state.lock:
+            if 'ScriptRun' in params:
+                script, state.script = state.script, None
+                return self.send_json(script or {})
+            if 'LinuxUpdatesRun' in params:
+                # Como o servidor antigo: objetos JSON concatenados
+                updates, state.updates = state.updates, []
+                return self.send_text(''.join(json.dumps(u) for u in updates))
+            actions, state.actions = state.actions, {}
+        return self.send_json({
+            'OperatingSystem_Reboot': actions.get('OperatingSystem_Reboot', '0'),
+            'OperatingSystem_ShutDown': actions.get('OperatingSystem_ShutDown', '0')
+        })
+
+    def commands(self, params):
+        state = self.state
+        wait = float(params.get('Wait') or 0)
+        etag = self.headers.get('If-None-Match')
+
+        with state.lock:
+            current = f'"{state.version}"'
+            if etag == current and not state.pending() and wait:
+                # Long-poll: espera por comandos novos até 'wait' segundos
+                state.lock.wait_for(lambda: state.version != int(current.strip('"')), timeout=wait)
+                current = f'"{state.version}"'
+            if etag == current and not state.pending():
+                self.send_response(304)
+                self.send_header('ETag', current)
+                self.end_headers()
+                return
+            commands = state.take_commands()
+        return self.send_json({'Commands': commands}, headers={'ETag': current})
+
+
+class MockServer:
+    # Servidor em segundo plano para usar a partir de testes/benchmarks
+    def __init__(self, host='127.0.0.1', port=0, legacy=False):
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = MockState(legacy=legacy)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock do servidor iWebIT para testes locais')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--legacy', action='store_true', help='sem canal de comandos unificado')
+    args = parser.parse_args()
+
+    server = MockServer(args.host, args.port, legacy=args.legacy)
+    print(f"Mock iWebIT a escutar em {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()